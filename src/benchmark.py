@@ -0,0 +1,319 @@
+from logging import getLogger
+import pandas as pd
+import numpy as np
+import gc
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from src.data.synthetic import make_drive_stats, save_drive_stats
+from src.data.hdd_preprocessing import load_preprocess_data, train_test_splitter
+from src.features.feature_engineering import unwrap_smart_7, calculate_ema, calculate_smart_999
+
+logger = getLogger(__name__)
+
+def git_commit() -> str:
+    """Commit of the working tree, "unknown" outside of a git repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure(func, *args, repeat=1, **kwargs) -> dict:
+    """Measure the wall time and the peak memory of a function call. The wall time is the
+    best of repeat untraced runs, the peak memory is traced in an additional run.
+
+    Args:
+        func (callable): Function to measure
+        repeat (int, optional): Number of timed runs. Defaults to 1.
+
+    Returns:
+        dict: Wall time in s, peak memory in MB and the result of the function
+    """
+    wall = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        wall.append(time.perf_counter() - start)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_s": min(wall), "peak_mb": peak / 1e6, "result": result}
+
+def benchmark_scale(n_drives:int, days:int, path:str, repeat=1, model_path=None) -> list:
+    """Benchmark the pipeline stages on synthetic data of one scale
+
+    Args:
+        n_drives (int): Number of drives
+        days (int): Number of days
+        path (str): Folder used as repo path for the synthetic csv file
+        repeat (int, optional): Number of timed runs per stage. Defaults to 1.
+        model_path (str, optional): Model used to benchmark run_predict, skipped if None. Defaults to None.
+
+    Returns:
+        list: Results of the stages
+    """
+    filename = f"synthetic_{n_drives}_{days}"
+    df = make_drive_stats(n_drives=n_drives, days=days)
+    file = save_drive_stats(df, filename=filename, path=path)
+    stages = []
+    def run(stage, func, *args, rows=None, runs=repeat, **kwargs):
+        measured = measure(func, *args, repeat=runs, **kwargs)
+        result = measured.pop("result")
+        stages.append({"stage": stage, "drives": n_drives, "days": days, "rows": rows, **measured})
+        logger.info(f"{stage} ({n_drives} drives, {days} days): {measured['wall_s']:.3f} s, {measured['peak_mb']:.1f} MB")
+        return result
+
+    def load_uncached():
+        # Remove the parquet cache so that the csv is parsed
+        for suffix in (".parquet", ".parquet.json"):
+            cache = f"{file}{suffix}"
+            if os.path.exists(cache):
+                os.remove(cache)
+        return load_preprocess_data(filename=filename, path=path)
+
+    run("load_preprocess_data_uncached", load_uncached, rows=len(df))
+    X, y = run("load_preprocess_data", load_preprocess_data, filename=filename, path=path, rows=len(df))
+    X_unwrapped = run("unwrap_smart_7", unwrap_smart_7, X, rows=len(X))
+    X_ema = run("calculate_ema", calculate_ema, X_unwrapped, rows=len(X))
+    run("calculate_smart_999", calculate_smart_999, X_ema, rows=len(X))
+    run("train_test_splitter", train_test_splitter, X, y, rows=len(X))
+    if model_path is not None:
+        from src.models.predict import run_predict
+        run("run_predict", run_predict, model_path=model_path, filename=filename, path=path, rows=len(df))
+    return stages
+
+# Scoring in a fresh interpreter, reports the time to import, load and score and the peak RSS
+cold_start_script = """
+import time
+start = time.perf_counter()
+import json, sys, resource
+engine, model_path, weights_file, rows, output = sys.argv[1:]
+if engine == "numpy":
+    from src.models.numpy_model import numpy_model
+    imported = time.perf_counter()
+    model = numpy_model.load(weights_file)
+else:
+    from mlflow.sklearn import load_model
+    imported = time.perf_counter()
+    model = load_model(model_path)
+loaded = time.perf_counter()
+import numpy as np
+with np.load(weights_file) as weights:
+    names = list(weights["feature_names"]) if "feature_names" in weights else None
+    n_features = int(weights["n_features"])
+X = np.random.default_rng(42).uniform(0, 100, (int(rows), n_features))
+if names is not None and engine != "numpy":
+    import pandas as pd
+    X = pd.DataFrame(X, columns=names)
+scoring = time.perf_counter()
+proba = model.predict_proba(X)[:, 1]
+scored = time.perf_counter()
+np.save(output, proba)
+# On Linux ru_maxrss keeps the peak of the forked benchmark process, VmHWM starts fresh at exec
+try:
+    with open("/proc/self/status") as f:
+        peak_mb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1e3
+except OSError:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+print(json.dumps({  "import_s": imported - start,
+                    "load_s": loaded - imported,
+                    "predict_s": scored - scoring,
+                    "peak_rss_mb": peak_mb,
+                    }))
+"""
+
+def benchmark_cold_start(model_path="models/deployment", weights_file=None, rows=1000) -> list:
+    """Benchmark the cold start of a scoring process with the MLflow model and with the NumPy
+    model of src.models.numpy_model. Each engine imports, loads the model and scores random
+    features in a fresh interpreter.
+
+    Args:
+        model_path (str, optional): Folder of the MLflow model. Defaults to "models/deployment".
+        weights_file (str, optional): Weights file exported by src.models.train. Defaults to
+            weights.npz in the model folder.
+        rows (int, optional): Number of scored rows. Defaults to 1000.
+
+    Returns:
+        list: Results per engine, with the largest probability difference to the MLflow model
+    """
+    weights_file = weights_file or f"{model_path}/weights.npz"
+    # The src package of this repo has to be importable by the fresh interpreter
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                                      os.environ.get("PYTHONPATH")]))}
+    results, probas = [], {}
+    with tempfile.TemporaryDirectory() as folder:
+        for engine in ("mlflow", "numpy"):
+            output = f"{folder}/{engine}.npy"
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", cold_start_script, engine, model_path, weights_file, str(rows), output],
+                                     capture_output=True, text=True, env=env)
+            wall = time.perf_counter() - start
+            if process.returncode != 0:
+                logger.warning(f"Cold start of the {engine} engine failed: {process.stderr.strip().splitlines()[-1:]}")
+                continue
+            result = {"stage": f"cold_start_{engine}", "rows": rows, "wall_s": wall, **json.loads(process.stdout.splitlines()[-1])}
+            probas[engine] = np.load(output)
+            results.append(result)
+            logger.info(f"Cold start {engine}: {wall:.3f} s, import {result['import_s']:.3f} s, "
+                        f"load {result['load_s']:.3f} s, predict {result['predict_s']:.3f} s, {result['peak_rss_mb']:.1f} MB")
+    if len(probas) == 2:
+        difference = float(np.abs(probas["mlflow"] - probas["numpy"]).max())
+        results[-1]["max_abs_diff"] = difference
+        logger.info(f"Largest probability difference between the engines: {difference:.2e}")
+    return results
+
+# Training in a fresh interpreter restricted to the first cores, reports the budget, wall time and utilization
+training_script = """
+import json, os, sys
+n_cores, features_file = int(sys.argv[1]), sys.argv[2]
+if hasattr(os, "sched_setaffinity"):
+    os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:n_cores])
+# The budget is applied before TensorFlow is initialized
+from src.models.resources import thread_budget, cpu_utilization
+budget = thread_budget(n_cores).apply()
+import pandas as pd
+from src.models.train import build_pipeline
+X = pd.read_parquet(features_file)
+y = X.pop("target")
+model = build_pipeline(y, input_dim=X.shape[1], budget=budget)
+with budget.backend(), cpu_utilization(budget.n_cores) as usage:
+    model.fit(X, y)
+print(json.dumps({**budget.as_dict(), **usage.report}))
+"""
+
+def benchmark_training(cores=(1, 2, 4, 8), n_drives=1000, days=365) -> list:
+    """Benchmark the training of the stacked model with growing core budgets on synthetic data.
+    Every budget trains in a fresh interpreter pinned to as many cores, so that the thread pools
+    are sized by the budget and not by the cores of the host.
+
+    Args:
+        cores (tuple, optional): Core budgets, budgets beyond the available cores are skipped. Defaults to (1, 2, 4, 8).
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        days (int, optional): Number of days. Defaults to 365.
+
+    Returns:
+        list: Thread budget, wall time, CPU time, utilization and speedup over the smallest budget per core budget
+    """
+    from src.features.feature_engineering import hdd_preprocessor
+    from src.models.resources import available_cores
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                                      os.environ.get("PYTHONPATH")]))}
+    results = []
+    with tempfile.TemporaryDirectory() as path:
+        filename = f"synthetic_{n_drives}_{days}"
+        save_drive_stats(make_drive_stats(n_drives=n_drives, days=days), filename=filename, path=path)
+        X, y = load_preprocess_data(filename=filename, path=path)
+        X_train, _, y_train, _ = train_test_splitter(X, y, method="hash")
+        features = hdd_preprocessor().fit_transform(X_train)
+        features["target"] = y_train.loc[features.index].astype(int)
+        features_file = f"{path}/features.parquet"
+        features.to_parquet(features_file)
+        for n_cores in [n for n in cores if n <= available_cores()]:
+            process = subprocess.run([sys.executable, "-c", training_script, str(n_cores), features_file],
+                                     capture_output=True, text=True, env=env)
+            if process.returncode != 0:
+                logger.warning(f"Training with {n_cores} cores failed: {process.stderr.strip().splitlines()[-1:]}")
+                continue
+            result = {"stage": "training", "drives": n_drives, "days": days, "rows": len(features),
+                      **json.loads(process.stdout.splitlines()[-1])}
+            result["speedup"] = results[0]["wall_s"] / result["wall_s"] if results else 1.0
+            results.append(result)
+            logger.info(f"Training with {n_cores} cores: {result['wall_s']:.1f} s, "
+                        f"{100 * result['utilization']:.0f} % utilization, speedup {result['speedup']:.2f}")
+    return results
+
+def run_benchmark(scales=((100, 365), (1000, 365), (10000, 365)), repeat=1, model_path=None, output=None) -> dict:
+    """Benchmark the pipeline at several scales and store the results in a json file
+
+    Args:
+        scales (tuple, optional): Pairs of number of drives and days. Defaults to ((100, 365), (1000, 365), (10000, 365)).
+        repeat (int, optional): Number of timed runs per stage. Defaults to 1.
+        model_path (str, optional): Model used to benchmark run_predict, skipped if None. Defaults to None.
+        output (str, optional): Json file for the results. Defaults to None.
+
+    Returns:
+        dict: Benchmark results
+    """
+    results = { "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "cpu_count": os.cpu_count(),
+                "stages": [],
+                }
+    with tempfile.TemporaryDirectory() as path:
+        for n_drives, days in scales:
+            results["stages"] += benchmark_scale(n_drives, days, path, repeat=repeat, model_path=model_path)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def compare_benchmarks(baseline:str, current:str) -> pd.DataFrame:
+    """Compare two benchmark result files
+
+    Args:
+        baseline (str): Json file of the baseline results
+        current (str): Json file of the current results
+
+    Returns:
+        pd.DataFrame: Wall time and peak memory of both runs and their ratios per stage and scale
+    """
+    frames = []
+    for file in (baseline, current):
+        with open(file) as f:
+            results = json.load(f)
+        frames.append(pd.DataFrame(results["stages"]).set_index(["stage", "drives", "days"])[["wall_s", "peak_mb"]])
+    df = frames[0].join(frames[1], lsuffix="_baseline", rsuffix="_current", how="outer")
+    df["speedup"] = df.wall_s_baseline / df.wall_s_current
+    df["memory_ratio"] = df.peak_mb_current / df.peak_mb_baseline
+    return df
+
+if __name__ == "__main__":
+    import logging
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    parser.add_argument("--drives", default="100,1000,10000", help="Comma separated numbers of drives")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--model-path", help="Also benchmark run_predict with this model")
+    parser.add_argument("--output", default="reports/benchmark.json")
+    parser.add_argument("--compare", help="Baseline json file to compare the results with")
+    parser.add_argument("--cold-start", metavar="MODEL_PATH",
+                        help="Only benchmark the cold start of the MLflow and the NumPy model")
+    parser.add_argument("--weights", help="Weights file of the NumPy model, defaults to weights.npz in the model folder")
+    parser.add_argument("--training-cores", metavar="CORES",
+                        help="Only benchmark the training with these comma separated core budgets")
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    if args.cold_start:
+        results = benchmark_cold_start(model_path=args.cold_start, weights_file=args.weights)
+        print(pd.DataFrame(results).set_index("stage").to_string())
+    elif args.training_cores:
+        cores = [int(n_cores) for n_cores in args.training_cores.split(",")]
+        n_drives = int(args.drives.split(",")[0])
+        results = benchmark_training(cores=cores, n_drives=n_drives, days=args.days)
+        print(pd.DataFrame(results).set_index("n_cores").to_string())
+    else:
+        scales = [(int(n_drives), args.days) for n_drives in args.drives.split(",")]
+        run_benchmark(scales=scales, repeat=args.repeat, model_path=args.model_path, output=args.output)
+        if args.compare:
+            print(compare_benchmarks(args.compare, args.output).to_string())
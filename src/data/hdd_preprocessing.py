@@ -1,32 +1,622 @@
 import pandas as pd
 import numpy as np
 import os
+import json
+import glob
+import hashlib
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
 
-def load_drive_stats(filename:str, path:str) -> pd.DataFrame:
-    """Load drive stats file
+from src.instrumentation import instrument_stage
+
+logger = getLogger(__name__)
+
+# Columns kept after loading the drive stats
+cols_of_importance = ['smart_4_raw', 'smart_5_raw', 'smart_7_raw', 'smart_9_raw',
+                        'smart_12_raw', 'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
+                        'smart_188_raw', 'smart_189_raw', 'smart_190_raw', 'smart_192_raw',
+                        'smart_193_raw', 'smart_194_raw', 'smart_197_raw', 'smart_198_raw',
+                        'smart_199_raw', 'smart_240_raw', 'smart_241_raw', 'smart_242_raw',
+                        'serial_number', 'date']
+
+# Suffixes of the raw drive stats file in the order they are looked up
+raw_suffixes = [".csv", ".csv.gz", ".csv.zip", ".zip"]
+# Folder of the saved smart_7 unwrap states, relative to the repo path
+SMART_7_CACHE = "data/cache/smart_7"
+# Separates archive and member in the names of zipped csv files, e.g. data_Q1_2019.zip::2019-01-01.csv
+MEMBER_SEP = "::"
+
+def source_signature(file:str, block_size:int=1 << 20) -> dict:
+    """Signature of a raw data file used to validate the columnar cache. The content
+    hash covers the first, middle and last block so that it stays cheap for multi-GB files.
+
+    Args:
+        file (str): Path of the raw data file
+        block_size (int, optional): Size of the hashed blocks in bytes. Defaults to 1 MiB.
+
+    Returns:
+        dict: Size, modification time and content hash of the file
+    """
+    stat = os.stat(file)
+    sha = hashlib.sha1()
+    with open(file, "rb") as f:
+        for offset in (0, stat.st_size // 2, stat.st_size - block_size):
+            f.seek(max(offset, 0))
+            sha.update(f.read(block_size))
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": sha.hexdigest()}
+
+def narrow_dtypes(df_in) -> pd.DataFrame:
+    """Downcast the numeric columns to the smallest dtype that stores the values exactly
+
+    Args:
+        df_in (pd.DataFrame): Drive stats data
+
+    Returns:
+        pd.DataFrame: Drive stats data with narrowed dtypes
+    """
+    df = df_in.copy()
+    for col in df.select_dtypes("float64").columns:
+        narrowed = df[col].astype("float32")
+        # Only keep float32 if no precision is lost
+        if np.array_equal(narrowed.values, df[col].values, equal_nan=True):
+            df[col] = narrowed
+    for col in df.select_dtypes("int64").columns:
+        df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+def write_cache(df, file:str, signature:dict):
+    """Store the drive stats in a parquet file next to the raw file. The signature of the
+    raw file and the original dtypes are stored in a json sidecar.
+
+    Args:
+        df (pd.DataFrame): Drive stats data as read from the raw file
+        file (str): Path of the raw data file
+        signature (dict): Signature of the raw data file
+    """
+    cache = f"{file}.parquet"
+    try:
+        narrow_dtypes(df).to_parquet(cache, index=False)
+    except (ImportError, OSError) as err:
+        logger.warning(f"Could not write the cache {cache}: {err}")
+        return
+    meta = {"signature": signature, "dtypes": df.dtypes.astype(str).to_dict()}
+    with open(f"{cache}.json", "w") as f:
+        json.dump(meta, f)
+
+def read_cache(file:str, signature:dict, columns=None, filters=None):
+    """Read the drive stats from the parquet cache if it matches the raw file
+
+    Args:
+        file (str): Path of the raw data file
+        signature (dict): Signature of the raw data file
+        columns (list, optional): Columns to read. Defaults to None (all columns).
+        filters (list, optional): Row filters applied while reading, see date_filters. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Drive stats data with the original dtypes, None if the cache is invalid
+    """
+    cache = f"{file}.parquet"
+    try:
+        with open(f"{cache}.json") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta["signature"] != signature or not os.path.exists(cache):
+        return None
+    try:
+        df = pd.read_parquet(cache, columns=columns, filters=filters)
+    except ImportError as err:
+        logger.warning(f"Could not read the cache {cache}: {err}")
+        return None
+    # Restore the dtypes as parsed from the csv
+    return df.astype({col: meta["dtypes"][col] for col in df.columns})
+
+def date_filters(start_date=None, end_date=None) -> list:
+    """Parquet row filters of a date range
+
+    Args:
+        start_date (str, optional): First date. Defaults to None (no lower bound).
+        end_date (str, optional): Last date, inclusive. Defaults to None (no upper bound).
+
+    Returns:
+        list: Filters for pd.read_parquet, None without bounds
+    """
+    filters = []
+    if start_date is not None:
+        filters.append(("date", ">=", pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(("date", "<=", pd.Timestamp(end_date)))
+    return filters or None
+
+def date_value(date, dates):
+    """Date comparable with a date column. Compact dates (see compact_dtypes) are day numbers.
+
+    Args:
+        date (str): Date
+        dates (pd.Series): Date column
+
+    Returns:
+        pd.Timestamp or int: Timestamp, or days since 1970-01-01 for an integer date column
+    """
+    date = pd.Timestamp(date)
+    if dates.dtype.kind in "iu":
+        return (date - pd.Timestamp(0)).days
+    return date
+
+def filter_dates(df, start_date=None, end_date=None) -> pd.DataFrame:
+    """Rows of the drive stats within a date range
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+        start_date (str, optional): First date. Defaults to None (no lower bound).
+        end_date (str, optional): Last date, inclusive. Defaults to None (no upper bound).
+
+    Returns:
+        pd.DataFrame: Rows within the range
+    """
+    if start_date is None and end_date is None:
+        return df
+    keep = np.ones(len(df), dtype=bool)
+    if start_date is not None:
+        keep &= (df.date >= date_value(start_date, df.date)).values
+    if end_date is not None:
+        keep &= (df.date <= date_value(end_date, df.date)).values
+    return df if keep.all() else df[keep]
+
+def ema_lookback(days=30, tolerance=1e-3) -> int:
+    """Number of daily observations the EMA needs to warm up. The observations before the
+    lookback carry less than the tolerance of the weight of the adjusted EMA, so the EMA of
+    the truncated history deviates by at most the tolerance times the range of the values.
+
+    Args:
+        days (int, optional): Span of the EMA. Defaults to 30.
+        tolerance (float, optional): Weight of the truncated history. Defaults to 1e-3.
+
+    Returns:
+        int: Number of days
+    """
+    decay = 1 - 2 / (days + 1)
+    return int(np.ceil(np.log(tolerance) / np.log(decay)))
+
+def warmup_start(start_date, days=30, tolerance=1e-3) -> pd.Timestamp:
+    """First date read for features from start_date on, see ema_lookback
+
+    Args:
+        start_date (str): First date of the features
+        days (int, optional): Span of the EMA. Defaults to 30.
+        tolerance (float, optional): Weight of the truncated history. Defaults to 1e-3.
+
+    Returns:
+        pd.Timestamp: First date to read
+    """
+    return pd.Timestamp(start_date) - pd.Timedelta(days=ema_lookback(days, tolerance))
+
+def raw_file(filename:str, path:str) -> str:
+    """Path of the raw drive stats file. Besides the csv file, a gzip or zip archive of it is
+    read without unzipping it first.
+
+    Args:
+        filename (str): Name of the csv file
+        path (str): Path of the repo
+
+    Returns:
+        str: Path of the csv file or of the archive
+    """
+    for suffix in raw_suffixes:
+        file = f"{path}/data/raw/{filename}{suffix}"
+        if os.path.exists(file):
+            return file
+    raise FileNotFoundError(f"No drive stats file {filename} with a suffix of {raw_suffixes} in {path}/data/raw")
+
+def archive_members(file:str) -> list:
+    """csv files of a raw data file. The csv members of a zip archive, like the quarterly
+    Backblaze zips, are named archive.zip::member.csv, other files are returned as they are.
+
+    Args:
+        file (str): Path of a csv, gzip or zip file
+
+    Returns:
+        list: Names of the csv files
+    """
+    if not file.endswith(".zip"):
+        return [file]
+    with zipfile.ZipFile(file) as archive:
+        # The quarterly zips may contain macOS metadata
+        members = sorted(name for name in archive.namelist()
+                         if name.endswith(".csv") and not name.startswith("__MACOSX"))
+    return [f"{file}{MEMBER_SEP}{member}" for member in members]
+
+@contextmanager
+def open_raw(file:str):
+    """Open a csv file for pd.read_csv. Members of zip archives are opened as a stream that
+    is decompressed while it is parsed, nothing is extracted to disk. Paths of csv and gzip
+    files are passed on, pandas decompresses them while parsing as well.
+
+    Args:
+        file (str): Path of a csv or gzip file or name of a zip member, see archive_members
+
+    Yields:
+        str or file: Path or binary stream of the csv file
+    """
+    if MEMBER_SEP not in file:
+        yield file
+        return
+    archive, member = file.split(MEMBER_SEP, 1)
+    with zipfile.ZipFile(archive) as zipped, zipped.open(member) as f:
+        yield f
+
+def iter_raw_csv(file:str, chunksize=100_000, **kwargs):
+    """Parse a csv file in chunks, see open_raw
+
+    Args:
+        file (str): Path of a csv or gzip file or name of a zip member
+        chunksize (int, optional): Number of rows parsed at once. Defaults to 100_000.
+        **kwargs: Arguments of pd.read_csv
+
+    Yields:
+        pd.DataFrame: Chunk of the csv file
+    """
+    with open_raw(file) as f:
+        yield from pd.read_csv(f, chunksize=chunksize, **kwargs)
+
+def map_ordered(func, items, n_jobs=1):
+    """Apply a function to the items in worker threads and yield the results in the order of
+    the items. At most n_jobs + 1 items are processed ahead of the consumer, which bounds the
+    memory. Threads suffice for parsing, the decompression and the csv tokenizer release the GIL.
+
+    Args:
+        func (callable): Function of an item
+        items (iterable): Items, e.g. csv files
+        n_jobs (int, optional): Number of worker threads, -1 for all cores. Defaults to 1 (no threads).
+
+    Yields:
+        Result of the function per item
+    """
+    if n_jobs == 1:
+        yield from map(func, items)
+        return
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) > n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def read_raw_csv(file:str, columns=None, start_date=None, end_date=None, chunksize=1_000_000, n_jobs=1) -> pd.DataFrame:
+    """Parse a raw drive stats file, which may be a gzip or zip archive. The members of a zip
+    archive are parsed in parallel. With a date range, every member is parsed in chunks which
+    are filtered to the range while reading.
+
+    Args:
+        file (str): Path of the csv file or of the archive
+        columns (list, optional): Columns to parse. Defaults to None (all columns).
+        start_date (str, optional): First date to keep. Defaults to None.
+        end_date (str, optional): Last date to keep. Defaults to None.
+        chunksize (int, optional): Number of rows parsed at once with a date range. Defaults to 1_000_000.
+        n_jobs (int, optional): Number of threads parsing archive members, see map_ordered. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: Dataframe containing the drive stats
+    """
+    parse_dates = ["date"] if columns is None or "date" in columns else False
+    def read_member(member):
+        if start_date is None and end_date is None:
+            with open_raw(member) as f:
+                return pd.read_csv(f, usecols=columns, parse_dates=parse_dates)
+        chunks = iter_raw_csv(member, chunksize=chunksize, usecols=columns, parse_dates=parse_dates)
+        return pd.concat([filter_dates(chunk, start_date, end_date) for chunk in chunks], ignore_index=True)
+    frames = list(map_ordered(read_member, archive_members(file), n_jobs=n_jobs))
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+@instrument_stage
+def load_drive_stats(filename:str, path:str, columns=None, use_cache=True, start_date=None, end_date=None,
+                     n_jobs=1) -> pd.DataFrame:
+    """Load drive stats file. The parsed csv is cached in a parquet file next to it, which
+    is used as long as size, modification time and content hash of the csv are unchanged.
+    The csv file may also be zipped or gzipped, see raw_file.
 
     Args:
         filename (str): Name of the csv file
         path (str): Path of the repo
+        columns (list, optional): Columns to load. Defaults to None (all columns).
+        use_cache (bool, optional): Read and write the parquet cache. Defaults to True.
+        start_date (str, optional): First date to load, filtered while reading. Defaults to None.
+        end_date (str, optional): Last date to load. Defaults to None.
+        n_jobs (int, optional): Number of threads parsing the members of a zip archive. Defaults to 1.
 
     Returns:
         pd.DataFrame: Dataframe containing the drive stats
     """
-    file = f"{path}/data/raw/{filename}.csv"
-    df = pd.read_csv(file, parse_dates=["date"])
+    file = raw_file(filename, path)
+    if not use_cache:
+        return read_raw_csv(file, columns=columns, start_date=start_date, end_date=end_date, n_jobs=n_jobs)
+    signature = source_signature(file)
+    df = read_cache(file, signature, columns=columns, filters=date_filters(start_date, end_date))
+    if df is None:
+        logger.info(f"Parsing {file} and writing the cache")
+        df = read_raw_csv(file, n_jobs=n_jobs)
+        write_cache(df, file, signature)
+        if columns is not None:
+            df = df.loc[:, columns]
+        df = filter_dates(df, start_date, end_date).reset_index(drop=True)
     return df
 
-def calculate_target(df_in, days=30):
+def __file_date(file:str):
+    # Daily Backblaze files are named by their date, e.g. 2019-01-31.csv
+    try:
+        return pd.Timestamp(os.path.basename(file).split(".")[0])
+    except ValueError:
+        return None
+
+def daily_files(source:str, start_date=None, end_date=None) -> list:
+    """List the daily drive stats files of a directory, an archive or a glob pattern in
+    chronological order. The files may be gzipped, and zip archives like the quarterly
+    Backblaze zips are listed by their csv members, see archive_members.
+
+    Args:
+        source (str): Directory containing the daily csv files or archives, zip archive or glob pattern
+        start_date (str, optional): Skip the files named by an earlier date. Defaults to None.
+        end_date (str, optional): Skip the files named by a later date. Defaults to None.
+
+    Returns:
+        list: Sorted file names
+    """
+    if os.path.isdir(source):
+        files = [file for pattern in ("*.csv", "*.csv.gz", "*.zip") for file in glob.glob(os.path.join(source, pattern))]
+    else:
+        files = glob.glob(source)
+    files = [member for file in sorted(files) for member in archive_members(file)]
+    if not files:
+        raise FileNotFoundError(f"No drive stats files found for {source}")
+    dates = [__file_date(file) for file in files]
+    # By date across the archives, e.g. data_Q1_2020.zip after data_Q4_2019.zip
+    order = sorted(range(len(files)), key=lambda i: (dates[i] is None, dates[i] or pd.Timestamp.min, files[i]))
+    files, dates = [files[i] for i in order], [dates[i] for i in order]
+    if start_date is not None or end_date is not None:
+        start = pd.Timestamp.min if start_date is None else pd.Timestamp(start_date)
+        end = pd.Timestamp.max if end_date is None else pd.Timestamp(end_date)
+        # Files without a date in the name are kept and filtered by rows
+        files = [file for file, date in zip(files, dates) if date is None or start <= date <= end]
+    return files
+
+def __iter_daily_file(file, model, columns, chunksize, start_date, end_date):
+    wanted = None if columns is None else set(columns) | {"model"}
+    # Daily files differ in the available smart columns over the years
+    usecols = None if wanted is None else (lambda col: col in wanted)
+    for chunk in iter_raw_csv(file, chunksize=chunksize, usecols=usecols):
+        chunk = chunk[chunk.model == model]
+        if columns is not None:
+            # Columns missing in older files are filled with NaN
+            chunk = chunk.reindex(columns=columns)
+        if "date" in chunk.columns:
+            chunk["date"] = pd.to_datetime(chunk["date"])
+            chunk = filter_dates(chunk, start_date, end_date)
+        yield chunk
+
+def iter_daily_drive_stats(source:str, model="ST4000DM000", columns=None, chunksize=100_000,
+                           start_date=None, end_date=None, n_jobs=1):
+    """Stream the daily Backblaze drive stats files in chunks. Every chunk is filtered to
+    the drive model and projected to the columns while reading, so memory scales with
+    the chunk size. Zipped files are decompressed while parsing.
+
+    Args:
+        source (str): Directory containing the daily csv files or archives, zip archive or glob pattern
+        model (str, optional): Drive model to keep. Defaults to "ST4000DM000".
+        columns (list, optional): Columns to keep. Defaults to None (all columns).
+        chunksize (int, optional): Number of rows parsed at once. Defaults to 100_000.
+        start_date (str, optional): First date, earlier files are not opened. Defaults to None.
+        end_date (str, optional): Last date, later files are not opened. Defaults to None.
+        n_jobs (int, optional): Number of threads parsing files in parallel, see map_ordered. The
+            filtered chunks of a file are then yielded together. Defaults to 1.
+
+    Yields:
+        pd.DataFrame: Chunk of drive stats of the drive model
+    """
+    files = daily_files(source, start_date=start_date, end_date=end_date)
+    if n_jobs == 1:
+        for file in files:
+            yield from __iter_daily_file(file, model, columns, chunksize, start_date, end_date)
+        return
+    read_file = lambda file: list(__iter_daily_file(file, model, columns, chunksize, start_date, end_date))
+    for chunks in map_ordered(read_file, files, n_jobs=n_jobs):
+        yield from chunks
+
+@instrument_stage
+def load_daily_drive_stats(source:str, model="ST4000DM000", columns=None, chunksize=100_000,
+                           start_date=None, end_date=None, n_jobs=1) -> pd.DataFrame:
+    """Load the daily Backblaze drive stats files of a drive model
+
+    Args:
+        source (str): Directory containing the daily csv files or archives, zip archive or glob pattern
+        model (str, optional): Drive model to keep. Defaults to "ST4000DM000".
+        columns (list, optional): Columns to keep. Defaults to None (all columns).
+        chunksize (int, optional): Number of rows parsed at once. Defaults to 100_000.
+        start_date (str, optional): First date to load. Defaults to None.
+        end_date (str, optional): Last date to load. Defaults to None.
+        n_jobs (int, optional): Number of threads parsing files in parallel. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: Dataframe containing the drive stats
+    """
+    chunks = iter_daily_drive_stats(source, model=model, columns=columns, chunksize=chunksize,
+                                    start_date=start_date, end_date=end_date, n_jobs=n_jobs)
+    return pd.concat(chunks, ignore_index=True)
+
+def partition_folder(folder:str, model:str) -> str:
+    """Folder of the partition of a drive model
+
+    Args:
+        folder (str): Root folder of the partitioned dataset
+        model (str): Drive model
+
+    Returns:
+        str: Folder of the partition
+    """
+    return f"{folder}/model={model.replace('/', '_')}"
+
+def write_partitions(source:str, folder="data/partitioned", chunksize=100_000) -> dict:
+    """Partition the Backblaze drive stats of all drive models by model. Every drive model
+    gets a folder of parquet files holding date, serial number, failure and the raw SMART
+    columns, and the models with their folders are listed in partitions.json.
+
+    Args:
+        source (str): Directory of daily csv files or archives, glob pattern or csv file with a model column
+        folder (str, optional): Root folder of the partitioned dataset. Defaults to "data/partitioned".
+        chunksize (int, optional): Number of rows parsed at once. Defaults to 100_000.
+
+    Returns:
+        dict: Number of rows per drive model
+    """
+    keep = lambda col: col in ("date", "serial_number", "model", "failure") or (col.startswith("smart_") and col.endswith("_raw"))
+    rows = {}
+    for number, file in enumerate(daily_files(source)):
+        for part, chunk in enumerate(iter_raw_csv(file, chunksize=chunksize, usecols=keep, parse_dates=["date"])):
+            for model, df in chunk.groupby("model"):
+                partition = partition_folder(folder, model)
+                os.makedirs(partition, exist_ok=True)
+                df.to_parquet(f"{partition}/part-{number:05d}-{part:05d}.parquet", index=False)
+                rows[model] = rows.get(model, 0) + len(df)
+    manifest = {model: {"folder": partition_folder(folder, model), "rows": n_rows} for model, n_rows in rows.items()}
+    with open(f"{folder}/partitions.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    return rows
+
+def partition_models(folder="data/partitioned") -> dict:
+    """Drive models of a partitioned dataset
+
+    Args:
+        folder (str, optional): Root folder of the partitioned dataset. Defaults to "data/partitioned".
+
+    Returns:
+        dict: Folder and number of rows per drive model
+    """
+    with open(f"{folder}/partitions.json") as f:
+        return json.load(f)
+
+@instrument_stage
+def load_partition(folder:str, model:str, columns=None, start_date=None, end_date=None) -> pd.DataFrame:
+    """Load the drive stats of a drive model from the partitioned dataset
+
+    Args:
+        folder (str): Root folder of the partitioned dataset
+        model (str): Drive model
+        columns (list, optional): Columns to load, columns missing in older files are NaN. Defaults to None (all columns).
+        start_date (str, optional): First date to load, filtered while reading. Defaults to None.
+        end_date (str, optional): Last date to load. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Dataframe containing the drive stats
+    """
+    import pyarrow.parquet as pq
+    files = sorted(glob.glob(f"{partition_folder(folder, model)}/*.parquet"))
+    if not files:
+        raise FileNotFoundError(f"No partition of the drive model {model} in {folder}")
+    chunks = []
+    for file in files:
+        available = pq.read_schema(file).names
+        chunk = pd.read_parquet(file, columns=None if columns is None else [col for col in columns if col in available],
+                                filters=date_filters(start_date, end_date))
+        chunks.append(chunk if columns is None else chunk.reindex(columns=columns))
+    return pd.concat(chunks, ignore_index=True)
+
+def select_columns(df, min_coverage=0.99) -> list:
+    """Per drive model selection of the raw SMART columns in place of cols_of_importance.
+    A column is selected if it is reported in most of the rows and not constant.
+
+    Args:
+        df (pd.DataFrame): Drive stats of one drive model
+        min_coverage (float, optional): Minimal fraction of rows with a value. Defaults to 0.99.
+
+    Returns:
+        list: Selected SMART columns, serial_number and date
+    """
+    smart = [col for col in df.columns if col.startswith("smart_") and col.endswith("_raw")]
+    # Numeric order of the SMART attributes like in cols_of_importance
+    smart = sorted(smart, key=lambda col: int(col.split("_")[1]))
+    selected = [col for col in smart if df[col].notna().mean() >= min_coverage and df[col].nunique() > 1]
+    return selected + ["serial_number", "date"]
+
+def smallest_int_dtype(values):
+    """Smallest signed integer dtype holding all the values, None if there is none"""
+    if len(values) == 0:
+        return np.int8
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return dtype
+    return None
+
+@instrument_stage
+def compact_dtypes(df_in) -> pd.DataFrame:
+    """Store the drive stats in compact dtypes. SMART counters are downcast to the smallest
+    integer type if they are complete and integral, otherwise to float32 if that is exact.
+    Text columns become categoricals and the date becomes an int32 day number.
+
+    Args:
+        df_in (pd.DataFrame): Drive stats data
+
+    Returns:
+        pd.DataFrame: Drive stats data with compact dtypes
+    """
+    columns = {}
+    for col in df_in.columns:
+        series = df_in[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            # Days since 1970-01-01
+            series = series.values.astype("datetime64[D]").astype(np.int32)
+        elif col == "date":
+            # Day numbers of a compacted frame stay int32, so that repeated passes keep the dtype
+            series = series.astype(np.int32)
+        elif series.dtype == object:
+            series = series.astype("category")
+        elif series.dtype.kind == "f":
+            values = series.values
+            int_dtype = smallest_int_dtype(values) if not np.isnan(values).any() else None
+            if int_dtype is not None and np.array_equal(np.floor(values), values):
+                series = series.astype(int_dtype)
+            elif np.array_equal(values.astype(np.float32), values, equal_nan=True):
+                series = series.astype(np.float32)
+        elif series.dtype.kind in "iu":
+            series = series.astype(smallest_int_dtype(series.values))
+        columns[col] = series
+    return pd.DataFrame(columns, index=df_in.index)
+
+def log_memory(df, stage:str) -> float:
+    """Log the memory used by the dataframe after a stage
+
+    Args:
+        df (pd.DataFrame): Dataframe
+        stage (str): Name of the stage
+
+    Returns:
+        float: Memory usage in MB
+    """
+    memory = df.memory_usage(deep=True).sum() / 1e6
+    logger.info(f"{stage}: {len(df)} rows, {memory:.1f} MB")
+    return memory
+
+@instrument_stage
+def calculate_target(df_in, days=30, copy=True):
     """Merge failure date, calculate the countdown and the target.
 
     Args:
         df (pd.DataFrame): Drive stats file
         days (int): Time interval for the target calculation
+        copy (bool, optional): Protect the input dataframe, otherwise its rows are dropped in place. Defaults to True.
 
     Returns:
         pd.Series: Target variable
     """
-    df = df_in.copy() # Copy to protect input dataframe
+    # The input is only read before the filtering, which copies the rows
+    df = df_in
     # Series of all the hdds the day they failed to obtain failure date
     failure = df[df.failure == 1]
     # Only use first failure per hdd
@@ -34,14 +624,82 @@ def calculate_target(df_in, days=30):
     failure = failure.drop_duplicates(keep='first', subset="serial_number")
     # Assign failure dates
     date_failure = df['serial_number'].map(failure.set_index('serial_number')['date'])
-    # Days to fail as int
-    countdown = (date_failure - df.date).dt.days
+    if pd.api.types.is_categorical_dtype(date_failure):
+        # One-to-one mappings of categorical serial numbers stay categorical
+        date_failure = date_failure.astype(date_failure.cat.categories.dtype)
+    # Days to fail as int (dates in compact mode are day numbers already)
+    countdown = date_failure - df.date
+    if pd.api.types.is_timedelta64_dtype(countdown):
+        countdown = countdown.dt.days
     # Remove observations with negative countdown (repaired drives) and with more than 800 days left
-    df = df[(countdown >= 0) & (countdown < 800)]
-    target = (countdown <= days)[(countdown >= 0) & (countdown < 800)]
+    keep = (countdown >= 0) & (countdown < 800)
+    target = (countdown <= days)[keep]
+    if copy:
+        df = df[keep]
+    else:
+        df.drop(df.index[~keep.values], inplace=True)
     return df, target
 
-def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
+def drive_hash(serial_numbers, salt="42") -> np.ndarray:
+    """Stable 64 bit hash of the serial numbers. It only depends on the serial number and the
+    salt, so the same drive gets the same hash in every run and in every chunk of the data.
+
+    Args:
+        serial_numbers (pd.Series): Serial numbers
+        salt (str, optional): Salt to obtain different assignments. Defaults to "42".
+
+    Returns:
+        np.ndarray: Hash per row as uint64
+    """
+    # Hash every drive once and broadcast to the rows
+    codes, drives = pd.factorize(serial_numbers)
+    hashes = np.array([int.from_bytes(hashlib.blake2b(f"{salt}:{drive}".encode(), digest_size=8).digest(), "little")
+                       for drive in drives], dtype=np.uint64)
+    return hashes[codes]
+
+def is_test_drive(serial_numbers, test_size=0.3, salt="42") -> np.ndarray:
+    """Assign the drives to the test set by their hash
+
+    Args:
+        serial_numbers (pd.Series): Serial numbers
+        test_size (float, optional): Expected fraction of test drives. Defaults to 0.3.
+        salt (str, optional): Salt to obtain different assignments. Defaults to "42".
+
+    Returns:
+        np.ndarray: Boolean mask of the rows belonging to test drives
+    """
+    return drive_hash(serial_numbers, salt=salt) < np.uint64(test_size * 2**64)
+
+def drive_folds(serial_numbers, n_folds=5, salt="42") -> np.ndarray:
+    """Assign the drives to cross-validation folds by their hash
+
+    Args:
+        serial_numbers (pd.Series): Serial numbers
+        n_folds (int, optional): Number of folds. Defaults to 5.
+        salt (str, optional): Salt to obtain different assignments. Defaults to "42".
+
+    Returns:
+        np.ndarray: Fold per row, usable as test_fold of sklearn's PredefinedSplit
+    """
+    return (drive_hash(serial_numbers, salt=salt) % np.uint64(n_folds)).astype(np.int64)
+
+def drive_kfold(X, n_folds=5, salt="42"):
+    """Cross-validation splits with all the rows of a drive in the same fold
+
+    Args:
+        X (pd.DataFrame): Drive stats data
+        n_folds (int, optional): Number of folds. Defaults to 5.
+        salt (str, optional): Salt to obtain different assignments. Defaults to "42".
+
+    Yields:
+        tuple: Positions of the train rows and of the test rows
+    """
+    folds = drive_folds(X.serial_number, n_folds=n_folds, salt=salt)
+    for fold in range(n_folds):
+        yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+@instrument_stage
+def train_test_splitter(X, y, test_size=0.3, random_state=42, method="sample") -> pd.DataFrame:
     """Train test split of the drive data
 
     Args:
@@ -49,10 +707,18 @@ def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
         y (_type_): Target variable
         test_size (float, optional): Size of the test subset. Defaults to 0.3.
         random_state (int, optional): Random state for comparability over different runs. Defaults to 42.
+        method (str, optional): "sample" draws the test drives from the unique serial numbers, "hash"
+            assigns every drive by a stable hash of its serial number salted with random_state, which
+            also holds for chunked data and later runs. Defaults to "sample".
 
     Returns:
         pd.DataFrame: _description_
     """
+    if method == "hash":
+        test = is_test_drive(X.serial_number, test_size=test_size, salt=str(random_state))
+        return X[~test], X[test], y[~test], y[test]
+    if method != "sample":
+        raise ValueError(f"Unknown split method {method}")
     # All the unique serial numbers
     drives = pd.Series(X.serial_number.unique(), name="HDD")
     # Random sampling of drives
@@ -66,115 +732,375 @@ def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
     y_test = y[X.serial_number.isin(drives_test)]
     return X_train, X_test, y_train, y_test
 
-def drop_cols(df_in) -> pd.DataFrame:
+@instrument_stage
+def drop_cols(df_in, copy=True, columns=None) -> pd.DataFrame:
     """Drop columns with missing values. A threshold allows to tune which columns are dropped.
 
     Args:
         df (_type_): Drive stats data
+        copy (bool, optional): Protect the input dataframe, otherwise the columns are dropped in place. Defaults to True.
+        columns (list, optional): Columns selected for the drive model, see select_columns. Defaults to cols_of_importance.
 
     Returns:
         pd.DataFrame: Drive stats file with dropped columns
     """
-    cols_of_importance = ['smart_4_raw', 'smart_5_raw', 'smart_7_raw', 'smart_9_raw',
-                            'smart_12_raw', 'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
-                            'smart_188_raw', 'smart_189_raw', 'smart_190_raw', 'smart_192_raw',
-                            'smart_193_raw', 'smart_194_raw', 'smart_197_raw', 'smart_198_raw',
-                            'smart_199_raw', 'smart_240_raw', 'smart_241_raw', 'smart_242_raw',
-                            'serial_number', 'date']
-    df = df_in.loc[:,cols_of_importance]
+    columns = cols_of_importance if columns is None else columns
+    if not copy:
+        df_in.drop(columns=df_in.columns.difference(columns), inplace=True)
+        # Restore the column order by moving single columns
+        for position, col in enumerate(columns):
+            if df_in.columns[position] != col:
+                df_in.insert(position, col, df_in.pop(col))
+        return df_in
+    df = df_in.loc[:,columns]
     return df
 
-def drop_missing_rows(df_in) -> pd.DataFrame:
+@instrument_stage
+def drop_missing_rows(df_in, copy=True) -> pd.DataFrame:
     """Drop rows with missing values (measurement errors, see EDA)
 
     Args:
         df (_type_): Drive stats
+        copy (bool, optional): Protect the input dataframe, otherwise the rows are dropped in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Drive stats data with removed rows
     """
-    df = df_in.copy().dropna(how="any")
+    if not copy:
+        df_in.dropna(how="any", inplace=True)
+        return df_in
+    df = df_in.dropna(how="any")
     return df
 
-def drop_duplicate_rows(df_in) -> pd.DataFrame:
+@instrument_stage
+def drop_duplicate_rows(df_in, copy=True) -> pd.DataFrame:
     """Drop doublicated rows (measurement errors, see EDA)
 
     Args:
         df (_type_): Drive stats data
+        copy (bool, optional): Protect the input dataframe, otherwise the rows are dropped in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Drive stats data with removed rows
     """
-    df = df_in.copy().drop_duplicates(keep='first', subset=["serial_number", "date"])
+    if not copy:
+        df_in.drop_duplicates(keep='first', subset=["serial_number", "date"], inplace=True)
+        return df_in
+    df = df_in.drop_duplicates(keep='first', subset=["serial_number", "date"])
     return df
 
-def remove_smart_7_outliers(df_in, threshold=5e10) -> pd.DataFrame:
-    """_summary_
+@instrument_stage
+def remove_smart_7_outliers(df_in, threshold=5e10, copy=True):
+    """Remove all drives which show a smart_7_raw value above the threshold
 
     Args:
-        df_in (_type_): _description_
-        threshold (_type_, optional): _description_. Defaults to 5e10.
+        df_in (pd.DataFrame): Drive stats data
+        threshold (float, optional): Upper limit for smart_7_raw. Defaults to 5e10.
+        copy (bool, optional): Protect the input dataframe, otherwise the rows are dropped in place. Defaults to True.
 
     Returns:
-        pd.DataFrame: _description_
+        pd.DataFrame: Drive stats data without the outlier drives
+        list: Serial numbers of the dropped drives
+        int: Number of dropped drives
     """
-    df = df_in.copy()
-    sn_to_drop = df[df.smart_7_raw > threshold].serial_number.unique()
-    for sn in sn_to_drop:
-        df = df.drop(df[df.serial_number == sn].index)
-    return df
+    sn_to_drop = df_in.serial_number[df_in.smart_7_raw > threshold].unique().tolist()
+    # One mask over the whole frame, the filtering is the only copy
+    drop = df_in.serial_number.isin(sn_to_drop).values
+    if not copy:
+        df_in.drop(df_in.index[drop], inplace=True)
+        return df_in, sn_to_drop, len(sn_to_drop)
+    df = df_in[~drop]
+    return df, sn_to_drop, len(sn_to_drop)
 
-def load_preprocess_data(filename="ST4000DM000_history_total", path=os.getcwd(), days=30) -> pd.DataFrame:
+@instrument_stage
+def load_preprocess_data(filename="ST4000DM000_history_total", path=os.getcwd(), days=30,
+                         source=None, model="ST4000DM000", chunksize=100_000,
+                         compact=False, report_memory=False, copy=True,
+                         columns=None, partitions=None, n_jobs=1) -> pd.DataFrame:
     """Load and preprocess drive stats data
 
     Args:
         filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history".
         path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        source (str, optional): Directory, zip archive or glob of daily csv files streamed instead of the csv file. Defaults to None.
+        model (str, optional): Drive model kept from the daily files or the partitioned dataset. Defaults to "ST4000DM000".
+        chunksize (int, optional): Number of rows parsed at once from the daily files. Defaults to 100_000.
+        compact (bool, optional): Use compact dtypes, see compact_dtypes. Defaults to False.
+        report_memory (bool, optional): Log the memory usage after every stage. Defaults to False.
+        copy (bool, optional): Let every stage copy its input, otherwise the stages filter the loaded
+            dataframe in place, which keeps the memory close to a single copy. Defaults to True.
+        columns (list, optional): Columns selected for the drive model, see select_columns. Defaults to cols_of_importance.
+        partitions (str, optional): Folder of a partitioned dataset read instead of the csv file, see
+            write_partitions. Defaults to None.
+        n_jobs (int, optional): Number of threads parsing the daily files or the members of a zipped
+            csv file. Defaults to 1.
 
     Returns:
         pd.DataFrame: Dataframe with the drive stats data
     """
     #print("Preprocessing")
     #print("Loading file", filename)
-    X = load_drive_stats(filename, path)
+    columns = cols_of_importance if columns is None else columns
+    if partitions is not None:
+        X = load_partition(partitions, model, columns=columns + ["failure"])
+    elif source is None:
+        X = load_drive_stats(filename, path, columns=columns + ["failure"], n_jobs=n_jobs)
+    else:
+        X = load_daily_drive_stats(source, model=model, columns=columns + ["failure"], chunksize=chunksize, n_jobs=n_jobs)
+    if report_memory:
+        log_memory(X, "Loading")
+    return preprocess_drive_stats(X, compact=compact, report_memory=report_memory, copy=copy, columns=columns)
+
+def preprocess_drive_stats(X, compact=False, report_memory=False, copy=True, columns=None):
+    """Preprocess loaded drive stats data: target calculation, outlier removal and the
+    column and row filters. Every step works per drive, so that the drive stats can also be
+    preprocessed in shards of drives.
+
+    Args:
+        X (pd.DataFrame): Drive stats data with the columns cols_of_importance and failure
+        compact (bool, optional): Use compact dtypes, see compact_dtypes. Defaults to False.
+        report_memory (bool, optional): Log the memory usage after every stage. Defaults to False.
+        copy (bool, optional): Let every stage copy its input, otherwise the stages filter the
+            dataframe in place. Defaults to True.
+        columns (list, optional): Columns selected for the drive model, see select_columns. Defaults to cols_of_importance.
+
+    Returns:
+        pd.DataFrame: Dataframe with the drive stats data
+        pd.Series: Target variable
+    """
+    if compact:
+        X = compact_dtypes(X)
+        if report_memory:
+            log_memory(X, "Compacting dtypes")
     #print("Calculate the target variable")
-    X, y = calculate_target(X)
+    X, y = calculate_target(X, copy=copy)
+    if report_memory:
+        log_memory(X, "Calculating the target")
     #print("Removing smart_7_raw outliers")
-    X = remove_smart_7_outliers(X)
+    if "smart_7_raw" in X.columns:
+        X, _, n_dropped = remove_smart_7_outliers(X, copy=copy)
+        logger.info(f"Removed {n_dropped} drives with smart_7_raw outliers")
+        if report_memory:
+            log_memory(X, "Removing smart_7_raw outliers")
     #print("Dropping unused columns")
-    X = drop_cols(X)
+    X = drop_cols(X, copy=copy, columns=columns)
     #print("Dropping missings")
-    X = drop_missing_rows(X)
+    X = drop_missing_rows(X, copy=copy)
+    if report_memory:
+        log_memory(X, "Dropping missings")
     #print("Dropping dublicated observations")
-    X = drop_duplicate_rows(X)
+    X = drop_duplicate_rows(X, copy=copy)
+    if compact:
+        # Counters without missings fit into integers now
+        X = compact_dtypes(X)
+    if report_memory:
+        log_memory(X, "Dropping duplicates")
     y = y[X.index]
     #print("Preprocessing finished")
     #print("-----------------------------------------------------")
     return X, y
 
-def load_preprocess_testdata(filename="ST4000DM000_history_total", path=os.getcwd(), days=30) -> pd.DataFrame:
-    """Load and preprocess drive stats data
+@instrument_stage
+def load_preprocess_testdata(filename="ST4000DM000_history_total", path=os.getcwd(), days=30,
+                             source=None, model="ST4000DM000", chunksize=100_000,
+                             compact=False, report_memory=False, copy=True,
+                             columns=None, partitions=None, start_date=None, end_date=None,
+                             warmup_tolerance=1e-3, n_jobs=1) -> pd.DataFrame:
+    """Load and preprocess drive stats data. With a start date, the read window is widened by
+    the warm-up of the EMA (see ema_lookback), the warm-up rows are trimmed after the feature
+    engineering by hdd_preprocessor(start_date=...).
 
     Args:
         filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history".
         path (_type_, optional): Path of the repo. Defaults to os.getcwd().
+        source (str, optional): Directory, zip archive or glob of daily csv files streamed instead of the csv file. Defaults to None.
+        model (str, optional): Drive model kept from the daily files or the partitioned dataset. Defaults to "ST4000DM000".
+        chunksize (int, optional): Number of rows parsed at once from the daily files. Defaults to 100_000.
+        compact (bool, optional): Use compact dtypes, see compact_dtypes. Defaults to False.
+        report_memory (bool, optional): Log the memory usage after every stage. Defaults to False.
+        copy (bool, optional): Let every stage copy its input, otherwise the stages filter the loaded
+            dataframe in place, which keeps the memory close to a single copy. Defaults to True.
+        columns (list, optional): Columns selected for the drive model, see select_columns. Defaults to cols_of_importance.
+        partitions (str, optional): Folder of a partitioned dataset read instead of the csv file, see
+            write_partitions. Defaults to None.
+        start_date (str, optional): First date of the scored rows. Defaults to None (full history).
+        end_date (str, optional): Last date of the scored rows. Defaults to None.
+        warmup_tolerance (float, optional): Weight of the history before the read window in the EMA.
+            Defaults to 1e-3.
+        n_jobs (int, optional): Number of threads parsing the daily files or the members of a zipped
+            csv file. Defaults to 1.
 
     Returns:
         pd.DataFrame: Dataframe with the drive stats data
     """
     #print("Preprocessing")
     #print("Loading file", filename)
-    df = load_drive_stats(filename, path)
+    columns = cols_of_importance if columns is None else columns
+    read_start = None if start_date is None else warmup_start(start_date, days=days, tolerance=warmup_tolerance)
+    if partitions is not None:
+        df = load_partition(partitions, model, columns=columns, start_date=read_start, end_date=end_date)
+    elif source is None:
+        df = load_drive_stats(filename, path, columns=columns, start_date=read_start, end_date=end_date, n_jobs=n_jobs)
+    else:
+        df = load_daily_drive_stats(source, model=model, columns=columns, chunksize=chunksize,
+                                    start_date=read_start, end_date=end_date, n_jobs=n_jobs)
+    if report_memory:
+        log_memory(df, "Loading")
+    if compact:
+        df = compact_dtypes(df)
+        if report_memory:
+            log_memory(df, "Compacting dtypes")
     #print("Dropping unused columns")
-    df = drop_cols(df)
+    df = drop_cols(df, copy=copy, columns=columns)
     #print("Dropping missings")
-    df = drop_missing_rows(df)
+    df = drop_missing_rows(df, copy=copy)
+    if report_memory:
+        log_memory(df, "Dropping missings")
     #print("Dropping dublicated observations")
-    df = drop_duplicate_rows(df)
+    df = drop_duplicate_rows(df, copy=copy)
+    if compact:
+        # Counters without missings fit into integers now
+        df = compact_dtypes(df)
+    if report_memory:
+        log_memory(df, "Dropping duplicates")
     #print("Preprocessing finished")
     #print("-----------------------------------------------------")
     return df
 
+def smart_7_summary(df, carry=None) -> pd.DataFrame:
+    """Per drive unwrap state of smart_7 at the last row of the drive stats: the cumulative
+    offset of the wrap-arounds and the last raw value, like drive_feature_state.state
+
+    Args:
+        df (pd.DataFrame): Drive stats with serial_number, date and smart_7_raw
+        carry (pd.DataFrame, optional): State before the rows of df, which is advanced by them.
+            Defaults to None (df starts with the drive histories).
+
+    Returns:
+        pd.DataFrame: smart_7_offset and smart_7_last, indexed by serial_number
+    """
+    temp_data = pd.DataFrame({  "serial_number": df.serial_number.values,
+                                "date": df.date.values,
+                                "smart_7_raw": df.smart_7_raw.values.astype(np.float64),
+                                })
+    temp_data = temp_data.sort_values(["serial_number", "date"], kind="mergesort")
+    previous = temp_data.groupby("serial_number", sort=False, observed=True).smart_7_raw.shift(1)
+    if carry is not None:
+        # The first row of a drive continues the last row of the carry, like in unwrap_smart_7
+        serials = temp_data.serial_number.values
+        first = np.flatnonzero(np.append(True, serials[1:] != serials[:-1])) if len(serials) else np.array([], dtype=int)
+        previous.iloc[first] = carry.smart_7_last.reindex(serials[first]).values
+    # Same jumps as unwrap_smart_7
+    jumps = (temp_data.smart_7_raw - previous) < -5e8
+    offset = previous.where(jumps, 0).groupby(temp_data.serial_number, sort=False, observed=True).sum()
+    last = temp_data.groupby("serial_number", sort=False, observed=True).smart_7_raw.last()
+    summary = pd.DataFrame({"smart_7_offset": offset, "smart_7_last": last})
+    if carry is not None:
+        summary["smart_7_offset"] += carry.smart_7_offset.reindex(summary.index).fillna(0).values
+        # Drives without rows in df keep their state
+        summary = pd.concat([carry[~carry.index.isin(summary.index)], summary])
+    summary.index.name = "serial_number"
+    return summary
+
+def __smart_7_folder(path, filename, source, model, partitions) -> str:
+    # Snapshots of one data source are stored in a folder named by a hash of the source
+    content = json.dumps({"filename": filename, "source": source, "model": model, "partitions": partitions}, sort_keys=True)
+    return f"{path}/{SMART_7_CACHE}/{hashlib.blake2b(content.encode(), digest_size=8).hexdigest()}"
+
+def __smart_7_signature(before, filename, path, source, model, partitions) -> dict:
+    # Signature of the data a snapshot of the state before a date is built from: the csv file
+    # like for the parquet cache, the daily files before the date or the partition files
+    if partitions is None and source is None:
+        return source_signature(raw_file(filename, path))
+    if partitions is None:
+        files = daily_files(source, end_date=before - pd.Timedelta(days=1))
+    else:
+        files = sorted(glob.glob(f"{partition_folder(partitions, model)}/*.parquet"))
+    # Members of a zip archive are signed by the archive
+    stats = [os.stat(file.split(MEMBER_SEP)[0]) for file in files]
+    return {"files": files, "size": [stat.st_size for stat in stats], "mtime": [stat.st_mtime_ns for stat in stats]}
+
+@instrument_stage
+def load_smart_7_summary(before, filename="ST4000DM000_history_total", path=os.getcwd(), source=None,
+                         model="ST4000DM000", partitions=None, chunksize=100_000, use_cache=True) -> pd.DataFrame:
+    """Unwrap state of smart_7 of the history before a date. Only serial_number, date and
+    smart_7_raw are read, so that scoring a date window does not need the full history.
+    Rows with missing smart_7_raw and duplicates are dropped, rows missing other SMART values
+    are kept.
+
+    The states are saved as snapshots in SMART_7_CACHE, one per date, with the signature of the
+    data they were built from (see source_signature). A state is advanced from the latest earlier
+    snapshot by reading the days in between only, so the full history before the window is read
+    once per data source. Snapshots whose data changed are deleted and rebuilt, use_cache=False
+    rebuilds them as well.
+
+    Args:
+        before (str): First date not included, usually the first date read for the features
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+        path (str, optional): Path of the repo. Defaults to os.getcwd().
+        source (str, optional): Directory or glob of daily csv files read instead of the csv file. Defaults to None.
+        model (str, optional): Drive model kept from the daily files or the partitioned dataset. Defaults to "ST4000DM000".
+        partitions (str, optional): Folder of a partitioned dataset read instead of the csv file. Defaults to None.
+        chunksize (int, optional): Number of rows parsed at once from the daily files. Defaults to 100_000.
+        use_cache (bool, optional): Start from the saved snapshots, otherwise the full history is read.
+            The state is saved in both cases. Defaults to True.
+
+    Returns:
+        pd.DataFrame: smart_7_offset and smart_7_last, indexed by serial_number, see smart_7_summary
+    """
+    before = pd.Timestamp(before).normalize()
+    folder = __smart_7_folder(path, filename, source, model, partitions)
+    carry, start_date = None, None
+    if use_cache and os.path.isdir(folder):
+        dates = sorted(pd.Timestamp(os.path.splitext(name)[0]) for name in os.listdir(folder) if name.endswith(".parquet"))
+        for date in reversed([date for date in dates if date <= before]):
+            snapshot = f"{folder}/{date.date()}"
+            # Round trip through json, so that the signature compares like the stored one
+            signature = json.loads(json.dumps(__smart_7_signature(date, filename, path, source, model, partitions)))
+            try:
+                with open(f"{snapshot}.json") as f:
+                    valid = json.load(f) == signature
+            except (OSError, ValueError):
+                valid = False
+            if not valid:
+                logger.info(f"Deleting the smart_7 state of {date.date()}, the data changed")
+                for file in (f"{snapshot}.parquet", f"{snapshot}.json"):
+                    if os.path.exists(file):
+                        os.remove(file)
+                continue
+            start_date = date
+            carry = pd.read_parquet(f"{snapshot}.parquet")
+            if start_date == before:
+                return carry
+            logger.info(f"Advancing the smart_7 state of {start_date.date()} to {before.date()}")
+            break
+    columns = ["serial_number", "date", "smart_7_raw"]
+    end_date = before - pd.Timedelta(days=1)
+    if partitions is not None:
+        df = load_partition(partitions, model, columns=columns, start_date=start_date, end_date=end_date)
+    elif source is None:
+        df = load_drive_stats(filename, path, columns=columns, start_date=start_date, end_date=end_date)
+    else:
+        df = load_daily_drive_stats(source, model=model, columns=columns, chunksize=chunksize,
+                                    start_date=start_date, end_date=end_date)
+    df = df.dropna(subset=["smart_7_raw"]).drop_duplicates(keep="first", subset=["serial_number", "date"])
+    summary = smart_7_summary(df, carry=carry)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        snapshot = f"{folder}/{before.date()}"
+        # Written to temporary files first, so that readers never see partial snapshots. The
+        # signature is written last, a snapshot without it is rebuilt.
+        tmp = f"{snapshot}.parquet.tmp{os.getpid()}"
+        summary.to_parquet(tmp)
+        os.replace(tmp, f"{snapshot}.parquet")
+        tmp = f"{snapshot}.json.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(__smart_7_signature(before, filename, path, source, model, partitions), f)
+        os.replace(tmp, f"{snapshot}.json")
+    except (OSError, ImportError) as err:
+        logger.warning(f"Could not save the smart_7 state in {folder}: {err}")
+    return summary
+
 def save_preprocessed_data(filename="ST4000DM000_history_total", path=os.getcwd()):
     """Load and preprocess the drive stats data and store the result in a csv file
 
@@ -2,21 +2,7 @@ import pandas as pd
 import numpy as np
 import os
 
-from sklearn.model_selection import train_test_split
-
-def load_drive_stats(filename, path) -> pd.DataFrame:
-    """Load drive stats file
-
-    Args:
-        filename (_type_): Name of the csv file
-        path (_type_): Path of the repo
-
-    Returns:
-        pd.DataFrame: Dataframe containing the drive stats
-    """
-    file = f"{path}/data/raw/{filename}.csv"
-    df = pd.read_csv(file, parse_dates=["date"])
-    return df
+from src.data.hdd_preprocessing import load_drive_stats
 
 def countdown(df) -> pd.DataFrame:
     """Create column with failure date and calculate countdown
@@ -39,31 +25,6 @@ def countdown(df) -> pd.DataFrame:
     df = df[df.countdown >= 0]
     return df
 
-def train_test_splitter(X, y, test_size=0.3, random_state=42) -> pd.DataFrame:
-    """Train test split of the drive data
-
-    Args:
-        X (_type_): Feature variable
-        y (_type_): Target variable
-        test_size (float, optional): Size of the test subset. Defaults to 0.3.
-        random_state (int, optional): Random state for comparability over different runs. Defaults to 42.
-
-    Returns:
-        pd.DataFrame: _description_
-    """
-    # All the unique serial numbers
-    drives = pd.Series(X.serial_number.unique(), name="HDD")
-    # Random sampling of drives
-    drives_test = drives.sample(int(test_size * len(drives)), random_state=random_state)
-    # Remaining drives end up in the train set
-    drives_train = drives.drop(drives_test.index, axis=0)
-    # Create split X and y
-    X_train = X[X.serial_number.isin(drives_train)]
-    X_test = X[X.serial_number.isin(drives_test)]
-    y_train = y[X.serial_number.isin(drives_train)]
-    y_test = y[X.serial_number.isin(drives_test)]
-    return X_train, X_test, y_train, y_test
-
 def drop_missing_cols(df, threshold=0.8) -> pd.DataFrame:
     """Drop columns with missing values. A threshold allows to tune which columns are dropped.
 
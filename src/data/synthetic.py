@@ -0,0 +1,110 @@
+import pandas as pd
+import numpy as np
+import os
+
+# Daily increase of the SMART counters as (mean, spread), counters without entry stay mostly at 0
+counter_rates = {   'smart_4_raw': (0.05, 0.05), 'smart_9_raw': (24, 0), 'smart_12_raw': (0.05, 0.05),
+                    'smart_192_raw': (0.05, 0.05), 'smart_193_raw': (20, 10), 'smart_240_raw': (24, 0),
+                    'smart_241_raw': (3e8, 2e8), 'smart_242_raw': (8e8, 5e8),
+                    }
+# Error counters which grow towards the failure of a drive
+error_cols = ['smart_5_raw', 'smart_183_raw', 'smart_184_raw', 'smart_187_raw', 'smart_188_raw',
+              'smart_189_raw', 'smart_197_raw', 'smart_198_raw', 'smart_199_raw']
+# Temperatures
+temperature_cols = ['smart_190_raw', 'smart_194_raw']
+# smart_7 grows by about 1e7 per day and wraps around at 2^32
+smart_7_wrap = 2 ** 32
+
+def make_drive_stats(n_drives=1000, days=365, failure_rate=0.05, wrap_rate=0.3, duplicate_rate=0.001,
+                     nan_rate=0.001, model="ST4000DM000", start="2019-01-01", seed=42) -> pd.DataFrame:
+    """Create synthetic drive stats histories similar to the Backblaze data
+
+    Args:
+        n_drives (int, optional): Number of drives. Defaults to 1000.
+        days (int, optional): Number of days covered by the data. Defaults to 365.
+        failure_rate (float, optional): Fraction of drives failing at the end of their history. Defaults to 0.05.
+        wrap_rate (float, optional): Fraction of drives whose smart_7 counter wraps around. Defaults to 0.3.
+        duplicate_rate (float, optional): Fraction of duplicated rows. Defaults to 0.001.
+        nan_rate (float, optional): Fraction of rows with a missing SMART value. Defaults to 0.001.
+        model (str, optional): Drive model. Defaults to "ST4000DM000".
+        start (str, optional): First date. Defaults to "2019-01-01".
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Drive stats data
+    """
+    rng = np.random.default_rng(seed)
+    # Observation window of every drive
+    first_day = rng.integers(0, days, n_drives)
+    length = rng.integers(1, days + 1, n_drives)
+    length = np.minimum(length, days - first_day)
+    failing = rng.random(n_drives) < failure_rate
+    drive = np.repeat(np.arange(n_drives), length)
+    # Day within the history of the drive
+    age = np.arange(len(drive)) - np.repeat(np.cumsum(length) - length, length)
+    days_left = np.repeat(length, length) - 1 - age
+    df = pd.DataFrame({ "date": pd.Timestamp(start) + pd.to_timedelta(np.repeat(first_day, length) + age, unit="D"),
+                        "serial_number": pd.Series([f"Z{i:08d}" for i in range(n_drives)]).values[drive],
+                        "model": model,
+                        "capacity_bytes": 4000787030016,
+                        "failure": (np.repeat(failing, length) & (days_left == 0)).astype(int),
+                        })
+    # Drives start with different ages
+    initial_age = rng.integers(0, 1000, n_drives)[drive]
+    for col, (mean, spread) in counter_rates.items():
+        increment = np.maximum(rng.normal(mean, spread, len(drive)), 0)
+        if mean < 1:
+            increment = rng.random(len(drive)) < mean
+        total = pd.Series(increment).groupby(drive).cumsum().values
+        df[col] = np.floor(total + initial_age * mean * rng.uniform(0.5, 1.5, n_drives)[drive])
+    # smart_7 with wrap-arounds
+    wrapping = (rng.random(n_drives) < wrap_rate)[drive]
+    smart_7 = np.floor(pd.Series(rng.normal(1e7, 3e6, len(drive)).clip(0)).groupby(drive).cumsum().values)
+    offset = np.where(wrapping, smart_7_wrap - rng.uniform(0, 1e7 * days, n_drives)[drive], 0)
+    df["smart_7_raw"] = (smart_7 + offset) % smart_7_wrap
+    # Error counters, failing drives degrade during their last weeks
+    degrading = np.repeat(failing, length) & (days_left < 30)
+    for col in error_cols:
+        errors = rng.random(len(drive)) < np.where(degrading, 0.3, 0.001)
+        df[col] = pd.Series(errors * rng.integers(1, 50, len(drive))).groupby(drive).cumsum().values.astype(float)
+    for col in temperature_cols:
+        df[col] = np.round(rng.normal(30, 4, len(drive)))
+    # Measurement errors: missing values and duplicated rows
+    smart_cols = [col for col in df.columns if col.startswith("smart")]
+    missing = np.flatnonzero(rng.random(len(df)) < nan_rate)
+    for row, col in zip(missing, rng.choice(smart_cols, len(missing))):
+        df.at[row, col] = np.nan
+    duplicates = df.sample(frac=duplicate_rate, random_state=seed)
+    df = pd.concat([df, duplicates]).sort_values(["date", "serial_number"], kind="mergesort")
+    return df.reset_index(drop=True)
+
+def save_drive_stats(df, filename="synthetic_history", path=os.getcwd()) -> str:
+    """Store synthetic drive stats where load_drive_stats expects them
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+        filename (str, optional): Name of the csv file. Defaults to "synthetic_history".
+        path (str, optional): Path of the repo. Defaults to os.getcwd().
+
+    Returns:
+        str: Path of the csv file
+    """
+    folder = f"{path}/data/raw"
+    os.makedirs(folder, exist_ok=True)
+    file = f"{folder}/{filename}.csv"
+    df.to_csv(file, index=False)
+    return file
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create synthetic drive stats")
+    parser.add_argument("--drives", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--filename", default="synthetic_history")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    df = make_drive_stats(n_drives=args.drives, days=args.days, failure_rate=args.failure_rate, seed=args.seed)
+    print(save_drive_stats(df, filename=args.filename))
@@ -0,0 +1,172 @@
+import pandas as pd
+import os
+import json
+import time
+import shutil
+import hashlib
+import importlib
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Modules whose code determines the feature matrices
+pipeline_modules = ["src.data.hdd_preprocessing", "src.features.feature_engineering"]
+# Stored frames of a training run
+frame_names = ["X_train", "X_test", "y_train", "y_test", "ids_test"]
+
+def code_version(modules=pipeline_modules) -> str:
+    """Hash of the source code of the preprocessing and feature engineering modules and of
+    the pandas version. It also covers the thresholds which are hard-coded in the pipeline.
+
+    Args:
+        modules (list, optional): Names of the modules. Defaults to pipeline_modules.
+
+    Returns:
+        str: Hash of the source files
+    """
+    blake = hashlib.blake2b(digest_size=16)
+    for module in modules:
+        with open(importlib.import_module(module).__file__, "rb") as f:
+            blake.update(f.read())
+    blake.update(pd.__version__.encode())
+    return blake.hexdigest()
+
+class feature_cache():
+    """Content-addressed cache of the train and test feature matrices. Entries are keyed on
+    the hash of the raw data, the preprocessing parameters and the code version and stored
+    as parquet files. The least recently used entries are evicted when the cache grows
+    beyond the disk budget.
+    """
+    def __init__(self, folder:str, max_bytes:int=10 * 2**30):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def content_hash(self, file:str, block_size:int=1 << 24) -> str:
+        """Hash of the full content of a file. It is remembered together with size and
+        modification time, so that an unchanged file is hashed only once.
+
+        Args:
+            file (str): Path of the file
+            block_size (int, optional): Size of the read blocks in bytes. Defaults to 16 MiB.
+
+        Returns:
+            str: Hash of the file content
+        """
+        index_file = f"{self.folder}/hashes.json"
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        stat = os.stat(file)
+        file = os.path.abspath(file)
+        known = index.get(file)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            return known["hash"]
+        blake = hashlib.blake2b(digest_size=16)
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                blake.update(block)
+        index[file] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": blake.hexdigest()}
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+        return index[file]["hash"]
+
+    def key(self, files, params:dict, version:str) -> str:
+        """Key of the features of raw data files
+
+        Args:
+            files (list): Raw data files
+            params (dict): Preprocessing and splitting parameters
+            version (str): Code version, see code_version
+
+        Returns:
+            str: Key of the cache entry
+        """
+        content = {"data": [self.content_hash(file) for file in files], "params": params, "version": version}
+        return hashlib.blake2b(json.dumps(content, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def get(self, key:str):
+        """Read a cache entry and mark it as recently used
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            tuple: X_train, X_test, y_train, y_test and ids_test, None if the entry does not exist
+        """
+        entry = f"{self.folder}/{key}"
+        try:
+            with open(f"{entry}/meta.json") as f:
+                meta = json.load(f)
+            frames = [pd.read_parquet(f"{entry}/{name}.parquet") for name in frame_names]
+        except (OSError, ValueError, ImportError):
+            return None
+        meta["last_used"] = time.time()
+        with open(f"{entry}/meta.json", "w") as f:
+            json.dump(meta, f)
+        # The targets are stored as single column frames
+        frames[2] = frames[2].iloc[:, 0].rename(meta["y_name"])
+        frames[3] = frames[3].iloc[:, 0].rename(meta["y_name"])
+        return tuple(frames)
+
+    def put(self, key:str, X_train, X_test, y_train, y_test, ids_test, params=None):
+        """Store a cache entry and evict the least recently used entries beyond the disk budget
+
+        Args:
+            key (str): Key of the entry
+            X_train (pd.DataFrame): Train features
+            X_test (pd.DataFrame): Test features
+            y_train (pd.Series): Train target
+            y_test (pd.Series): Test target
+            ids_test (pd.DataFrame): Serial numbers of the test rows
+            params (dict, optional): Parameters stored for information. Defaults to None.
+        """
+        entry = f"{self.folder}/{key}"
+        # Written to a temporary folder first, so that readers never see partial entries
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            X_train.to_parquet(f"{tmp}/X_train.parquet")
+            X_test.to_parquet(f"{tmp}/X_test.parquet")
+            y_train.to_frame(name="y").to_parquet(f"{tmp}/y_train.parquet")
+            y_test.to_frame(name="y").to_parquet(f"{tmp}/y_test.parquet")
+            ids_test.to_parquet(f"{tmp}/ids_test.parquet")
+            meta = {"params": params, "y_name": y_train.name, "created": time.time(), "last_used": time.time()}
+            with open(f"{tmp}/meta.json", "w") as f:
+                json.dump(meta, f)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.replace(tmp, entry)
+        except (OSError, ImportError) as err:
+            logger.warning(f"Could not write the feature cache {entry}: {err}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self) -> pd.DataFrame:
+        """List the cache entries
+
+        Returns:
+            pd.DataFrame: Size in bytes and last use of the entries, indexed by key
+        """
+        rows = []
+        for key in os.listdir(self.folder):
+            entry = f"{self.folder}/{key}"
+            try:
+                with open(f"{entry}/meta.json") as f:
+                    last_used = json.load(f)["last_used"]
+            except (OSError, ValueError, KeyError):
+                continue
+            size = sum(os.path.getsize(f"{entry}/{file}") for file in os.listdir(entry))
+            rows.append({"key": key, "bytes": size, "last_used": last_used})
+        return pd.DataFrame(rows, columns=["key", "bytes", "last_used"]).set_index("key")
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into the disk budget"""
+        entries = self.entries().sort_values("last_used", ascending=False)
+        over_budget = entries.bytes.cumsum() > self.max_bytes
+        for key in entries.index[over_budget]:
+            logger.info(f"Evicting the feature cache entry {key}")
+            shutil.rmtree(f"{self.folder}/{key}", ignore_errors=True)
@@ -2,70 +2,173 @@ import pandas as pd
 import numpy as np
 
 import os
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.base import BaseEstimator, TransformerMixin
 
-def unwrap_smart_7(df_in) -> pd.DataFrame:
+from src.instrumentation import instrument_stage, init_worker
+from src.data.hdd_preprocessing import date_value
+
+# Columns compared with their EMA for the smart_999 feature
+trigger_cols = ['smart_4_raw', 'smart_5_raw',
+                'smart_12_raw', 'smart_183_raw', 'smart_184_raw',
+                'smart_187_raw', 'smart_188_raw', 'smart_189_raw',
+                'smart_193_raw', 'smart_192_raw', 'smart_197_raw',
+                'smart_198_raw', 'smart_199_raw',
+                ]
+# Temperatures, not used as features
+temperature_cols = ['smart_190_raw', 'smart_194_raw']
+
+def feature_cols(cols=None) -> list:
+    """Columns kept by drop_feats
+
+    Args:
+        cols (list, optional): Raw columns selected for a drive model. Defaults to None (the
+            columns of the ST4000DM000 model).
+
+    Returns:
+        list: Feature columns and serial_number
+    """
+    if cols is None:
+        return ['smart_4_raw', 'smart_5_raw', 'smart_7_mod', 'smart_9_raw',
+                'smart_12_raw', 'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
+                'smart_188_raw', 'smart_189_raw', 'smart_192_raw', 'smart_193_raw',
+                'smart_197_raw', 'smart_198_raw', 'smart_199_raw', 'smart_240_raw',
+                'smart_241_raw', 'smart_242_raw', 'smart_999', 'serial_number']
+    smart = [col for col in cols if col.startswith("smart_") and col not in temperature_cols]
+    return ["smart_7_mod" if col == "smart_7_raw" else col for col in smart] + ['smart_999', 'serial_number']
+
+@instrument_stage
+def unwrap_smart_7(df_in, copy=True, carry=None) -> pd.DataFrame:
     """Fix the jumps in the smart_7 feature
 
     Args:
         df_in (_type_): Drive stats data
+        copy (bool, optional): Protect the input dataframe, otherwise the feature is added in place. Defaults to True.
+        carry (pd.DataFrame, optional): Unwrap state of the drives before the first row, smart_7_offset
+            and smart_7_last indexed by serial_number (see smart_7_summary or drive_feature_state).
+            Defaults to None (the data starts with the drive history).
 
     Returns:
         pd.DataFrame: Data with updated feature
     """
     # Copy input dataframe
-    df = df_in.copy()
-    df["smart_7_mod"] = df.smart_7_raw
-    # Extract individual drives
-    drives = df.serial_number.unique()
-    for drive in drives: # Loop over drives
-        # Create dataframe with time series for drive, reindex and store the old index
-        temp_data = df[df.serial_number == drive].sort_values("date", ascending=True).reset_index()
-        # Calculate the derivate and use spikes to determine jumps
-        jumps = temp_data.smart_7_raw.diff() < -5e8
-        # Extract index of jumps
-        jump_idx = jumps[jumps].index
-        # Backup the smart_7_raw series
-        smart_7_temp = temp_data.smart_7_raw.copy()
-        for idx in jump_idx: # Loop over the jumps
-            # Add the value before the jump to all the following  values
-            temp_data.loc[idx:, "smart_7_raw"] += smart_7_temp[idx-1]
-        # Restore the original index
-        temp_data = temp_data.set_index("index")
-        # Update the dataframe with the unwrapped data for this drive
-        df.loc[temp_data.index,"smart_7_mod"] = temp_data.smart_7_raw
+    df = df_in.copy() if copy else df_in
+    # Time series of all drives in one frame, sorted by drive and date (positional index)
+    temp_data = pd.DataFrame({  "serial_number": df.serial_number.values,
+                                "date": df.date.values,
+                                "smart_7_raw": df.smart_7_raw.values,
+                                })
+    temp_data = temp_data.sort_values(["serial_number", "date"], kind="mergesort")
+    # Value before each observation of the same drive
+    previous = temp_data.groupby("serial_number", sort=False, dropna=False, observed=True).smart_7_raw.shift(1)
+    if carry is not None:
+        # The first row of a drive continues the last row before the data
+        serials = temp_data.serial_number.values
+        first = np.flatnonzero(np.append(True, serials[1:] != serials[:-1]))
+        state = carry.reindex(serials[first])
+        previous.iloc[first] = state.smart_7_last.values
+    # Calculate the derivate and use spikes to determine jumps
+    jumps = (temp_data.smart_7_raw - previous) < -5e8
+    # Every jump adds the value before the jump to all the following values of the drive
+    offset = previous.where(jumps, 0).groupby(temp_data.serial_number, sort=False, dropna=False, observed=True).cumsum()
+    if carry is not None:
+        lengths = np.diff(np.append(first, len(serials)))
+        offset = offset + np.repeat(state.smart_7_offset.fillna(0).values, lengths)
+    smart_7_mod = (temp_data.smart_7_raw + offset).sort_index()
+    # Restore the original order, narrow integer dtypes are widened to hold the offsets
+    dtype = np.promote_types(df.smart_7_raw.dtype, np.int64) if df.smart_7_raw.dtype.kind in "iu" else df.smart_7_raw.dtype
+    df["smart_7_mod"] = smart_7_mod.values.astype(dtype, copy=False)
     return df
 
-def calculate_ema(df_in, days=30) -> pd.DataFrame:
+def segmented_ewm(values, starts, days=30, out=None) -> np.ndarray:
+    """EWM mean over contiguous segments of rows, equal to pandas' ewm(span=days, adjust=True,
+    min_periods=0).mean() per segment. The recursion runs over the position within the segments
+    and is vectorized over all segments and columns.
+
+    Args:
+        values (np.ndarray): 2-D float array, rows sorted by segment
+        starts (np.ndarray): First row of every segment
+        days (int, optional): Span of the EWM. Defaults to 30.
+        out (np.ndarray, optional): Float64 array the EWM is written to, which may be values
+            itself, every row is read before it is written. Defaults to None (a new array).
+
+    Returns:
+        np.ndarray: EWM mean with the shape of values
+    """
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float64)
+    if len(starts) == 0:
+        return out
+    decay = 1 - 2 / (days + 1)
+    lengths = np.diff(np.append(starts, len(values)))
+    # Longest segments first, so that the active segments at every position are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    starts, lengths = starts[order], lengths[order]
+    n_active = np.searchsorted(-lengths, -np.arange(lengths[0]), side="left")
+    # Running average and weight of the previous observations per segment and column
+    average = values[starts].astype(np.float64)
+    weight = np.ones(average.shape)
+    complete = not np.isnan(values).any()
+    out[starts] = average
+    for position in range(1, lengths[0]):
+        m = n_active[position]
+        rows = starts[:m] + position
+        current = values[rows]
+        avg, wt = average[:m], weight[:m]
+        if complete:
+            # Fast path without missing values
+            wt *= decay
+            avg[:] = np.where(avg != current, (wt * avg + current) / (wt + 1), avg)
+            wt += 1
+            out[rows] = avg
+            continue
+        observed = ~np.isnan(current)
+        started = ~np.isnan(avg)
+        # Weights decay with every position, also for missing observations
+        wt[started] *= decay
+        update = started & observed & (avg != current)
+        avg[update] = (wt[update] * avg[update] + current[update]) / (wt[update] + 1)
+        wt[started & observed] += 1
+        first = ~started & observed
+        avg[first] = current[first]
+        out[rows] = avg
+    return out
+
+@instrument_stage
+def calculate_ema(df_in, days=30, cols=trigger_cols, copy=True) -> pd.DataFrame:
     """Calculate the EMA of the features over time.
 
     Args:
         df_in (_type_): Dataframe with some features
+        days (int, optional): Span of the EMA. Defaults to 30.
+        cols (list, optional): Columns to calculate the EMA for. Defaults to the columns used by smart_999.
+        copy (bool, optional): Protect the input dataframe, otherwise the EMA columns are added in place. Defaults to True.
 
     Returns:
         pd.DataFrame: Dataframe with EMA columns
     """
-    # Dataframe with only the relevant data
-    df = df_in.copy()
-    # Sort the values
-    df.sort_values(["serial_number", "date"], inplace=True)
-    # Drop date to suppress warnings
-    df = df.drop("date", axis=1)
-    # Create grouped object
-    grouped_data = df.groupby("serial_number")
-    # Calculate EMA
-    int_series = grouped_data.ewm(span=days, min_periods=0).mean()
-    # Extract index from multiindex
-    index_series = int_series.index.get_level_values(1)
-    # Fix indices
-    int_series = pd.DataFrame(int_series.values, index=index_series, columns=int_series.columns)
-    # Merge dataframes
-    df_out = pd.merge(  left=df_in, right=int_series, how="left", 
-                        left_index=True, right_index=True, suffixes=("", "_ema"),
-                        )
-    return df_out
-
-def calculate_smart_999(df_in, trigger=0.05) -> pd.DataFrame:
+    df = df_in.copy() if copy else df_in
+    # Row positions sorted by drive and date
+    keys = pd.DataFrame({"serial_number": df.serial_number.values, "date": df.date.values})
+    order = keys.sort_values(["serial_number", "date"]).index.values
+    serials = keys.serial_number.values[order]
+    # Every drive is a contiguous segment of the sorted rows
+    starts = np.flatnonzero(np.append(True, serials[1:] != serials[:-1]))
+    # One sorted float block of the columns, gathered column by column, the EMA overwrites it
+    ema = np.empty((len(df), len(cols)))
+    for i, col in enumerate(cols):
+        ema[:, i] = df[col].values[order]
+    segmented_ewm(ema, starts, days=days, out=ema)
+    # Write the EMA columns in the original row order
+    for i, col in enumerate(cols):
+        values = np.empty(len(df))
+        values[order] = ema[:, i]
+        df[col + "_ema"] = values
+    return df
+
+@instrument_stage
+def calculate_smart_999(df_in, trigger=0.05, copy=True, trigger_bits=False, cols=trigger_cols) -> pd.DataFrame:
     """Calculate the smart_999 feature. If the raw differs from the EMA by more 
     than trigger_percent, the corresponding feature initiates a trigger. Smart_999
     sums over all those triggers.
@@ -73,96 +176,232 @@ def calculate_smart_999(df_in, trigger=0.05) -> pd.DataFrame:
     Args:
         df_in (_type_): Drive stats data
         trigger (float, optional): Percentage for triggering. Defaults to 0.05.
+        copy (bool, optional): Protect the input dataframe, otherwise the features are added in place. Defaults to True.
+        trigger_bits (bool, optional): Also add the individual triggers as bitmask column smart_999_bits,
+            bit i belongs to cols[i]. Defaults to False.
+        cols (list, optional): Columns compared with their EMA. Defaults to trigger_cols.
 
     Returns:
         pd.DataFrame: Dataframe with features
     """
-    df = df_in.copy()
-    # Select columns to use for the calculation
-    cols_to_use =   ['smart_4_raw', 'smart_5_raw',
-                    'smart_12_raw', 'smart_183_raw', 'smart_184_raw',
-                    'smart_187_raw', 'smart_188_raw', 'smart_189_raw',
-                    'smart_193_raw', 'smart_192_raw', 'smart_197_raw',
-                    'smart_198_raw', 'smart_199_raw',
-                    ]
-    # Loop over columns
-    for col in cols_to_use:
-        # Check if raw differs from ema by more than 5%
-        df[col+"_trigger"] = 1/2 * np.abs((df[col] + df[col+"_ema"]) / df[col+"_ema"]) > (1+trigger)
+    df = df_in.copy() if copy else df_in
+    # Raw and EMA blocks of all the trigger columns
+    raw = df[cols].to_numpy(dtype=np.float64)
+    ema = df[[col + "_ema" for col in cols]].to_numpy(dtype=np.float64)
+    # Check if raw differs from ema by more than 5%
+    with np.errstate(divide="ignore", invalid="ignore"):
+        triggers = 1/2 * np.abs((raw + ema) / ema) > (1+trigger)
     #print("Shape after calculation of EMA triggers:", df.shape)
     # Sum over all triggers
-    sum_cols = []
-    for col in df.columns:
-        if 'trigger' in col:
-            sum_cols.append(col)
-    df["smart_999"] = df[sum_cols].sum(axis=1)
+    df["smart_999"] = triggers.sum(axis=1, dtype=np.int64)
+    if trigger_bits:
+        df["smart_999_bits"] = (triggers.astype(np.int32) << np.arange(len(cols), dtype=np.int32)).sum(axis=1, dtype=np.int32)
     #print("Shape after calculation of sum of EMA triggers:", df.shape)
     return df
 
-def drop_feats(df_in) -> pd.DataFrame:
+@instrument_stage
+def drop_feats(df_in, copy=True, cols=None) -> pd.DataFrame:
     """Drop columns with missing values. A threshold allows to tune which columns are dropped.
 
     Args:
         df (_type_): Drive stats data
+        copy (bool, optional): Protect the input dataframe, otherwise the columns are dropped in place. Defaults to True.
+        cols (list, optional): Raw columns selected for the drive model, see feature_cols. Defaults to None.
 
     Returns:
         pd.DataFrame: Drive stats file with dropped columns
     """
-    cols_of_importance = ['smart_4_raw', 'smart_5_raw', 'smart_7_mod', 'smart_9_raw',
-                            'smart_12_raw', 'smart_183_raw', 'smart_184_raw', 'smart_187_raw',
-                            'smart_188_raw', 'smart_189_raw', 'smart_192_raw', 'smart_193_raw',
-                            'smart_197_raw', 'smart_198_raw', 'smart_199_raw', 'smart_240_raw',
-                            'smart_241_raw', 'smart_242_raw', 'smart_999', 'serial_number']
+    cols_of_importance = feature_cols(cols)
+    if not copy:
+        df_in.drop(columns=df_in.columns.difference(cols_of_importance), inplace=True)
+        # Restore the column order by moving single columns
+        for position, col in enumerate(cols_of_importance):
+            if df_in.columns[position] != col:
+                df_in.insert(position, col, df_in.pop(col))
+        return df_in
     df = df_in.loc[:,cols_of_importance]
     return df
 
 class log_transformer(BaseEstimator, TransformerMixin):
-    def __init__(self, offset=1):
+    def __init__(self, offset=1, copy=True, dtype=None):
         self.offset = offset
+        self.copy = copy
+        self.dtype = dtype
 
     def fit(self, X, y = None):
         return self
 
     def transform(self, X, y = None):
-        return np.log(X+self.offset)
+        # Models pickled before the copy and dtype parameters existed transform a copy
+        dtype = getattr(self, "dtype", None)
+        if dtype is not None:
+            # The scaling of a model fitted on float32 features runs in float32 for every input
+            X = X.astype(dtype, copy=False)
+        if getattr(self, "copy", True):
+            return np.log(X+self.offset)
+        # In place on the float buffer of X, e.g. a memory-mapped feature matrix
+        values = np.asarray(X)
+        if values.dtype.kind != "f" or not values.flags.writeable:
+            return np.log(X+self.offset)
+        np.add(values, self.offset, out=values)
+        np.log(values, out=values)
+        if isinstance(X, pd.DataFrame):
+            return pd.DataFrame(values, index=X.index, columns=X.columns, copy=False)
+        return values
 
-def create_features(df_in, days=30, trigger=0.05) -> pd.DataFrame:
+@instrument_stage
+def create_features(df_in, days=30, trigger=0.05, copy=True, cols=None, smart_7_carry=None) -> pd.DataFrame:
     """Create the fancy features.
 
     Args:
         df_in (_type_): Dataframe as output by preprocessing script
         interval (int, optional): Time interval for EMA. Defaults to 30.
         trigger_percentage (float, optional): Normalized distance between raw and EMA. Defaults to 0.05.
+        copy (bool, optional): Protect the input dataframe, otherwise all the stages work in place
+            on it and it ends up holding the features. Defaults to True.
+        cols (list, optional): Raw columns selected for the drive model, the triggers use the
+            available trigger_cols. Defaults to None (the columns of the ST4000DM000 model).
+        smart_7_carry (pd.DataFrame, optional): Unwrap state of the drives before the data, see
+            unwrap_smart_7. Defaults to None.
 
     Returns:
         pd.DataFrame: Dataset with new features
     """
-    df = df_in.copy()
+    # The stages work in place on the single copy
+    df = df_in.copy() if copy else df_in
+    triggers = trigger_cols if cols is None else [col for col in trigger_cols if col in cols]
     #print("Feature engineering")
     #print("Unwrapping smart_7_raw")
-    df = unwrap_smart_7(df)
+    if cols is None or "smart_7_raw" in cols:
+        df = unwrap_smart_7(df, copy=False, carry=smart_7_carry)
     #print("Calculating of EMAs")
-    df = calculate_ema(df, days=days)
+    df = calculate_ema(df, days=days, cols=triggers, copy=False)
     #print("Calculating smart_999 feature")
-    df = calculate_smart_999(df, trigger=trigger)
+    df = calculate_smart_999(df, trigger=trigger, copy=False, cols=triggers)
     #print("Dropping unused columns")
-    df = drop_feats(df)
+    df = drop_feats(df, copy=False, cols=cols)
     #print("Feature engineering finished")
     #print("Size if the dataframe:", df.shape)
     #print("-----------------------------------------------------")
     return df
 
+def __features_of_shard(spec) -> None:
+    # Worker of create_features_parallel: attach the shared buffers, compute the features of
+    # the rows start:stop and write them into the shared output buffer
+    buffers = {name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in spec["shm"].items()}
+    try:
+        start, stop = spec["start"], spec["stop"]
+        n_rows = spec["n_rows"]
+        values = np.ndarray((n_rows, len(spec["cols"])), dtype=np.float64, buffer=buffers["values"].buf)
+        keys = np.ndarray((2, n_rows), dtype=np.int64, buffer=buffers["keys"].buf)
+        out = np.ndarray((n_rows, len(spec["out_cols"])), dtype=np.float64, buffer=buffers["out"].buf)
+        df = pd.DataFrame(values[start:stop], columns=spec["cols"]).astype(spec["dtypes"])
+        df["serial_number"] = keys[0, start:stop]
+        dates = keys[1, start:stop]
+        df["date"] = dates.view(spec["date_dtype"]) if spec["date_dtype"].kind == "M" else dates.astype(spec["date_dtype"])
+        features = create_features(df, days=spec["days"], trigger=spec["trigger"], cols=spec["feature_cols"],
+                                   smart_7_carry=spec["smart_7_carry"])
+        out[start:stop] = features[spec["out_cols"]].values
+    finally:
+        for buffer in buffers.values():
+            buffer.close()
+
+@instrument_stage
+def create_features_parallel(df_in, days=30, trigger=0.05, n_jobs=-1, shards_per_job=4, cols=None,
+                             smart_7_carry=None) -> pd.DataFrame:
+    """Create the features in worker processes. The drives are partitioned by a hash of the
+    serial number, and the data is exchanged through shared memory buffers instead of pickled
+    dataframes. The result equals create_features in the original row order.
+
+    Args:
+        df_in (_type_): Dataframe as output by preprocessing script
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Normalized distance between raw and EMA. Defaults to 0.05.
+        n_jobs (int, optional): Number of worker processes, -1 for all cores. Defaults to -1.
+        shards_per_job (int, optional): Number of shards per worker for load balancing. Defaults to 4.
+        cols (list, optional): Raw columns selected for the drive model, see create_features. Defaults to None.
+        smart_7_carry (pd.DataFrame, optional): Unwrap state of the drives before the data, see
+            unwrap_smart_7. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Dataset with new features
+    """
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    # Raw input columns of the features of create_features(cols=cols), they include the trigger columns
+    input_cols = ["smart_7_raw" if col == "smart_7_mod" else col for col in feature_cols(cols)
+                  if col not in ("smart_999", "serial_number")]
+    # Output columns and dtypes from the first drive
+    sample = create_features(df_in.loc[df_in.serial_number == df_in.serial_number.iloc[0], input_cols + ["serial_number", "date"]],
+                             days=days, trigger=trigger, cols=cols, smart_7_carry=smart_7_carry)
+    out_cols = [col for col in sample.columns if col != "serial_number"]
+    # Partition the drives by hash and make every shard a contiguous block of rows
+    n_shards = n_jobs * shards_per_job
+    shard = pd.util.hash_pandas_object(df_in.serial_number, index=False).values % n_shards
+    order = np.argsort(shard, kind="stable")
+    bounds = np.searchsorted(shard[order], np.arange(n_shards + 1))
+    n_rows = len(df_in)
+    sizes = {"values": max(n_rows * len(input_cols) * 8, 1), "keys": max(n_rows * 2 * 8, 1),
+             "out": max(n_rows * len(out_cols) * 8, 1)}
+    buffers = {name: shared_memory.SharedMemory(create=True, size=size) for name, size in sizes.items()}
+    try:
+        values = np.ndarray((n_rows, len(input_cols)), dtype=np.float64, buffer=buffers["values"].buf)
+        keys = np.ndarray((2, n_rows), dtype=np.int64, buffer=buffers["keys"].buf)
+        out = np.ndarray((n_rows, len(out_cols)), dtype=np.float64, buffer=buffers["out"].buf)
+        values[:] = df_in[input_cols].values[order]
+        codes, serials = pd.factorize(df_in.serial_number)
+        keys[0] = codes[order]
+        if smart_7_carry is not None:
+            # The workers see the serial numbers as codes
+            smart_7_carry = smart_7_carry.reindex(serials).set_axis(np.arange(len(serials)), axis=0)
+        keys[1] = df_in.date.values[order].view(np.int64) if df_in.date.dtype.kind == "M" else df_in.date.values[order]
+        base = {"shm": {name: buffer.name for name, buffer in buffers.items()}, "n_rows": n_rows,
+                "cols": input_cols, "dtypes": df_in[input_cols].dtypes.to_dict(), "date_dtype": df_in.date.dtype,
+                "out_cols": out_cols, "days": days, "trigger": trigger, "feature_cols": cols}
+        # Every shard gets the carry of its own drives only
+        specs = [dict(base, start=start, stop=stop,
+                      smart_7_carry=None if smart_7_carry is None else smart_7_carry.iloc[np.unique(keys[0, start:stop])])
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker) as pool:
+            list(pool.map(__features_of_shard, specs))
+        # Restore the original row order
+        result = np.empty_like(out)
+        result[order] = out
+    finally:
+        for buffer in buffers.values():
+            buffer.close()
+            buffer.unlink()
+    df = pd.DataFrame(result, index=df_in.index, columns=out_cols).astype(sample[out_cols].dtypes.to_dict())
+    df["serial_number"] = df_in.serial_number.values
+    return df[sample.columns]
+
 class hdd_preprocessor(BaseEstimator, TransformerMixin):
-    def __init__(self, days=30, trigger=0.05):
+    def __init__(self, days=30, trigger=0.05, n_jobs=1, copy=True, cols=None, start_date=None, smart_7_carry=None):
         self.days = days
         self.trigger = trigger
+        self.n_jobs = n_jobs
+        self.copy = copy
+        self.cols = cols
+        self.start_date = start_date
+        self.smart_7_carry = smart_7_carry
 
     def fit(self, X, y = None):
         return self
 
     def transform(self, X, y = None):
-        X = create_features(X, days=self.days, trigger=self.trigger)
-        X = X.drop("serial_number", axis=1)
+        # Rows before the start date only warm up the EMAs
+        keep = None if self.start_date is None else (X.date >= date_value(self.start_date, X.date)).values
+        if self.n_jobs == 1:
+            X = create_features(X, days=self.days, trigger=self.trigger, copy=self.copy, cols=self.cols,
+                                smart_7_carry=self.smart_7_carry)
+        else:
+            X = create_features_parallel(X, days=self.days, trigger=self.trigger, n_jobs=self.n_jobs, cols=self.cols,
+                                         smart_7_carry=self.smart_7_carry)
+        if not self.copy:
+            X.drop("serial_number", axis=1, inplace=True)
+        else:
+            X = X.drop("serial_number", axis=1)
+        if keep is not None:
+            X = X[keep]
         return X
 
 if __name__ == "__main__":
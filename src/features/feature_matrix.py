@@ -0,0 +1,98 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Rows converted at once while writing a feature matrix
+CHUNKSIZE = 1_000_000
+
+def write_feature_matrix(features, file:str, y=None, ids=None, chunksize=CHUNKSIZE) -> str:
+    """Store the features as a C-contiguous float32 matrix in a .npy file, which can be
+    memory-mapped without copying. The column names are stored in a json sidecar, the row
+    labels, the ids (e.g. serial_number and date) and the target in a parquet sidecar.
+
+    Args:
+        features (pd.DataFrame): Features as output by hdd_preprocessor
+        file (str): Path of the .npy file
+        y (pd.Series, optional): Target, aligned with the features. Defaults to None.
+        ids (pd.DataFrame, optional): Id columns of the rows, aligned with the features by index. Defaults to None.
+        chunksize (int, optional): Number of rows converted at once. Defaults to CHUNKSIZE.
+
+    Returns:
+        str: Path of the .npy file
+    """
+    os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+    # Written to temporary files first, so that readers never map a partial matrix
+    tmp = f"{file}.tmp{os.getpid()}.npy"
+    X = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=features.shape)
+    for start in range(0, len(features), chunksize):
+        X[start:start + chunksize] = features.iloc[start:start + chunksize].values
+    X.flush()
+    del X
+    rows = pd.DataFrame({"row": features.index.values})
+    if ids is not None:
+        ids = ids.loc[features.index]
+        for col in ids.columns:
+            rows[col] = ids[col].values
+    target = None
+    if y is not None:
+        target = y.name or "target"
+        rows[target] = y.loc[features.index].values
+    rows.to_parquet(f"{tmp}.ids.parquet", index=False)
+    with open(f"{tmp}.json", "w") as f:
+        json.dump({"columns": list(features.columns), "target": target, "shape": list(features.shape)}, f)
+    os.replace(f"{tmp}.ids.parquet", f"{file}.ids.parquet")
+    os.replace(f"{tmp}.json", f"{file}.json")
+    os.replace(tmp, file)
+    return file
+
+class feature_matrix():
+    """Memory-mapped feature matrix written by write_feature_matrix. Opening it reads only the
+    sidecars, the rows are paged in on access, and processes mapping the same file share the
+    pages of the page cache.
+
+    The mode is passed to np.load: "r" maps the file read-only, "c" maps it copy-on-write, so
+    that scaling steps can work in place without changing the file, and "r+" writes to it.
+    """
+    def __init__(self, file:str, mode="r"):
+        self.file = file
+        self.X = np.load(file, mmap_mode=mode)
+        with open(f"{file}.json") as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.target = meta["target"]
+        self.__ids = None
+
+    def __len__(self):
+        return len(self.X)
+
+    @property
+    def ids(self) -> pd.DataFrame:
+        """Row labels, ids and target of the rows, read on first use"""
+        if self.__ids is None:
+            self.__ids = pd.read_parquet(f"{self.file}.ids.parquet")
+        return self.__ids
+
+    @property
+    def y(self) -> pd.Series:
+        """Target of the rows"""
+        if self.target is None:
+            raise ValueError(f"The feature matrix {self.file} has no target")
+        return self.ids[self.target]
+
+    def frame(self, start=None, stop=None) -> pd.DataFrame:
+        """Dataframe on the mapped rows without copying them
+
+        Args:
+            start (int, optional): First row. Defaults to None (first row of the matrix).
+            stop (int, optional): Row after the last row. Defaults to None (end of the matrix).
+
+        Returns:
+            pd.DataFrame: Features with a positional index
+        """
+        X = self.X[start:stop]
+        offset = 0 if start is None else start
+        return pd.DataFrame(X, columns=self.columns, index=pd.RangeIndex(offset, offset + len(X)), copy=False)
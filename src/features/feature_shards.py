@@ -0,0 +1,143 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import glob
+import shutil
+from logging import getLogger
+
+from src.data.hdd_preprocessing import cols_of_importance, drive_hash, is_test_drive, iter_daily_drive_stats, preprocess_drive_stats, raw_file, archive_members, iter_raw_csv
+from src.features.feature_engineering import hdd_preprocessor
+
+logger = getLogger(__name__)
+
+# Name of the target column in the feature shards
+target_col = "target"
+
+def __iter_raw_chunks(filename, path, source, model, columns, chunksize):
+    if source is not None:
+        yield from iter_daily_drive_stats(source, model=model, columns=columns, chunksize=chunksize)
+        return
+    for file in archive_members(raw_file(filename, path)):
+        yield from iter_raw_csv(file, chunksize=chunksize, usecols=columns, parse_dates=["date"])
+
+def write_feature_shards(folder:str, filename="ST4000DM000_history_total", path=os.getcwd(), source=None,
+                         model="ST4000DM000", n_shards=32, chunksize=1_000_000, days=30, trigger=0.05,
+                         test_size=0.3, random_state=42) -> dict:
+    """Preprocess the drive stats and engineer the features shard by shard without holding
+    the full data in memory. The raw rows are first routed by drive into shards on disk, then
+    every shard is preprocessed, split by drive like train_test_splitter(method="hash") and
+    stored as train and test feature shards. The peak memory depends on the chunk and the
+    shard size only.
+
+    Args:
+        folder (str): Folder of the shards
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+        path (str, optional): Path of the repo. Defaults to os.getcwd().
+        source (str, optional): Directory or glob of daily csv files read instead of the csv file. Defaults to None.
+        model (str, optional): Drive model kept from the daily files. Defaults to "ST4000DM000".
+        n_shards (int, optional): Number of shards. Defaults to 32.
+        chunksize (int, optional): Number of raw rows parsed at once. Defaults to 1_000_000.
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Normalized distance between raw and EMA. Defaults to 0.05.
+        test_size (float, optional): Fraction of test drives. Defaults to 0.3.
+        random_state (int, optional): Seed of the split by drive. Defaults to 42.
+
+    Returns:
+        dict: Manifest with the parameters, the feature columns and the rows of every shard
+    """
+    raw_folder = f"{folder}/raw"
+    shutil.rmtree(folder, ignore_errors=True)
+    columns = cols_of_importance + ["failure"]
+    logger.info("Routing the raw rows into shards of drives")
+    for part, chunk in enumerate(__iter_raw_chunks(filename, path, source, model, columns, chunksize)):
+        shard = drive_hash(chunk.serial_number, salt="shards") % n_shards
+        for number, rows in chunk.groupby(shard):
+            os.makedirs(f"{raw_folder}/{number:03d}", exist_ok=True)
+            rows.to_parquet(f"{raw_folder}/{number:03d}/{part:05d}.parquet")
+    manifest = {"days": days, "trigger": trigger, "test_size": test_size, "random_state": random_state,
+                "columns": None, "shards": {"train": {}, "test": {}}}
+    preprocessor = hdd_preprocessor(days=days, trigger=trigger)
+    for part in ("train", "test"):
+        os.makedirs(f"{folder}/{part}", exist_ok=True)
+    for shard_folder in sorted(glob.glob(f"{raw_folder}/*")):
+        number = os.path.basename(shard_folder)
+        logger.info(f"Feature engineering of shard {number}")
+        X = pd.concat([pd.read_parquet(file) for file in sorted(glob.glob(f"{shard_folder}/*.parquet"))],
+                      ignore_index=True)
+        X, y = preprocess_drive_stats(X, copy=False)
+        test = is_test_drive(X.serial_number, test_size=test_size, salt=str(random_state))
+        for part, rows in (("train", ~test), ("test", test)):
+            if not rows.any():
+                continue
+            features = preprocessor.transform(X[rows])
+            features = features.assign(**{target_col: y[features.index].values})
+            features.to_parquet(f"{folder}/{part}/{number}.parquet")
+            manifest["shards"][part][number] = len(features)
+            manifest["columns"] = [col for col in features.columns if col != target_col]
+        shutil.rmtree(shard_folder)
+    shutil.rmtree(raw_folder, ignore_errors=True)
+    with open(f"{folder}/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def read_manifest(folder:str) -> dict:
+    """Read the manifest of the feature shards
+
+    Args:
+        folder (str): Folder of the shards
+
+    Returns:
+        dict: Manifest written by write_feature_shards
+    """
+    with open(f"{folder}/manifest.json") as f:
+        return json.load(f)
+
+def feature_shard_files(folder:str, part="train") -> list:
+    """List the feature shards
+
+    Args:
+        folder (str): Folder of the shards
+        part (str, optional): "train" or "test". Defaults to "train".
+
+    Returns:
+        list: Paths of the shard files
+    """
+    return sorted(glob.glob(f"{folder}/{part}/*.parquet"))
+
+def read_feature_shard(file:str):
+    """Read a feature shard
+
+    Args:
+        file (str): Path of the shard file
+
+    Returns:
+        pd.DataFrame: Features
+        pd.Series: Target variable
+    """
+    X = pd.read_parquet(file)
+    y = X.pop(target_col)
+    return X, y
+
+def iter_batches(files, batch_size=40_000, seed=42):
+    """Endless stream of shuffled mini-batches from the feature shards, one shard in memory
+    at a time. The order of the shards and of the rows within a shard is reshuffled on every
+    pass.
+
+    Args:
+        files (list): Paths of the shard files
+        batch_size (int, optional): Number of rows per batch. Defaults to 40_000.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Yields:
+        pd.DataFrame: Features of the batch
+        pd.Series: Target of the batch
+    """
+    rng = np.random.default_rng(seed)
+    while True:
+        for file in rng.permutation(files):
+            X, y = read_feature_shard(file)
+            order = rng.permutation(len(X))
+            for start in range(0, len(X), batch_size):
+                rows = order[start:start + batch_size]
+                yield X.iloc[rows], y.iloc[rows]
@@ -0,0 +1,110 @@
+import pandas as pd
+import numpy as np
+
+from src.features.feature_engineering import unwrap_smart_7, calculate_ema, calculate_smart_999, drop_feats, trigger_cols
+
+# Columns whose EMA enters the smart_999 feature
+ema_cols = trigger_cols
+
+class drive_feature_state():
+    """Per drive state of the feature engineering. It holds the last EMA values, the
+    normalization of the (adjusted) EMA, the cumulative smart_7 unwrap offset and the last
+    smart_7_raw value of every drive, so that new observations only need the state and
+    not the full history of the drives.
+    """
+    def __init__(self, days=30, trigger=0.05):
+        self.days = days
+        self.trigger = trigger
+        self.alpha = 2 / (days + 1)
+        self.state = pd.DataFrame(columns=["weight", "smart_7_offset", "smart_7_last"] + ema_cols,
+                                  index=pd.Index([], name="serial_number"), dtype=float)
+
+    def fit(self, df_in) -> pd.DataFrame:
+        """Initialize the state from the full history of the drives
+
+        Args:
+            df_in (pd.DataFrame): Preprocessed drive stats data
+
+        Returns:
+            pd.DataFrame: Features of the history as created by create_features
+        """
+        df = unwrap_smart_7(df_in)
+        df = calculate_ema(df, days=self.days)
+        # Last observation of every drive
+        last = df.sort_values(["serial_number", "date"], kind="mergesort").groupby("serial_number", observed=True).tail(1)
+        last = last.set_index("serial_number")
+        n_obs = df.groupby("serial_number", observed=True).size()
+        state = pd.DataFrame(index=last.index)
+        # Sum of the EMA weights (1-alpha)^i over all observations
+        state["weight"] = (1 - (1 - self.alpha) ** n_obs[last.index]) / self.alpha
+        state["smart_7_offset"] = last.smart_7_mod - last.smart_7_raw
+        state["smart_7_last"] = last.smart_7_raw
+        for col in ema_cols:
+            state[col] = last[col + "_ema"]
+        self.state = state.astype(float)
+        df = calculate_smart_999(df, trigger=self.trigger)
+        return drop_feats(df)
+
+    def update(self, new_df) -> pd.DataFrame:
+        """Advance the state by new observations, usually one day of data
+
+        Args:
+            new_df (pd.DataFrame): New preprocessed drive stats data, one row per drive and day
+
+        Returns:
+            pd.DataFrame: Features of the new observations as created by create_features
+        """
+        features = []
+        for _, day in new_df.sort_values("date", kind="mergesort").groupby("date", sort=True):
+            features.append(self.__update_day(day))
+        return pd.concat(features).loc[new_df.index]
+
+    def __update_day(self, day) -> pd.DataFrame:
+        # State of the drives, new drives start empty
+        state = self.state.reindex(day.serial_number)
+        state["weight"] = state.weight.fillna(0)
+        state["smart_7_offset"] = state.smart_7_offset.fillna(0)
+        df = day.copy()
+        # Unwrap smart_7
+        raw = df.smart_7_raw.values
+        last = state.smart_7_last.values
+        jumps = (raw - last) < -5e8
+        offset = state.smart_7_offset.values + np.where(jumps, last, 0)
+        df["smart_7_mod"] = raw + offset
+        # Adjusted EMA update
+        decay = (1 - self.alpha) * state.weight.values
+        weight = 1 + decay
+        for col in ema_cols:
+            ema = state[col].fillna(0).values
+            df[col + "_ema"] = (df[col].values + decay * ema) / weight
+        # Store the new state
+        new_state = pd.DataFrame({"weight": weight, "smart_7_offset": offset, "smart_7_last": raw},
+                                 index=pd.Index(day.serial_number.values, name="serial_number"))
+        for col in ema_cols:
+            new_state[col] = df[col + "_ema"].values
+        self.state = pd.concat([self.state.drop(new_state.index, errors="ignore"), new_state])
+        df = calculate_smart_999(df, trigger=self.trigger)
+        return drop_feats(df)
+
+    def save(self, file:str):
+        """Store the state in a pickle file
+
+        Args:
+            file (str): Path of the file
+        """
+        pd.to_pickle({"days": self.days, "trigger": self.trigger, "state": self.state}, file)
+
+    @classmethod
+    def load(cls, file:str):
+        """Load the state from a pickle file
+
+        Args:
+            file (str): Path of the file
+
+        Returns:
+            drive_feature_state: Feature state
+        """
+        stored = pd.read_pickle(file)
+        feature_state = cls(days=stored["days"], trigger=stored["trigger"])
+        feature_state.state = stored["state"]
+        return feature_state
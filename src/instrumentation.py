@@ -0,0 +1,158 @@
+from logging import getLogger
+import pandas as pd
+import sys
+import json
+import time
+import atexit
+import resource
+import functools
+from collections import defaultdict
+
+logger = getLogger(__name__)
+
+# Active sinks, instrumentation is disabled if empty
+__sinks = []
+# Nesting depth of the running stages
+__depth = 0
+# Whether disable_instrumentation is registered to run at the exit
+__atexit = False
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+def log_sink(record:dict):
+    """Write the stage record as json to the log"""
+    logger.info(json.dumps(record))
+
+class json_sink():
+    """Append the stage records as json lines to a file"""
+    def __init__(self, file:str):
+        self.file = file
+
+    def __call__(self, record:dict):
+        with open(self.file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+class mlflow_sink():
+    """Log the stage records as MLflow metrics to the active run, or to a new run of the
+    experiment in src.models.config. Repeated stages are logged as steps.
+    """
+    def __init__(self, tracking_uri:str, experiment_name:str):
+        import mlflow
+        self.mlflow = mlflow
+        mlflow.set_tracking_uri(tracking_uri)
+        mlflow.set_experiment(experiment_name)
+        self.steps = defaultdict(int)
+        # Run started by the sink, which it ends on close
+        self.run = None
+
+    def __call__(self, record:dict):
+        if self.mlflow.active_run() is None:
+            self.run = self.mlflow.start_run()
+        stage = record["stage"]
+        metrics = {f"{stage}/{key}": value for key, value in record.items()
+                   if key not in ("stage", "depth") and value is not None}
+        self.mlflow.log_metrics(metrics, step=self.steps[stage])
+        self.steps[stage] += 1
+
+    def close(self):
+        """End the run started by the sink, runs of the caller stay active"""
+        active = self.mlflow.active_run()
+        if self.run is not None and active is not None and active.info.run_id == self.run.info.run_id:
+            self.mlflow.end_run()
+        self.run = None
+
+def enable_instrumentation(json_file=None, log=True, mlflow=None, sinks=()):
+    """Enable the recording of the pipeline stages
+
+    Args:
+        json_file (str, optional): File for the stage records as json lines. Defaults to None.
+        log (bool, optional): Write the stage records to the log. Defaults to True.
+        mlflow (bool, optional): Log the stage records to MLflow, by default if the tracking uri in
+            src.models.config is set. Defaults to None.
+        sinks (tuple, optional): Additional callables receiving the stage records. Defaults to ().
+    """
+    global __sinks, __atexit
+    disable_instrumentation()
+    new_sinks = list(sinks)
+    if log:
+        new_sinks.append(log_sink)
+    if json_file is not None:
+        new_sinks.append(json_sink(json_file))
+    if mlflow is not False:
+        from src.models import config
+        if config.TRACKING_URI:
+            new_sinks.append(mlflow_sink(config.TRACKING_URI, config.EXPERIMENT_NAME))
+        elif mlflow:
+            logger.warning("MLflow instrumentation requested, but no tracking uri is set")
+    __sinks = new_sinks
+    if not __atexit:
+        # Ends the MLflow run of the sink with the process
+        atexit.register(disable_instrumentation)
+        __atexit = True
+
+def disable_instrumentation(close=True):
+    """Disable the recording of the pipeline stages
+
+    Args:
+        close (bool, optional): Close the sinks, e.g. end the MLflow run of mlflow_sink. Defaults to True.
+    """
+    global __sinks
+    sinks, __sinks = __sinks, []
+    if close:
+        for sink in sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+
+def init_worker():
+    """Initializer of worker processes. Forked workers inherit the sinks of the parent, they are
+    dropped without closing, so that the workers do not write to or end the run of the parent.
+    """
+    disable_instrumentation(close=False)
+
+def __shape(obj):
+    # Shape of a dataframe, or of the first dataframe of a tuple
+    if isinstance(obj, tuple):
+        obj = next((item for item in obj if isinstance(item, (pd.DataFrame, pd.Series))), None)
+    if isinstance(obj, pd.DataFrame):
+        return obj.shape
+    if isinstance(obj, pd.Series):
+        return len(obj), 1
+    return None, None
+
+def instrument_stage(func):
+    """Decorator recording wall time, CPU time, peak RSS increase, rows and columns in and out
+    of a pipeline stage. Without enabled instrumentation the stage is called directly.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not __sinks:
+            return func(*args, **kwargs)
+        global __depth
+        rows_in, cols_in = __shape(args[0] if args else next(iter(kwargs.values()), None))
+        rss_start = peak_rss_mb()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        __depth += 1
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            __depth -= 1
+        rows_out, cols_out = __shape(result)
+        record = {  "stage": func.__name__,
+                    "depth": __depth,
+                    "wall_s": time.perf_counter() - wall_start,
+                    "cpu_s": time.process_time() - cpu_start,
+                    "peak_rss_delta_mb": peak_rss_mb() - rss_start,
+                    "rows_in": rows_in,
+                    "rows_out": rows_out,
+                    "cols_in": cols_in,
+                    "cols_out": cols_out,
+                    }
+        for sink in __sinks:
+            sink(record)
+        return result
+    return wrapper
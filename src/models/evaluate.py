@@ -0,0 +1,227 @@
+from logging import getLogger
+import pandas as pd
+import numpy as np
+import json
+import time
+
+logger = getLogger(__name__)
+
+# Model folder holding the decision threshold
+MODEL_PATH = "models/deployment"
+# Number of probability bins of the histograms, the AUCs are exact up to ties within a bin
+N_BINS = 10_000
+
+def load_threshold(model_path=MODEL_PATH) -> float:
+    """Load the decision threshold stored next to the model
+
+    Args:
+        model_path (str, optional): Path of the model folder. Defaults to MODEL_PATH.
+
+    Returns:
+        float: Threshold on the failure probability
+    """
+    with open(f"{model_path}/threshold") as f:
+        return float(f.read().strip())
+
+class streaming_metrics():
+    """Metrics of a binary classifier consumed chunk by chunk. ROC-AUC and PR-AUC are calculated
+    from fixed-bin histograms of the probabilities of the positive and the negative rows, so the
+    memory does not grow with the number of rows. Recall and precision at the threshold are
+    counted exactly. With serial numbers, the metrics per drive hold three flags per drive: a
+    failing drive is caught if it is alarmed on a row within the failure window (a positive row),
+    a healthy drive is falsely alarmed if it is alarmed on any row.
+
+    Args:
+        threshold (float, optional): Decision threshold on the failure probability. Defaults to 0.5.
+        n_bins (int, optional): Number of histogram bins. Defaults to N_BINS.
+    """
+    def __init__(self, threshold=0.5, n_bins=N_BINS):
+        self.threshold = threshold
+        self.n_bins = n_bins
+        self.positives = np.zeros(n_bins, dtype=np.int64)
+        self.negatives = np.zeros(n_bins, dtype=np.int64)
+        self.counts = {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+        self.drives = None
+
+    def update(self, y_true, y_proba, serial_numbers=None):
+        """Add a chunk of predictions
+
+        Args:
+            y_true (array-like): Target of the rows
+            y_proba (array-like): Failure probability of the rows
+            serial_numbers (array-like, optional): Serial numbers of the rows for the metrics per drive. Defaults to None.
+
+        Returns:
+            streaming_metrics: The metrics themselves
+        """
+        y_true = np.asarray(y_true).astype(bool)
+        y_proba = np.asarray(y_proba, dtype=np.float64)
+        bins = np.clip((y_proba * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        self.positives += np.bincount(bins[y_true], minlength=self.n_bins)
+        self.negatives += np.bincount(bins[~y_true], minlength=self.n_bins)
+        alarm = y_proba > self.threshold
+        self.counts["tp"] += int(np.count_nonzero(alarm & y_true))
+        self.counts["fp"] += int(np.count_nonzero(alarm & ~y_true))
+        self.counts["fn"] += int(np.count_nonzero(~alarm & y_true))
+        self.counts["tn"] += int(np.count_nonzero(~alarm & ~y_true))
+        if serial_numbers is not None:
+            flags = pd.DataFrame({  "failing": y_true,
+                                    "caught": alarm & y_true,
+                                    "alarm": alarm,
+                                    }).groupby(np.asarray(serial_numbers), sort=False).any()
+            # Drives spanning several chunks are combined by a logical or
+            self.drives = flags if self.drives is None else pd.concat([self.drives, flags]).groupby(level=0, sort=False).any()
+        return self
+
+    def roc_auc(self) -> float:
+        """ROC-AUC of the histograms, rows in the same bin count as ties"""
+        # From the highest to the lowest probability
+        pos, neg = self.positives[::-1], self.negatives[::-1]
+        n_pos, n_neg = pos.sum(), neg.sum()
+        if n_pos == 0 or n_neg == 0:
+            return None
+        tp_before = np.cumsum(pos) - pos
+        return float(np.sum(neg * (tp_before + pos / 2)) / (n_pos * n_neg))
+
+    def pr_auc(self) -> float:
+        """Average precision of the histograms with a threshold at every bin edge"""
+        pos, neg = self.positives[::-1], self.negatives[::-1]
+        n_pos = pos.sum()
+        if n_pos == 0:
+            return None
+        tp, fp = np.cumsum(pos), np.cumsum(neg)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        return float(np.sum(pos * precision) / n_pos)
+
+    def result(self) -> dict:
+        """Metrics of the chunks added so far
+
+        Returns:
+            dict: Rows, ROC-AUC, PR-AUC, recall and precision at the threshold and, with serial
+                numbers, the caught and false alarm rates of the drives
+        """
+        tp, fp, fn = self.counts["tp"], self.counts["fp"], self.counts["fn"]
+        metrics = { "rows": sum(self.counts.values()),
+                    "positives": tp + fn,
+                    "threshold": self.threshold,
+                    "roc_auc": self.roc_auc(),
+                    "pr_auc": self.pr_auc(),
+                    "recall": tp / (tp + fn) if tp + fn else None,
+                    "precision": tp / (tp + fp) if tp + fp else None,
+                    }
+        if self.drives is not None:
+            failing = self.drives.failing.values
+            n_failing, n_healthy = int(failing.sum()), int((~failing).sum())
+            metrics["drives_failing"] = n_failing
+            metrics["drives_healthy"] = n_healthy
+            metrics["drives_caught_rate"] = self.drives.caught.values.sum() / n_failing if n_failing else None
+            metrics["drives_false_alarm_rate"] = (self.drives.alarm.values & ~failing).sum() / n_healthy if n_healthy else None
+        return metrics
+
+def evaluate_model(model, chunks, threshold=0.5, n_bins=N_BINS) -> dict:
+    """Score chunks of features and consume the predictions with streaming_metrics. Only one
+    chunk of predictions is held at a time. The inference throughput is measured on the calls
+    of predict_proba.
+
+    Args:
+        model: Fitted model with predict_proba, e.g. the pipeline or numpy_model
+        chunks (iterable): Tuples of features, target and serial numbers (or None) per chunk
+        threshold (float, optional): Decision threshold on the failure probability. Defaults to 0.5.
+        n_bins (int, optional): Number of histogram bins. Defaults to N_BINS.
+
+    Returns:
+        dict: Metrics, see streaming_metrics.result, with the prediction time and the throughput in rows per second
+    """
+    metrics = streaming_metrics(threshold=threshold, n_bins=n_bins)
+    predict_s = 0.0
+    for X, y, serial_numbers in chunks:
+        start = time.perf_counter()
+        y_proba = model.predict_proba(X)[:, 1]
+        predict_s += time.perf_counter() - start
+        metrics.update(y, y_proba, serial_numbers=serial_numbers)
+    result = metrics.result()
+    result["predict_s"] = predict_s
+    result["throughput_rows_per_s"] = result["rows"] / predict_s if predict_s > 0 else None
+    return result
+
+def iter_frame_chunks(X, y, serial_numbers=None, chunksize=500_000):
+    """Chunks of features in memory for evaluate_model
+
+    Args:
+        X (pd.DataFrame): Features
+        y (pd.Series): Target
+        serial_numbers (pd.Series, optional): Serial numbers of the rows. Defaults to None.
+        chunksize (int, optional): Number of rows per chunk. Defaults to 500_000.
+
+    Yields:
+        tuple: Features, target and serial numbers of the chunk
+    """
+    for start in range(0, len(X), chunksize):
+        stop = start + chunksize
+        yield (X.iloc[start:stop], y.iloc[start:stop].values,
+               None if serial_numbers is None else serial_numbers.iloc[start:stop].values)
+
+def iter_matrix_chunks(matrix, chunksize=500_000):
+    """Chunks of a memory-mapped feature matrix with a target for evaluate_model. The rows are
+    paged in chunk by chunk, the serial numbers are taken from the ids if they were stored.
+
+    Args:
+        matrix (feature_matrix): Feature matrix, see src.features.feature_matrix
+        chunksize (int, optional): Number of rows per chunk. Defaults to 500_000.
+
+    Yields:
+        tuple: Features, target and serial numbers of the chunk
+    """
+    ids = matrix.ids
+    y = matrix.y.values
+    serial_numbers = ids.serial_number.values if "serial_number" in ids.columns else None
+    for start in range(0, len(matrix), chunksize):
+        stop = start + chunksize
+        yield (matrix.frame(start, stop), y[start:stop],
+               None if serial_numbers is None else serial_numbers[start:stop])
+
+def log_metrics(metrics:dict, prefix="test"):
+    """Log the metrics and, if a tracking uri is set in src.models.config, log them to MLflow.
+    They go to the active run, or to a new run of the experiment.
+
+    Args:
+        metrics (dict): Metrics, see streaming_metrics.result
+        prefix (str, optional): Prefix of the metric names, e.g. the evaluated split. Defaults to "test".
+    """
+    logger.info(f"Metrics {prefix}: {json.dumps(metrics)}")
+    from src.models import config
+    if not config.TRACKING_URI:
+        return
+    import mlflow
+    mlflow.set_tracking_uri(config.TRACKING_URI)
+    mlflow.set_experiment(config.EXPERIMENT_NAME)
+    values = {f"{prefix}/{key}": float(value) for key, value in metrics.items() if value is not None}
+    if mlflow.active_run() is not None:
+        mlflow.log_metrics(values)
+        return
+    with mlflow.start_run():
+        mlflow.log_metrics(values)
+
+if __name__ == "__main__":
+    import logging
+    import argparse
+    from mlflow.sklearn import load_model
+    from src.features.feature_matrix import feature_matrix
+
+    parser = argparse.ArgumentParser(description="Evaluate a model on a feature matrix chunk by chunk")
+    parser.add_argument("--matrix", default="data/matrix/test.npy", help="Feature matrix with a target")
+    parser.add_argument("--model-path", default="models/deployment")
+    parser.add_argument("--threshold", type=float, help="Decision threshold, defaults to the threshold of the model")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    threshold = load_threshold(args.model_path) if args.threshold is None else args.threshold
+    chunks = iter_matrix_chunks(feature_matrix(args.matrix), chunksize=args.chunksize)
+    metrics = evaluate_model(load_model(args.model_path), chunks, threshold=threshold)
+    log_metrics(metrics, prefix="test")
+    print(json.dumps(metrics, indent=2))
@@ -0,0 +1,149 @@
+import numpy as np
+
+# Rows scored at once, bounds the (rows x trees) node index arrays of the tree ensembles
+CHUNKSIZE = 65536
+
+def _sigmoid(x):
+    # exp overflows to inf for large negative margins, which correctly gives 0
+    with np.errstate(over="ignore"):
+        return 1 / (1 + np.exp(-x))
+
+activations = { "linear": lambda x: x,
+                "relu": lambda x: np.maximum(x, 0),
+                "sigmoid": _sigmoid,
+                "tanh": np.tanh,
+                }
+
+class numpy_model():
+    """Pure NumPy version of a fitted model pipeline, loaded from the weights file written by
+    src.models.train.export_weights. Scoring needs neither scikit-learn nor Keras, TensorFlow,
+    XGBoost or MLflow, which keeps the import time and the memory of a scoring process small.
+
+    The pipeline consists of log and MinMax scaling steps followed by an XGBoost tree
+    ensemble, a dense neural network, a logistic regression or a stacking of them with a
+    logistic-regression meta-learner.
+    """
+    def __init__(self, weights:dict):
+        self.weights = weights
+        self.feature_names = list(weights["feature_names"]) if "feature_names" in weights else None
+        self.n_features = int(weights["n_features"])
+        self.transforms = [str(kind) for kind in weights["transforms"]]
+        self.estimators = [str(kind) for kind in weights["estimators"]]
+        self.stacking = "meta_coef" in weights
+        self.dtype = np.dtype(str(weights["dtype"])) if "dtype" in weights else np.dtype(np.float64)
+
+    @classmethod
+    def load(cls, file:str):
+        """Load the model from a weights file
+
+        Args:
+            file (str): Path of the .npz weights file
+
+        Returns:
+            numpy_model: Model
+        """
+        with np.load(file, allow_pickle=False) as stored:
+            return cls({key: stored[key] for key in stored.files})
+
+    def __features(self, X) -> np.ndarray:
+        # Dataframes are ordered like the training data
+        if hasattr(X, "columns") and self.feature_names is not None:
+            X = X[self.feature_names]
+        X = np.asarray(X, dtype=self.dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got an array of shape {X.shape}")
+        return X
+
+    def transform(self, X) -> np.ndarray:
+        """Apply the scaling steps of the pipeline
+
+        Args:
+            X (pd.DataFrame or np.ndarray): Features as output by hdd_preprocessor
+
+        Returns:
+            np.ndarray: Scaled features
+        """
+        X = self.__features(X)
+        for i, kind in enumerate(self.transforms):
+            # Every operation is rounded to the dtype of the features, like the in place
+            # operations of the fitted pipeline
+            if kind == "log":
+                X = np.log(X + self.weights[f"transform_{i}_offset"].astype(self.dtype))
+            elif kind == "minmax":
+                X = (X * self.weights[f"transform_{i}_scale"]).astype(self.dtype, copy=False)
+                X = (X + self.weights[f"transform_{i}_min"]).astype(self.dtype, copy=False)
+                clip = self.weights[f"transform_{i}_clip"]
+                if not np.isnan(clip).any():
+                    X = np.clip(X, clip[0], clip[1])
+            else:
+                raise ValueError(f"Unknown transform {kind}")
+        return X
+
+    def __tree_proba(self, X, prefix) -> np.ndarray:
+        w = self.weights
+        left, right = w[f"{prefix}_left"], w[f"{prefix}_right"]
+        feature, threshold = w[f"{prefix}_feature"], w[f"{prefix}_threshold"]
+        default_left, value = w[f"{prefix}_default_left"], w[f"{prefix}_value"]
+        roots, depth = w[f"{prefix}_roots"], int(w[f"{prefix}_depth"])
+        # XGBoost compares the features in single precision
+        X = X.astype(np.float32)
+        margin = np.empty(len(X))
+        for start in range(0, len(X), CHUNKSIZE):
+            chunk = X[start:start + CHUNKSIZE]
+            # Current node of every row in every tree, leaves point to themselves
+            node = np.broadcast_to(roots, (len(chunk), len(roots))).copy()
+            for _ in range(depth):
+                x = np.take_along_axis(chunk, feature[node], axis=1)
+                go_left = np.where(np.isnan(x), default_left[node], x < threshold[node])
+                node = np.where(go_left, left[node], right[node])
+            margin[start:start + CHUNKSIZE] = value[node].sum(axis=1, dtype=np.float64)
+        return _sigmoid(margin + float(w[f"{prefix}_base_margin"]))
+
+    def __ann_proba(self, X, prefix) -> np.ndarray:
+        # Keras computes in single precision, the dropout layers are inactive at inference
+        X = X.astype(np.float32)
+        for i, activation in enumerate(self.weights[f"{prefix}_activations"]):
+            X = activations[str(activation)](X @ self.weights[f"{prefix}_kernel_{i}"] + self.weights[f"{prefix}_bias_{i}"])
+        return X[:, -1].astype(np.float64)
+
+    def __logistic_proba(self, X, prefix) -> np.ndarray:
+        return _sigmoid(X @ self.weights[f"{prefix}_coef"][0] + self.weights[f"{prefix}_intercept"][0])
+
+    def __estimator_proba(self, X, i) -> np.ndarray:
+        kind = self.estimators[i]
+        if kind == "xgb":
+            return self.__tree_proba(X, f"est_{i}")
+        if kind == "ann":
+            return self.__ann_proba(X, f"est_{i}")
+        if kind == "logistic":
+            return self.__logistic_proba(X, f"est_{i}")
+        raise ValueError(f"Unknown estimator {kind}")
+
+    def predict_proba(self, X) -> np.ndarray:
+        """Predict the class probabilities like the predict_proba of the fitted pipeline
+
+        Args:
+            X (pd.DataFrame or np.ndarray): Features as output by hdd_preprocessor
+
+        Returns:
+            np.ndarray: Probabilities of no failure and of failure
+        """
+        X = self.transform(X)
+        probas = [self.__estimator_proba(X, i) for i in range(len(self.estimators))]
+        if self.stacking:
+            proba = self.__logistic_proba(np.column_stack(probas), "meta")
+        else:
+            proba = probas[0]
+        return np.column_stack([1 - proba, proba])
+
+    def predict(self, X, threshold=0.5) -> np.ndarray:
+        """Predict the failure of the drives
+
+        Args:
+            X (pd.DataFrame or np.ndarray): Features as output by hdd_preprocessor
+            threshold (float, optional): Decision threshold on the failure probability. Defaults to 0.5.
+
+        Returns:
+            np.ndarray: Predicted failures
+        """
+        return (self.predict_proba(X)[:, 1] > threshold).astype(int)
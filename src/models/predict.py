@@ -1,45 +1,374 @@
 from logging import getLogger
 import pandas as pd
-import pickle
 import warnings
 import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from mlflow.sklearn import load_model
 
-from src.data.hdd_preprocessing import load_preprocess_testdata
-from src.features.feature_engineering import hdd_preprocessor, log_transformer
+from src.data.hdd_preprocessing import load_preprocess_testdata, load_smart_7_summary, warmup_start, date_value
+from src.features.feature_engineering import hdd_preprocessor
+from src.features.feature_matrix import write_feature_matrix, feature_matrix
+from src.instrumentation import init_worker
 
 warnings.filterwarnings("ignore")
 logger = getLogger(__name__)
 
-def __get_data():
-    X_test = load_preprocess_testdata(   days=30, filename="ST4000DM000_history_total", 
-                                    path=os.getcwd())
+MODEL_PATH = "models/final1"
+
+def __get_data(filename="ST4000DM000_history_total", path=os.getcwd(), start_date=None, end_date=None):
+    X_test = load_preprocess_testdata(   days=30, filename=filename, 
+                                    path=path, start_date=start_date, end_date=end_date)
     return X_test
 
-def __get_model():
-    model_path = "models/final1"
+def __get_carry(filename="ST4000DM000_history_total", path=os.getcwd(), start_date=None):
+    # smart_7 unwrap state of the history before the read window
+    if start_date is None:
+        return None
+    return load_smart_7_summary(warmup_start(start_date, days=30), filename=filename, path=path)
+
+def __get_model(model_path=MODEL_PATH):
     model = load_model(model_path)
     return model
 
-def run_predict():
+def run_predict(model_path=MODEL_PATH, filename="ST4000DM000_history_total", path=os.getcwd(),
+                start_date=None, end_date=None):
     logger.info("Loading model")
-    model = __get_model()
+    model = __get_model(model_path)
     logger.info("Loading and preprocessing data")
-    X_test = __get_data()
+    X_test = __get_data(filename, path, start_date, end_date)
+    carry = __get_carry(filename, path, start_date)
     logger.info("Feature engineering on test")
-    preprocessor = hdd_preprocessor(days=30, trigger=0.05)
+    preprocessor = hdd_preprocessor(days=30, trigger=0.05, start_date=start_date, smart_7_carry=carry)
     X_test = preprocessor.fit_transform(X_test) # Nothing saved in the fit!
     logger.info("Prediction in progress")
     y_proba = model.predict_proba(X_test)
     return y_proba > 0.15
 
+def latest_rows(df) -> np.ndarray:
+    """Positions of the latest row of every drive
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+
+    Returns:
+        np.ndarray: Row positions, ordered by serial number
+    """
+    keys = pd.DataFrame({"serial_number": df.serial_number.values, "date": df.date.values})
+    order = keys.sort_values(["serial_number", "date"], kind="mergesort").index.values
+    serials = keys.serial_number.values[order]
+    # Last row of every contiguous drive segment
+    last = np.append(serials[1:] != serials[:-1], True)
+    return order[last]
+
+def score_latest(model, df, days=30, trigger=0.05, cols=None, start_date=None, smart_7_carry=None) -> pd.DataFrame:
+    """Current failure risk of every drive. The features are calculated over the history of the
+    drives, the EMAs and the smart_7 unwrapping need all earlier rows, but the model is evaluated
+    on the latest row of every drive only.
+
+    Args:
+        model: Fitted pipeline or numpy_model with predict_proba
+        df (pd.DataFrame): Preprocessed drive stats data
+        days (int, optional): Time interval for the EMA. Defaults to 30.
+        trigger (float, optional): Trigger percentage of the smart_999 feature. Defaults to 0.05.
+        cols (list, optional): Raw columns selected for the drive model, see hdd_preprocessor. Defaults to None.
+        start_date (str, optional): Drives without rows since this date are not scored, earlier rows
+            only warm up the features. Defaults to None.
+        smart_7_carry (pd.DataFrame, optional): Unwrap state of the drives before the data, see
+            unwrap_smart_7. Defaults to None.
+
+    Returns:
+        pd.DataFrame: serial_number, date and probability of the latest row of every drive
+    """
+    preprocessor = hdd_preprocessor(days=days, trigger=trigger, cols=cols, smart_7_carry=smart_7_carry)
+    X = preprocessor.fit_transform(df)
+    rows = latest_rows(df)
+    if start_date is not None:
+        rows = rows[(df.date.values[rows] >= date_value(start_date, df.date))]
+    y_proba = model.predict_proba(X.iloc[rows])[:, 1]
+    return pd.DataFrame({   "serial_number": df.serial_number.values[rows],
+                            "date": df.date.values[rows],
+                            "probability": y_proba,
+                            })
+
+def rank_drives(scores, top_k=None, threshold=None) -> pd.DataFrame:
+    """Drives ordered by decreasing failure probability. Only the selected drives are sorted,
+    the top k are found with a partial sort.
+
+    Args:
+        scores (pd.DataFrame): Output of score_latest
+        top_k (int, optional): Number of drives with the highest probability. Defaults to None (all).
+        threshold (float, optional): Keep the drives with a probability above the threshold. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Selected rows of the scores
+    """
+    proba = scores.probability.values
+    if threshold is None:
+        selected = np.arange(len(proba))
+    else:
+        selected = np.flatnonzero(proba > threshold)
+    if top_k is not None and top_k < len(selected):
+        selected = selected[np.argpartition(-proba[selected], top_k - 1)[:top_k]]
+    selected = selected[np.argsort(-proba[selected], kind="stable")]
+    return scores.iloc[selected].reset_index(drop=True)
+
+def run_predict_latest(model_path=MODEL_PATH, filename="ST4000DM000_history_total", path=os.getcwd(),
+                       top_k=None, threshold=None, days=30, trigger=0.05, start_date=None, end_date=None) -> pd.DataFrame:
+    """Score the latest snapshot of every drive and rank the drives by risk
+
+    Args:
+        model_path (str, optional): Path of the model. Defaults to MODEL_PATH.
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+        path (str, optional): Path of the repo. Defaults to os.getcwd().
+        top_k (int, optional): Number of drives with the highest probability. Defaults to None (all).
+        threshold (float, optional): Keep the drives with a probability above the threshold. Defaults to None.
+        days (int, optional): Time interval for the EMA. Defaults to 30.
+        trigger (float, optional): Trigger percentage of the smart_999 feature. Defaults to 0.05.
+        start_date (str, optional): Read only the data from this date on, plus the warm-up of the
+            EMA. Drives without rows since the date are not scored. Defaults to None.
+        end_date (str, optional): Last date of the data. Defaults to None.
+
+    Returns:
+        pd.DataFrame: serial_number, date and probability of the ranked drives
+    """
+    logger.info("Loading model")
+    model = __get_model(model_path)
+    logger.info("Loading and preprocessing data")
+    X_test = __get_data(filename, path, start_date, end_date)
+    carry = __get_carry(filename, path, start_date)
+    logger.info("Scoring the latest snapshot of every drive")
+    scores = score_latest(model, X_test, days=days, trigger=trigger, start_date=start_date, smart_7_carry=carry)
+    return rank_drives(scores, top_k=top_k, threshold=threshold)
+
+def shard_by_drive(df, chunksize=500_000) -> list:
+    """Split the drive stats into shards of about chunksize rows in one pass. All the rows
+    of a drive end up in the same shard.
+
+    Args:
+        df (pd.DataFrame): Drive stats data
+        chunksize (int, optional): Number of rows per shard. Defaults to 500_000.
+
+    Returns:
+        list: Dataframes of the shards
+    """
+    if len(df) == 0:
+        return []
+    counts = df.serial_number.value_counts(sort=False)
+    # Shard of every drive from the cumulative number of rows
+    shard_of_drive = pd.Series((counts.cumsum().values - counts.values) // chunksize, index=counts.index)
+    shards = df.serial_number.map(shard_of_drive).values
+    # One stable sort by shard keeps the row order within a shard, the shards are contiguous slices
+    order = np.argsort(shards, kind="stable")
+    df = df.iloc[order]
+    bounds = np.flatnonzero(np.diff(shards[order])) + 1
+    return [df.iloc[start:stop] for start, stop in zip(np.append(0, bounds), np.append(bounds, len(df)))]
+
+__worker_model = None
+
+def __init_worker(model_path):
+    # Every worker process loads the model once and records no stages of its own
+    global __worker_model
+    init_worker()
+    __worker_model = __get_model(model_path)
+
+def __score_shard(df, days=30, trigger=0.05) -> pd.DataFrame:
+    preprocessor = hdd_preprocessor(days=days, trigger=trigger)
+    X = preprocessor.fit_transform(df)
+    y_proba = __worker_model.predict_proba(X)[:, 1]
+    return pd.DataFrame({   "serial_number": df.serial_number.values,
+                            "date": df.date.values,
+                            "probability": y_proba,
+                            })
+
+class prediction_writer():
+    """Appends prediction chunks to a csv, jsonl or parquet file"""
+    def __init__(self, file:str, fmt="csv"):
+        if fmt not in ("csv", "jsonl", "parquet"):
+            raise ValueError(f"Unknown output format {fmt}")
+        self.file = file
+        self.fmt = fmt
+        self.parquet_writer = None
+        self.header = True
+        if os.path.exists(file):
+            os.remove(file)
+
+    def write(self, df):
+        if self.fmt == "csv":
+            df.to_csv(self.file, mode="a", header=self.header, index=False)
+        elif self.fmt == "jsonl":
+            lines = df.to_json(orient="records", lines=True, date_format="iso")
+            with open(self.file, "a") as f:
+                f.write(lines.rstrip("\n") + "\n")
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.file, table.schema)
+            self.parquet_writer.write_table(table)
+        self.header = False
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+def run_batch_predict(output="predictions.csv", fmt="csv", workers=os.cpu_count(), chunksize=500_000,
+                      model_path=MODEL_PATH, days=30, trigger=0.05) -> int:
+    """Score the drive stats in parallel. The data is sharded by drive, and feature engineering
+    and prediction run per shard in a process pool. The probabilities are streamed to the
+    output file as the shards finish.
+
+    Args:
+        output (str, optional): Output file. Defaults to "predictions.csv".
+        fmt (str, optional): Output format, "csv", "jsonl" or "parquet". Defaults to "csv".
+        workers (int, optional): Number of worker processes. Defaults to os.cpu_count().
+        chunksize (int, optional): Number of rows per shard. Defaults to 500_000.
+        model_path (str, optional): Path of the model. Defaults to MODEL_PATH.
+        days (int, optional): Time interval for the EMA. Defaults to 30.
+        trigger (float, optional): Trigger percentage of the smart_999 feature. Defaults to 0.05.
+
+    Returns:
+        int: Number of scored rows
+    """
+    logger.info("Loading and preprocessing data")
+    shards = shard_by_drive(__get_data(), chunksize=chunksize)
+    logger.info(f"Scoring {len(shards)} shards with {workers} workers")
+    writer = prediction_writer(output, fmt=fmt)
+    n_rows = 0
+    # Fresh interpreters, TensorFlow does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_worker, initargs=(model_path,),
+                             mp_context=context) as pool:
+        pending = set()
+        for i in range(len(shards)):
+            # Limit the number of shards in flight to bound the memory
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    writer.write(result)
+                    n_rows += len(result)
+            pending.add(pool.submit(__score_shard, shards[i], days, trigger))
+            shards[i] = None
+        for future in wait(pending).done:
+            result = future.result()
+            writer.write(result)
+            n_rows += len(result)
+    writer.close()
+    return n_rows
+
+def write_prediction_matrix(file:str, filename="ST4000DM000_history_total", path=os.getcwd(),
+                            start_date=None, end_date=None, days=30, trigger=0.05) -> str:
+    """Feature engineering of the drive stats into a memory-mapped feature matrix with the
+    serial numbers and dates as ids, see run_matrix_predict
+
+    Args:
+        file (str): Path of the .npy file
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+        path (str, optional): Path of the repo. Defaults to os.getcwd().
+        start_date (str, optional): First date of the rows, see run_predict. Defaults to None.
+        end_date (str, optional): Last date of the rows. Defaults to None.
+        days (int, optional): Time interval for the EMA. Defaults to 30.
+        trigger (float, optional): Trigger percentage of the smart_999 feature. Defaults to 0.05.
+
+    Returns:
+        str: Path of the .npy file
+    """
+    X_test = __get_data(filename, path, start_date, end_date)
+    carry = __get_carry(filename, path, start_date)
+    preprocessor = hdd_preprocessor(days=days, trigger=trigger, start_date=start_date, smart_7_carry=carry)
+    features = preprocessor.fit_transform(X_test)
+    return write_feature_matrix(features, file, ids=X_test[["serial_number", "date"]])
+
+def __score_matrix_rows(file, start, stop):
+    # Read-only mapping, the workers share the pages of the matrix
+    matrix = feature_matrix(file)
+    return start, __worker_model.predict_proba(matrix.frame(start, stop))[:, 1]
+
+def run_matrix_predict(file:str, output="predictions.csv", fmt="csv", workers=os.cpu_count(), chunksize=500_000,
+                       model_path=MODEL_PATH) -> int:
+    """Score a memory-mapped feature matrix in parallel. The workers map the matrix read-only
+    and score row ranges of it, so the features are neither pickled nor copied between the
+    processes.
+
+    Args:
+        file (str): Path of the matrix, see write_prediction_matrix
+        output (str, optional): Output file. Defaults to "predictions.csv".
+        fmt (str, optional): Output format, "csv", "jsonl" or "parquet". Defaults to "csv".
+        workers (int, optional): Number of worker processes. Defaults to os.cpu_count().
+        chunksize (int, optional): Number of rows per task. Defaults to 500_000.
+        model_path (str, optional): Path of the model. Defaults to MODEL_PATH.
+
+    Returns:
+        int: Number of scored rows
+    """
+    matrix = feature_matrix(file)
+    ids = matrix.ids
+    logger.info(f"Scoring {len(matrix)} rows with {workers} workers")
+    writer = prediction_writer(output, fmt=fmt)
+    n_rows = 0
+    # Fresh interpreters, TensorFlow does not survive a fork. The mapping of the file is shared anyway.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_worker, initargs=(model_path,),
+                             mp_context=context) as pool:
+        futures = [pool.submit(__score_matrix_rows, file, start, start + chunksize)
+                   for start in range(0, len(matrix), chunksize)]
+        for future in futures:
+            start, y_proba = future.result()
+            rows = ids.iloc[start:start + len(y_proba)]
+            writer.write(pd.DataFrame({ "serial_number": rows.serial_number.values,
+                                        "date": rows.date.values,
+                                        "probability": y_proba,
+                                        }))
+            n_rows += len(y_proba)
+    writer.close()
+    return n_rows
+
 if __name__ == "__main__":
     import logging
+    import argparse
 
     logger = logging.getLogger()
     logging.basicConfig(format="%(asctime)s: %(message)s")
     logging.getLogger("pyhive").setLevel(logging.CRITICAL)  # avoid excessive logs
     logger.setLevel(logging.INFO)
 
-    y_pred = run_predict()
-    print(y_pred.sum())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Predict the drive failures")
+    parser.add_argument("--output", help="Run the parallel batch mode and write the probabilities to this file")
+    parser.add_argument("--format", default="csv", choices=["csv", "jsonl", "parquet"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunksize", type=int, default=500_000, help="Number of rows per shard")
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--latest", action="store_true", help="Score only the latest row of every drive")
+    parser.add_argument("--top-k", type=int, help="Number of drives with the highest risk in the latest mode")
+    parser.add_argument("--threshold", type=float, help="Minimal probability of the drives in the latest mode")
+    parser.add_argument("--start-date", help="Score the rows from this date on, reads only the EMA warm-up before it")
+    parser.add_argument("--end-date", help="Score the rows up to this date")
+    parser.add_argument("--matrix", help="Score the memory-mapped feature matrix in this .npy file")
+    parser.add_argument("--write-matrix", action="store_true", help="Write the feature matrix before scoring it")
+    args = parser.parse_args()
+
+    if args.matrix:
+        if args.write_matrix:
+            write_prediction_matrix(args.matrix, start_date=args.start_date, end_date=args.end_date)
+        n_rows = run_matrix_predict(args.matrix, output=args.output or "predictions.csv", fmt=args.format,
+                                    workers=args.workers, chunksize=args.chunksize, model_path=args.model_path)
+        print(n_rows)
+    elif args.latest:
+        ranking = run_predict_latest(model_path=args.model_path, top_k=args.top_k, threshold=args.threshold,
+                                     start_date=args.start_date, end_date=args.end_date)
+        if args.output is None:
+            print(ranking.to_string(index=False))
+        else:
+            writer = prediction_writer(args.output, fmt=args.format)
+            writer.write(ranking)
+            writer.close()
+    elif args.output is None:
+        y_pred = run_predict(model_path=args.model_path, start_date=args.start_date, end_date=args.end_date)
+        print(y_pred.sum())
+    else:
+        n_rows = run_batch_predict(output=args.output, fmt=args.format, workers=args.workers,
+                                   chunksize=args.chunksize, model_path=args.model_path)
+        print(n_rows)
\ No newline at end of file
@@ -0,0 +1,106 @@
+from logging import getLogger
+import pandas as pd
+import numpy as np
+import os
+import re
+import json
+
+from src.data.hdd_preprocessing import drop_cols, drop_missing_rows
+from src.features.feature_engineering import hdd_preprocessor
+from src.models.numpy_model import numpy_model
+
+logger = getLogger(__name__)
+
+REGISTRY_PATH = "models/fleet"
+
+def artifact_name(model:str) -> str:
+    """Folder name of the artifact of a drive model
+
+    Args:
+        model (str): Drive model
+
+    Returns:
+        str: Drive model with the characters unsafe in paths replaced
+    """
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+
+def load_registry(folder=REGISTRY_PATH) -> dict:
+    """Load the registry of the per drive model artifacts
+
+    Args:
+        folder (str, optional): Folder of the registry and the artifacts. Defaults to REGISTRY_PATH.
+
+    Returns:
+        dict: Artifact, selected columns and training summary per drive model, empty if there is no registry
+    """
+    try:
+        with open(f"{folder}/registry.json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def update_registry(entries:dict, folder=REGISTRY_PATH) -> dict:
+    """Add or replace drive models in the registry
+
+    Args:
+        entries (dict): Registry entries per drive model
+        folder (str, optional): Folder of the registry and the artifacts. Defaults to REGISTRY_PATH.
+
+    Returns:
+        dict: Updated registry
+    """
+    registry = load_registry(folder)
+    registry.update(entries)
+    os.makedirs(folder, exist_ok=True)
+    # Written to a temporary file first, so that a scorer never reads a partial registry
+    with open(f"{folder}/registry.json.tmp", "w") as f:
+        json.dump(registry, f, indent=2)
+    os.replace(f"{folder}/registry.json.tmp", f"{folder}/registry.json")
+    return registry
+
+class fleet_scorer():
+    """Scores drive stats of several drive models. Every drive is routed to the artifact of its
+    drive model in the registry, which is scored with the NumPy weights of the artifact. The
+    artifacts are loaded on first use.
+    """
+    def __init__(self, folder=REGISTRY_PATH):
+        self.folder = folder
+        self.registry = load_registry(folder)
+        self.models = {}
+
+    def __model(self, model:str):
+        if model not in self.models:
+            entry = self.registry[model]
+            self.models[model] = (numpy_model.load(f"{self.folder}/{entry['artifact']}/weights.npz"),
+                                  hdd_preprocessor(days=entry["days"], trigger=entry["trigger"], cols=entry["columns"]))
+        return self.models[model]
+
+    def predict_proba(self, df) -> pd.Series:
+        """Failure probabilities of the drive stats
+
+        Args:
+            df (pd.DataFrame): Drive stats with a model column, the rows of a drive are its history
+
+        Returns:
+            pd.Series: Failure probabilities of the rows with complete SMART values, indexed like
+                the drive stats. Drive models without artifact are skipped.
+        """
+        probas = []
+        # Row positions as index, the index of the drive stats need not be unique
+        df_in = df
+        df = df.set_axis(pd.RangeIndex(len(df)), axis=0)
+        for model, rows in df.groupby("model", sort=False):
+            if model not in self.registry:
+                logger.warning(f"No model registered for the drive model {model}, skipping {len(rows)} rows")
+                continue
+            estimator, preprocessor = self.__model(model)
+            X = drop_cols(rows, columns=self.registry[model]["columns"])
+            X = drop_missing_rows(X)
+            if len(X) == 0:
+                continue
+            features = preprocessor.transform(X)
+            probas.append(pd.Series(estimator.predict_proba(features)[:, 1], index=features.index))
+        if not probas:
+            return pd.Series(dtype=np.float64)
+        proba = pd.concat(probas).sort_index()
+        return pd.Series(proba.values, index=df_in.index[proba.index])
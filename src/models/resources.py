@@ -0,0 +1,124 @@
+from logging import getLogger
+import os
+import time
+import resource
+
+logger = getLogger(__name__)
+
+# Thread pools of BLAS, OpenMP and numexpr, limited by environment variables inherited by the workers
+blas_env = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def available_cores() -> int:
+    """Number of cores the process may run on, which respects CPU affinity masks"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on macOS
+        return os.cpu_count()
+
+class thread_budget():
+    """Split of a core budget across the parallel levels of the stacked model. The stacking fits
+    the base estimators and their cross-validation folds in worker processes, and every worker
+    gets an equal share of the cores for the XGBoost threads, the TensorFlow intra-op threads
+    and BLAS. A worker fits XGBoost and the ANN one after the other, so both use the full share.
+
+    Args:
+        n_cores (int, optional): Total number of cores. Defaults to None (available_cores).
+        stacking_jobs (int, optional): Worker processes of the stacking. Defaults to None (one per
+            fold, as long as every worker gets min_threads cores).
+        n_folds (int, optional): Cross-validation folds of the stacking. Defaults to 5.
+        min_threads (int, optional): Minimal number of threads per worker. Defaults to 2.
+    """
+    def __init__(self, n_cores=None, stacking_jobs=None, n_folds=5, min_threads=2):
+        self.n_cores = available_cores() if n_cores is None else n_cores
+        if stacking_jobs is None:
+            stacking_jobs = min(n_folds, self.n_cores // min_threads)
+        self.stacking_jobs = max(1, min(stacking_jobs, self.n_cores))
+        threads = max(1, self.n_cores // self.stacking_jobs)
+        self.xgb_threads = threads
+        self.tf_intra_threads = threads
+        # The dense layers of the ANN are a chain of ops, parallel ops gain nothing
+        self.tf_inter_threads = 1
+        self.blas_threads = threads
+
+    def as_dict(self) -> dict:
+        """Thread counts of the budget"""
+        return {"n_cores": self.n_cores,
+                "stacking_jobs": self.stacking_jobs,
+                "xgb_threads": self.xgb_threads,
+                "tf_intra_threads": self.tf_intra_threads,
+                "tf_inter_threads": self.tf_inter_threads,
+                "blas_threads": self.blas_threads,
+                }
+
+    def apply(self):
+        """Apply the limits to this process and to the worker processes started afterwards. The
+        workers inherit the environment variables, TensorFlow reads TF_NUM_INTRAOP_THREADS and
+        TF_NUM_INTEROP_THREADS when it is initialized. In this process the BLAS pools are limited
+        by threadpoolctl and TensorFlow is configured unless it is initialized already.
+
+        Returns:
+            thread_budget: The budget itself
+        """
+        for name in blas_env:
+            os.environ[name] = str(self.blas_threads)
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(self.tf_intra_threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(self.tf_inter_threads)
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=self.blas_threads)
+        try:
+            import tensorflow as tf
+            tf.config.threading.set_intra_op_parallelism_threads(self.tf_intra_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(self.tf_inter_threads)
+        except ImportError:
+            pass
+        except RuntimeError as err:
+            logger.warning(f"TensorFlow is initialized already and keeps its thread pools: {err}")
+        logger.info(f"Thread budget {self.as_dict()}")
+        return self
+
+    def backend(self):
+        """joblib backend of the stacking, which limits the thread pools of its worker processes
+
+        Returns:
+            Context manager of the joblib backend
+        """
+        from joblib import parallel_backend
+        return parallel_backend("loky", n_jobs=self.stacking_jobs, inner_max_num_threads=self.blas_threads)
+
+def _cpu_seconds() -> float:
+    # User and system time of this process and of the exited worker processes
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+class cpu_utilization():
+    """Context manager measuring the CPU utilization of a core budget: the CPU time of the
+    process and its worker processes divided by the wall time and the number of cores. The
+    worker processes of joblib are reused across calls, so they are shut down at the exit to
+    count their CPU time.
+
+    Args:
+        n_cores (int): Number of cores of the budget
+    """
+    def __init__(self, n_cores:int):
+        self.n_cores = n_cores
+        self.report = None
+
+    def __enter__(self):
+        self.__cpu_start = _cpu_seconds()
+        self.__wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        from joblib.externals.loky import get_reusable_executor
+        get_reusable_executor().shutdown(wait=True)
+        wall = time.perf_counter() - self.__wall_start
+        cpu = _cpu_seconds() - self.__cpu_start
+        self.report = {"wall_s": wall,
+                       "cpu_s": cpu,
+                       "utilization": cpu / (wall * self.n_cores) if wall > 0 else None,
+                       }
+        logger.info(f"{wall:.1f} s wall time, {cpu:.1f} s CPU time, "
+                    f"{100 * (self.report['utilization'] or 0):.0f} % utilization of {self.n_cores} cores")
+        return False
@@ -0,0 +1,245 @@
+from logging import getLogger
+import pandas as pd
+import numpy as np
+import io
+import json
+import time
+import queue
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mlflow.sklearn import load_model
+
+from src.data.hdd_preprocessing import drop_cols, drop_missing_rows
+from src.features.feature_engineering import hdd_preprocessor
+from src.models.evaluate import load_threshold
+
+warnings.filterwarnings("ignore")
+logger = getLogger(__name__)
+
+MODEL_PATH = "models/deployment"
+
+class scoring_stats():
+    """Thread safe latency and throughput counters of the scoring service"""
+    def __init__(self, window=10_000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.failed_requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.batch_rows = 0
+
+    def record_request(self, latency:float, rows:int):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.rows += rows
+
+    def record_failure(self):
+        with self.lock:
+            self.failed_requests += 1
+
+    def record_batch(self, rows:int):
+        with self.lock:
+            self.batches += 1
+            self.batch_rows += rows
+
+    def snapshot(self) -> dict:
+        """Current counters, latencies in milliseconds over the recent requests"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.perf_counter() - self.started
+            stats = {   "requests": self.requests,
+                        "failed_requests": self.failed_requests,
+                        "rows": self.rows,
+                        "batches": self.batches,
+                        "mean_batch_rows": self.batch_rows / self.batches if self.batches else 0.0,
+                        "uptime_s": uptime,
+                        "requests_per_s": self.requests / uptime,
+                        "rows_per_s": self.rows / uptime,
+                        }
+        for q in (50, 90, 99):
+            stats[f"latency_p{q}_ms"] = float(np.percentile(latencies, q)) if len(latencies) else 0.0
+        return stats
+
+class micro_batcher():
+    """Groups the feature matrices of concurrent requests into a single predict_proba call.
+    A batch is scored as soon as it holds max_batch_size rows or the oldest request waited
+    max_wait_ms.
+    """
+    def __init__(self, model, stats:scoring_stats, max_batch_size=4096, max_wait_ms=5):
+        self.model = model
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.__run, daemon=True)
+        self.worker.start()
+
+    def submit(self, X) -> np.ndarray:
+        """Score a feature matrix, blocks until the batch containing it is scored
+
+        Args:
+            X (pd.DataFrame): Features as created by hdd_preprocessor
+
+        Returns:
+            np.ndarray: Failure probabilities
+        """
+        future = Future()
+        self.queue.put((X, future))
+        return future.result()
+
+    def __run(self):
+        while True:
+            batch = [self.queue.get()]
+            rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[0])
+            self.__score(batch, rows)
+
+    def __score(self, batch, rows):
+        try:
+            X = pd.concat([X for X, _ in batch])
+            y_proba = self.model.predict_proba(X)[:, 1]
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        self.stats.record_batch(rows)
+        start = 0
+        for X, future in batch:
+            future.set_result(y_proba[start:start + len(X)])
+            start += len(X)
+
+class scoring_service():
+    """Model, preprocessor and batcher loaded once for the lifetime of the server"""
+    def __init__(self, model_path=MODEL_PATH, days=30, trigger=0.05, max_batch_size=4096, max_wait_ms=5):
+        logger.info(f"Loading model from {model_path}")
+        self.model = load_model(model_path)
+        self.threshold = load_threshold(model_path)
+        self.preprocessor = hdd_preprocessor(days=days, trigger=trigger)
+        self.stats = scoring_stats()
+        self.batcher = micro_batcher(self.model, self.stats, max_batch_size=max_batch_size,
+                                     max_wait_ms=max_wait_ms)
+
+    def score(self, df_in) -> pd.DataFrame:
+        """Score SMART snapshots. Several rows of the same drive are treated as its history.
+
+        Args:
+            df_in (pd.DataFrame): Drive stats data
+
+        Returns:
+            pd.DataFrame: Serial number, date, probability and prediction per scored row
+        """
+        start = time.perf_counter()
+        df = drop_missing_rows(drop_cols(df_in))
+        X = self.preprocessor.transform(df)
+        y_proba = self.batcher.submit(X) if len(X) else np.array([])
+        result = pd.DataFrame({ "serial_number": df.serial_number.values,
+                                "date": df.date.astype(str).values,
+                                "probability": y_proba,
+                                "prediction": y_proba > self.threshold,
+                                })
+        self.stats.record_request(time.perf_counter() - start, len(df))
+        return result
+
+def parse_snapshots(body:bytes, content_type:str) -> pd.DataFrame:
+    """Parse a csv batch or json records (a list or {"instances": [...]}) of SMART snapshots"""
+    if "csv" in content_type:
+        df = pd.read_csv(io.BytesIO(body))
+    else:
+        records = json.loads(body)
+        if isinstance(records, dict):
+            records = records.get("instances", [records])
+        df = pd.DataFrame.from_records(records)
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+def make_handler(service:scoring_service):
+    class scoring_handler(BaseHTTPRequestHandler):
+        def __send(self, code:int, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.__send(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                self.__send(200, service.stats.snapshot())
+            else:
+                self.__send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self.__send(404, {"error": f"Unknown path {self.path}"})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                df = parse_snapshots(body, self.headers.get("Content-Type", ""))
+            except (ValueError, KeyError) as err:
+                service.stats.record_failure()
+                self.__send(400, {"error": f"Could not parse snapshots: {err}"})
+                return
+            try:
+                result = service.score(df)
+            except KeyError as err:
+                service.stats.record_failure()
+                self.__send(400, {"error": f"Missing column {err}"})
+                return
+            except Exception as err:
+                # Errors of the feature engineering or of the model, also raised by the batch future
+                logger.exception("Scoring failed")
+                service.stats.record_failure()
+                self.__send(500, {"error": f"Scoring failed: {type(err).__name__}: {err}"})
+                return
+            self.__send(200, result.to_dict(orient="records"))
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return scoring_handler
+
+def run_server(host="127.0.0.1", port=8000, model_path=MODEL_PATH, max_batch_size=4096, max_wait_ms=5):
+    service = scoring_service(model_path=model_path, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    logger.info(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    import logging
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local HTTP scoring service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model-path", default=MODEL_PATH)
+    parser.add_argument("--max-batch-size", type=int, default=4096)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    run_server(host=args.host, port=args.port, model_path=args.model_path,
+               max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
@@ -1,8 +1,10 @@
 from logging import getLogger
-import pandas as pd
 # import pickle
-from mlflow.sklearn import save_model
+from mlflow.sklearn import save_model, load_model
+import numpy as np
 import warnings
+import tempfile
+import json
 import os
 
 from keras.models import Sequential
@@ -10,16 +12,29 @@ from keras.layers import Dense, Dropout
 from keras import optimizers
 from keras.wrappers.scikit_learn import KerasClassifier
 
-from src.data.hdd_preprocessing import load_preprocess_data, train_test_splitter
+from src.data.hdd_preprocessing import load_preprocess_data, train_test_splitter, raw_file
 from src.features.feature_engineering import hdd_preprocessor, log_transformer
+from src.features.feature_cache import feature_cache, code_version
+from src.features.feature_shards import write_feature_shards, read_manifest, feature_shard_files, read_feature_shard, iter_batches
+from src.features.feature_matrix import write_feature_matrix, feature_matrix
+from src.models.numpy_model import activations
+from src.models.resources import thread_budget, cpu_utilization
+from src.models.evaluate import evaluate_model, iter_frame_chunks, iter_matrix_chunks, log_metrics, load_threshold
 
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import LogisticRegression
 from sklearn.ensemble import StackingClassifier
 from xgboost import XGBClassifier
+import xgboost
 
 RSEED = 42
+# Folder of the cached feature matrices
+FEATURE_CACHE = "data/cache/features"
+# Folder of the memory-mapped feature matrices
+FEATURE_MATRIX = "data/matrix"
+# Model folder holding the decision threshold of the evaluation
+DEPLOYMENT_PATH = "models/deployment"
 
 warnings.filterwarnings("ignore")
 logger = getLogger(__name__)
@@ -39,39 +54,88 @@ def __create_ann_model__(input_dim=19):
                     metrics = ['Recall', 'Precision'])
         return model
         
-def __get_data():
+def __get_data(use_cache=True, filename="ST4000DM000_history_total"):
+    params = {"days": 30, "trigger": 0.05, "test_size": 0.30, "random_state": RSEED}
+    if use_cache:
+        cache = feature_cache(FEATURE_CACHE)
+        key = cache.key([raw_file(filename, os.getcwd())], params, code_version())
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info(f"Loading the features from the cache entry {key}")
+            return cached
     logger.info("Loading and preprocessing data")
-    X, y = load_preprocess_data(   days=30, filename="ST4000DM000_history_total", 
+    X, y = load_preprocess_data(   days=params["days"], filename=filename, 
                                     path=os.getcwd())
     logger.info("Train-test splitting")
     X_train, X_test, y_train, y_test = train_test_splitter(
-        X, y, test_size=0.30, random_state=RSEED
+        X, y, test_size=params["test_size"], random_state=params["random_state"]
         )
     logger.info("Feature engineering on train")
-    preprocessor = hdd_preprocessor(days=30, trigger=0.05)
+    preprocessor = hdd_preprocessor(days=params["days"], trigger=params["trigger"])
     X_train = preprocessor.fit_transform(X_train)
     logger.info("Feature engineering on test")
+    # The serial numbers of the test rows for the metrics per drive, dropped from the features
+    ids_test = X_test[["serial_number"]]
     X_test = preprocessor.transform(X_test)
-    return X_train, X_test, y_train, y_test
+    if use_cache:
+        logger.info(f"Storing the features in the cache entry {key}")
+        cache.put(key, X_train, X_test, y_train, y_test, ids_test, params=params)
+    return X_train, X_test, y_train, y_test, ids_test
 
 
-def __compute_and_log_metrics(
-    y_true: pd.Series, y_pred: pd.Series, prefix: str = "train"
-):
-    pass
+def __get_threshold(model_path=DEPLOYMENT_PATH):
+    try:
+        return load_threshold(model_path)
+    except OSError:
+        logger.warning(f"No threshold in {model_path}, evaluating at 0.5")
+        return 0.5
 
 
-def run_training():
-    logger.info(f"Getting the data")
-    X_train, X_test, y_train, y_test = __get_data()
+def __compute_and_log_metrics(model, chunks, prefix: str = "test", threshold=None):
+    """Score the chunks, compute the metrics with streaming_metrics and log them
 
-    logger.info("Training")
+    Args:
+        model: Fitted model with predict_proba
+        chunks (iterable): Tuples of features, target and serial numbers (or None), see evaluate_model
+        prefix (str, optional): Prefix of the metric names. Defaults to "test".
+        threshold (float, optional): Decision threshold. Defaults to the threshold of the deployment model.
+
+    Returns:
+        dict: Metrics with the inference throughput, see evaluate_model
+    """
+    threshold = __get_threshold() if threshold is None else threshold
+    metrics = evaluate_model(model, chunks, threshold=threshold)
+    log_metrics(metrics, prefix=prefix)
+    return metrics
+
+
+def build_pipeline(y_train, input_dim=19, n_jobs=-1, copy=True, dtype=None, budget=None) -> Pipeline:
+    """Unfitted pipeline of scaling and the stacked XGBoost and ANN classifiers
+
+    Args:
+        y_train (pd.Series): Train target, sets the class weights
+        input_dim (int, optional): Number of features. Defaults to 19.
+        n_jobs (int, optional): Parallel jobs of the stacking. Defaults to -1.
+        copy (bool, optional): Let the scaling steps copy the features, otherwise they scale float
+            features in place, e.g. a feature matrix mapped copy-on-write. Defaults to True.
+        dtype (str, optional): Cast the features to this dtype before scaling, "float32" for a
+            feature matrix. Defaults to None (scaling in the dtype of the features).
+        budget (thread_budget, optional): Thread budget setting the jobs of the stacking and the
+            XGBoost threads in place of n_jobs. Defaults to None (thread pools of the libraries).
+
+    Returns:
+        Pipeline: Model pipeline
+    """
+    xgb_threads = None
+    if budget is not None:
+        n_jobs, xgb_threads = budget.stacking_jobs, budget.xgb_threads
     # Scaling pipeline
     scaling_pipe = Pipeline([
-                ('scaler_log', log_transformer(offset=1)),
-                ('scaler_minmax ', MinMaxScaler()),
+                ('scaler_log', log_transformer(offset=1, copy=copy, dtype=dtype)),
+                ('scaler_minmax ', MinMaxScaler(copy=copy)),
                 ])
     ann_classifier = KerasClassifier(build_fn=__create_ann_model__, 
+                            input_dim=input_dim,
                             epochs=15,
                             batch_size= 40000,
                             class_weight={0 : 1.0, 1 : 0.4*len(y_train)/y_train.sum()},
@@ -91,16 +155,70 @@ def run_training():
                         reg_lambda=0.7, # 1, L2 regularization
                         reg_alpha=1, # 0, L1 regularization
                         use_label_encoder=False,
+                        n_jobs=xgb_threads,
                         )),
         ('nn', ann_classifier),
         ]
-    clf = StackingClassifier(estimators = estimators, final_estimator=LogisticRegression(class_weight=0.4*len(y_train)/y_train.sum()), n_jobs=-1)
+    clf = StackingClassifier(estimators = estimators, final_estimator=LogisticRegression(class_weight=0.4*len(y_train)/y_train.sum()), n_jobs=n_jobs)
     model = Pipeline([
                 ('scaling', scaling_pipe),
                 ('stacking', clf),
             ])
+    return model
+
+
+def write_feature_matrices(folder=FEATURE_MATRIX, use_cache=True, filename="ST4000DM000_history_total"):
+    """Write the train and test features as memory-mapped float32 matrices, see write_feature_matrix
+
+    Args:
+        folder (str, optional): Folder of the matrices. Defaults to FEATURE_MATRIX.
+        use_cache (bool, optional): Read and write the feature cache. Defaults to True.
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+    """
+    X_train, X_test, y_train, y_test, ids_test = __get_data(use_cache=use_cache, filename=filename)
+    logger.info(f"Writing the feature matrices to {folder}")
+    write_feature_matrix(X_train, f"{folder}/train.npy", y=y_train)
+    # The serial numbers of the test rows for the metrics per drive
+    write_feature_matrix(X_test, f"{folder}/test.npy", y=y_test, ids=ids_test)
+
+
+def run_training(use_cache=True, filename="ST4000DM000_history_total", matrix_folder=None, build_matrix=True,
+                 n_cores=None):
+    """Train the stacked model and save it in models/stacked
+
+    Args:
+        use_cache (bool, optional): Read and write the feature matrices from the feature cache,
+            which skips the preprocessing for unchanged data, parameters and code. Defaults to True.
+        filename (str, optional): Name of the csv file. Defaults to "ST4000DM000_history_total".
+        matrix_folder (str, optional): Train on the memory-mapped feature matrices in this folder,
+            scaled in place in copy-on-write pages. Defaults to None (features in memory).
+        build_matrix (bool, optional): Write the feature matrices first, otherwise the existing
+            matrices are used. Defaults to True.
+        n_cores (int, optional): Core budget of the training, split by thread_budget. Defaults to
+            None (available cores).
+    """
+    budget = thread_budget(n_cores).apply()
+    logger.info("Getting the data")
+    if matrix_folder is None:
+        X_train, X_test, y_train, y_test, ids_test = __get_data(use_cache=use_cache, filename=filename)
+    else:
+        if build_matrix:
+            write_feature_matrices(matrix_folder, use_cache=use_cache, filename=filename)
+        train = feature_matrix(f"{matrix_folder}/train.npy", mode="c")
+        X_train, y_train = train.frame(), train.y
+
+    logger.info("Training")
+    if matrix_folder is None:
+        model = build_pipeline(y_train, input_dim=X_train.shape[1], budget=budget)
+    else:
+        model = build_pipeline(y_train, input_dim=X_train.shape[1], copy=False, dtype="float32", budget=budget)
     logger.info("Fitting in progress")
-    model.fit(X_train, y_train)
+    with budget.backend(), cpu_utilization(budget.n_cores):
+        model.fit(X_train, y_train)
+    if matrix_folder is not None:
+        # The saved model must not scale the features of its callers in place
+        for _, step in model.named_steps["scaling"].steps:
+            step.copy = True
     logger.info("Pickle")
     # filename = 'deployment.bin'
     # with open(filename, 'wb') as file_out:
@@ -109,14 +227,317 @@ def run_training():
     logger.info("Saving model in the model folder")
     path = "models/stacked"
     save_model(sk_model=model, path=path)
+    logger.info("Exporting the weights for the NumPy model")
+    export_weights(model, f"{path}/weights.npz")
+    logger.info("Evaluating on the test drives")
+    if matrix_folder is None:
+        chunks = iter_frame_chunks(X_test, y_test, serial_numbers=ids_test.serial_number)
+    else:
+        chunks = iter_matrix_chunks(feature_matrix(f"{matrix_folder}/test.npy"))
+    __compute_and_log_metrics(model, chunks, prefix="test")
+
+
+class shard_iter(xgboost.DataIter):
+    """XGBoost data iterator over the scaled feature shards, one shard in memory at a time"""
+    def __init__(self, files, scale, cache_prefix):
+        self.files = files
+        self.scale = scale
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.position == len(self.files):
+            return 0
+        X, y = read_feature_shard(self.files[self.position])
+        input_data(data=self.scale(X), label=y.values.astype(np.float32))
+        self.position += 1
+        return 1
+
+    def reset(self):
+        self.position = 0
+
+
+def run_training_out_of_core(shard_folder="data/shards", output="models/out_of_core", build_shards=True,
+                             meta_fraction=0.2, batch_size=40000, epochs=15, tree_method="approx"):
+    """Train the stacked model from feature shards on disk, so that the peak memory depends on
+    the shard size and not on the size of the history. XGBoost reads the shards through its
+    external memory data iterator, the ANN is trained in mini-batches from the same shards and
+    the logistic-regression meta-learner on the predictions for held out shards of drives.
+    The model is saved as NumPy weights file for src.models.numpy_model, next to the XGBoost
+    and Keras models.
+
+    Args:
+        shard_folder (str, optional): Folder of the feature shards. Defaults to "data/shards".
+        output (str, optional): Folder of the trained model. Defaults to "models/out_of_core".
+        build_shards (bool, optional): Write the feature shards from the raw data first. Defaults to True.
+        meta_fraction (float, optional): Fraction of the train shards held out for the meta-learner. Defaults to 0.2.
+        batch_size (int, optional): Mini-batch size of the ANN. Defaults to 40000.
+        epochs (int, optional): Epochs of the ANN. Defaults to 15.
+        tree_method (str, optional): XGBoost tree method supporting external memory. Defaults to "approx".
+    """
+    if build_shards:
+        logger.info("Writing the feature shards")
+        write_feature_shards(shard_folder, filename="ST4000DM000_history_total", path=os.getcwd(),
+                             days=30, trigger=0.05, test_size=0.30, random_state=RSEED)
+    files = feature_shard_files(shard_folder, "train")
+    if len(files) < 2:
+        raise ValueError("Out-of-core training needs at least two train shards")
+    logger.info("Fitting the scaling on the shards")
+    log_scaler = log_transformer(offset=1)
+    minmax_scaler = MinMaxScaler()
+    n_rows, n_failures = 0, 0
+    for file in files:
+        X, y = read_feature_shard(file)
+        minmax_scaler.partial_fit(log_scaler.transform(X))
+        n_rows += len(y)
+        n_failures += int(y.sum())
+    ratio = 0.4 * n_rows / n_failures
+
+    def scale(X):
+        return minmax_scaler.transform(log_scaler.transform(X))
+
+    n_meta = max(1, int(len(files) * meta_fraction))
+    meta_files, base_files = files[:n_meta], files[n_meta:]
+
+    logger.info("Training XGBoost from the shards")
+    params = {  "objective": "binary:logistic",
+                "scale_pos_weight": ratio,
+                "colsample_bytree": 0.4,
+                "subsample": 0.3,
+                "eta": 0.01,
+                "gamma": 1,
+                "max_depth": 6,
+                "min_child_weight": 2,
+                "lambda": 0.7,
+                "alpha": 1,
+                "tree_method": tree_method,
+                "seed": RSEED,
+                }
+    with tempfile.TemporaryDirectory() as cache:
+        dtrain = xgboost.DMatrix(shard_iter(base_files, scale, cache_prefix=f"{cache}/xgb"))
+        booster = xgboost.train(params, dtrain, num_boost_round=50)
+        del dtrain
+
+    logger.info("Training the ANN in mini-batches from the shards")
+    rows = read_manifest(shard_folder)["shards"]["train"]
+    steps = sum(-(-rows[os.path.splitext(os.path.basename(file))[0]] // batch_size) for file in base_files)
+    # The class weights are passed as sample weights of the batches
+    batches = ((scale(X), y.values.astype(np.float32), np.where(y.values, ratio, 1.0))
+               for X, y in iter_batches(base_files, batch_size=batch_size, seed=RSEED))
+    ann = __create_ann_model__(input_dim=minmax_scaler.n_features_in_)
+    ann.fit(batches, steps_per_epoch=steps, epochs=epochs, verbose=0)
+
+    logger.info("Fitting the meta-learner on the held out shards")
+    meta_X, meta_y = [], []
+    for file in meta_files:
+        X, y = read_feature_shard(file)
+        X = scale(X)
+        meta_X.append(np.column_stack([booster.predict(xgboost.DMatrix(X)),
+                                       ann.predict(X, batch_size=batch_size, verbose=0)[:, 0]]))
+        meta_y.append(y.values.astype(int))
+    meta = LogisticRegression(class_weight={0: 1.0, 1: ratio}).fit(np.concatenate(meta_X), np.concatenate(meta_y))
+
+    logger.info("Saving model in the model folder")
+    os.makedirs(output, exist_ok=True)
+    booster.save_model(f"{output}/xgb.json")
+    ann.save(f"{output}/ann.h5")
+    __write_weights(f"{output}/weights.npz", [log_scaler, minmax_scaler], [booster, ann], meta=meta)
+
+
+def __pipeline_steps(model):
+    # Steps of the pipeline with the nested pipelines flattened
+    for _, step in model.steps:
+        if isinstance(step, Pipeline):
+            yield from __pipeline_steps(step)
+        elif step is not None and step != "passthrough":
+            yield step
+
+
+def __export_transform(step, prefix: str) -> tuple:
+    if isinstance(step, log_transformer):
+        return "log", {f"{prefix}_offset": np.asarray(step.offset, dtype=float)}
+    if isinstance(step, MinMaxScaler):
+        clip = step.feature_range if getattr(step, "clip", False) else (np.nan, np.nan)
+        return "minmax", {  f"{prefix}_scale": step.scale_,
+                            f"{prefix}_min": step.min_,
+                            f"{prefix}_clip": np.asarray(clip, dtype=float),
+                            }
+    raise ValueError(f"Cannot export the transform {type(step).__name__}")
+
+
+def __export_xgb(booster, prefix: str, best_iteration=None) -> dict:
+    # The json model holds the exact single precision split conditions
+    with tempfile.TemporaryDirectory() as folder:
+        booster.save_model(f"{folder}/booster.json")
+        with open(f"{folder}/booster.json") as f:
+            learner = json.load(f)["learner"]
+    if learner["gradient_booster"]["name"] != "gbtree" or learner["objective"]["name"] != "binary:logistic":
+        raise ValueError("Only gbtree boosters with binary:logistic objective can be exported")
+    trees = learner["gradient_booster"]["model"]["trees"]
+    if best_iteration is not None:
+        # Trees of the best iteration found by early stopping, as used by predict_proba
+        parallel = int(learner["gradient_booster"]["model"]["gbtree_model_param"].get("num_parallel_tree", 1))
+        trees = trees[:(best_iteration + 1) * parallel]
+    arrays = {key: [] for key in ("left", "right", "feature", "threshold", "default_left", "value")}
+    roots, depth = [], 0
+    for tree in trees:
+        offset = sum(len(left) for left in arrays["left"])
+        left = np.asarray(tree["left_children"], dtype=np.int32)
+        right = np.asarray(tree["right_children"], dtype=np.int32)
+        leaf = left == -1
+        nodes = np.arange(len(left), dtype=np.int32)
+        # Leaves point to themselves, so that rows stay in their leaf
+        arrays["left"].append(np.where(leaf, nodes, left) + offset)
+        arrays["right"].append(np.where(leaf, nodes, right) + offset)
+        arrays["feature"].append(np.where(leaf, 0, tree["split_indices"]).astype(np.int32))
+        # Leaves store their value in the split condition
+        conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+        arrays["threshold"].append(np.where(leaf, 0, conditions).astype(np.float32))
+        arrays["value"].append(np.where(leaf, conditions, 0).astype(np.float32))
+        arrays["default_left"].append(np.asarray(tree["default_left"], dtype=bool))
+        roots.append(offset)
+        # Depth of the tree
+        stack = [(0, 0)]
+        while stack:
+            node, level = stack.pop()
+            depth = max(depth, level)
+            if not leaf[node]:
+                stack += [(left[node], level + 1), (right[node], level + 1)]
+    base_score = float(learner["learner_model_param"]["base_score"])
+    weights = {f"{prefix}_{key}": np.concatenate(values) for key, values in arrays.items()}
+    weights[f"{prefix}_roots"] = np.asarray(roots, dtype=np.int32)
+    weights[f"{prefix}_depth"] = np.asarray(depth)
+    weights[f"{prefix}_base_margin"] = np.asarray(np.log(base_score / (1 - base_score)))
+    return weights
+
+
+def __export_ann(network, prefix: str) -> dict:
+    weights, names = {}, []
+    for layer in network.layers:
+        kind = type(layer).__name__
+        if kind in ("Dropout", "InputLayer"):
+            continue
+        activation = getattr(getattr(layer, "activation", None), "__name__", None)
+        if kind != "Dense" or activation not in activations:
+            raise ValueError(f"Cannot export the layer {layer.name} ({kind}, {activation})")
+        kernel, bias = layer.get_weights()
+        weights[f"{prefix}_kernel_{len(names)}"] = kernel.astype(np.float32)
+        weights[f"{prefix}_bias_{len(names)}"] = bias.astype(np.float32)
+        names.append(activation)
+    if weights[f"{prefix}_kernel_{len(names) - 1}"].shape[1] != 1:
+        raise ValueError("Only networks with a single output unit can be exported")
+    weights[f"{prefix}_activations"] = np.asarray(names)
+    return weights
+
+
+def __export_logistic(estimator, prefix: str) -> dict:
+    return {f"{prefix}_coef": estimator.coef_, f"{prefix}_intercept": estimator.intercept_}
+
+
+def __export_estimator(estimator, prefix: str) -> tuple:
+    if isinstance(estimator, XGBClassifier):
+        return "xgb", __export_xgb(estimator.get_booster(), prefix, getattr(estimator, "best_iteration", None))
+    if isinstance(estimator, xgboost.Booster):
+        return "xgb", __export_xgb(estimator, prefix)
+    if isinstance(estimator, KerasClassifier):
+        return "ann", __export_ann(estimator.model, prefix)
+    if isinstance(estimator, Sequential):
+        return "ann", __export_ann(estimator, prefix)
+    if isinstance(estimator, LogisticRegression):
+        return "logistic", __export_logistic(estimator, prefix)
+    raise ValueError(f"Cannot export the estimator {type(estimator).__name__}")
+
+
+def export_weights(model, file: str):
+    """Export a fitted pipeline to a compact weights file for src.models.numpy_model
+
+    Args:
+        model (Pipeline): Fitted pipeline of log and MinMax scaling followed by an XGBoost,
+            Keras or logistic-regression classifier or a stacking of them
+        file (str): Path of the .npz weights file
+    """
+    steps = list(__pipeline_steps(model))
+    final = steps[-1]
+    if isinstance(final, StackingClassifier):
+        if final.passthrough or any(method != "predict_proba" for method in final.stack_method_):
+            raise ValueError("Only stackings of predict_proba without passthrough can be exported")
+        if not isinstance(final.final_estimator_, LogisticRegression):
+            raise ValueError("Only stackings with a logistic-regression meta-learner can be exported")
+        __write_weights(file, steps[:-1], final.estimators_, meta=final.final_estimator_)
+    else:
+        __write_weights(file, steps[:-1], [final])
+
+
+def __write_weights(file: str, transforms: list, estimators: list, meta=None):
+    # Transforms, (base) estimators and the meta-learner of a stacking to the weights file
+    weights, transform_kinds, estimator_kinds = {}, [], []
+    for i, step in enumerate(transforms):
+        kind, step_weights = __export_transform(step, f"transform_{i}")
+        transform_kinds.append(kind)
+        weights.update(step_weights)
+    if meta is not None:
+        weights.update(__export_logistic(meta, "meta"))
+    for i, estimator in enumerate(estimators):
+        kind, estimator_weights = __export_estimator(estimator, f"est_{i}")
+        estimator_kinds.append(kind)
+        weights.update(estimator_weights)
+    # Number and names of the features the pipeline was fitted on
+    fitted = [step for step in transforms + estimators if hasattr(step, "n_features_in_")]
+    if not fitted:
+        raise ValueError("Cannot determine the number of features of the pipeline")
+    weights["n_features"] = np.asarray(fitted[0].n_features_in_)
+    if hasattr(fitted[0], "feature_names_in_"):
+        weights["feature_names"] = np.asarray(fitted[0].feature_names_in_, dtype=str)
+    # Scaling in float32 for pipelines fitted on a feature matrix
+    dtypes = [step.dtype for step in transforms if getattr(step, "dtype", None) is not None]
+    if dtypes:
+        weights["dtype"] = np.asarray(np.dtype(dtypes[0]).name)
+    weights["transforms"] = np.asarray(transform_kinds, dtype=str)
+    weights["estimators"] = np.asarray(estimator_kinds, dtype=str)
+    np.savez_compressed(file, **weights)
+
+
+def export_model(model_path: str = "models/deployment", file: str = None) -> str:
+    """Export a saved MLflow model to a weights file for src.models.numpy_model
+
+    Args:
+        model_path (str, optional): Folder of the MLflow model. Defaults to "models/deployment".
+        file (str, optional): Path of the weights file. Defaults to weights.npz in the model folder.
+
+    Returns:
+        str: Path of the weights file
+    """
+    file = file or f"{model_path}/weights.npz"
+    export_weights(load_model(model_path), file)
+    return file
 
 
 if __name__ == "__main__":
     import logging
+    import argparse
 
     logger = logging.getLogger()
     logging.basicConfig(format="%(asctime)s: %(message)s")
     logging.getLogger("pyhive").setLevel(logging.CRITICAL)  # avoid excessive logs
     logger.setLevel(logging.INFO)
 
-    run_training()
+    parser = argparse.ArgumentParser(description="Train the stacked model")
+    parser.add_argument("--export", metavar="MODEL_PATH",
+                        help="Only export the weights of a saved model for src.models.numpy_model")
+    parser.add_argument("--no-cache", action="store_true", help="Recompute the features without the feature cache")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="Train from feature shards on disk instead of the in-memory feature matrix")
+    parser.add_argument("--shards", default="data/shards", help="Folder of the feature shards")
+    parser.add_argument("--reuse-shards", action="store_true", help="Train from existing feature shards")
+    parser.add_argument("--matrix", metavar="FOLDER", help="Train from memory-mapped float32 feature matrices")
+    parser.add_argument("--reuse-matrix", action="store_true", help="Train from existing feature matrices")
+    parser.add_argument("--cores", type=int, help="Core budget of the training, defaults to the available cores")
+    args = parser.parse_args()
+
+    if args.export:
+        logger.info(f"Weights written to {export_model(args.export)}")
+    elif args.out_of_core:
+        run_training_out_of_core(shard_folder=args.shards, build_shards=not args.reuse_shards)
+    else:
+        run_training(use_cache=not args.no_cache, matrix_folder=args.matrix, build_matrix=not args.reuse_matrix,
+                     n_cores=args.cores)
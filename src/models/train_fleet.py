@@ -0,0 +1,127 @@
+from logging import getLogger
+from mlflow.sklearn import save_model
+import os
+import time
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.data.hdd_preprocessing import partition_models, load_partition, select_columns, preprocess_drive_stats, train_test_splitter
+from src.features.feature_engineering import hdd_preprocessor
+from src.models.registry import REGISTRY_PATH, artifact_name, update_registry
+from src.models.train import RSEED, build_pipeline, export_weights
+from src.models.resources import thread_budget, available_cores
+
+logger = getLogger(__name__)
+
+def train_drive_model(model:str, partitions="data/partitioned", output=REGISTRY_PATH, min_coverage=0.99,
+                      min_failures=10, days=30, trigger=0.05, n_cores=None) -> dict:
+    """Fit the pipeline of one drive model on its partition and save the artifact
+
+    Args:
+        model (str): Drive model
+        partitions (str, optional): Folder of the partitioned dataset. Defaults to "data/partitioned".
+        output (str, optional): Folder of the registry and the artifacts. Defaults to REGISTRY_PATH.
+        min_coverage (float, optional): Minimal fraction of rows with a value of a selected column. Defaults to 0.99.
+        min_failures (int, optional): Minimal number of positive train rows. Defaults to 10.
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Normalized distance between raw and EMA. Defaults to 0.05.
+        n_cores (int, optional): Core budget of the drive model. Defaults to None (available cores).
+
+    Returns:
+        dict: Registry entry of the drive model, None if there are too few failures
+    """
+    X = load_partition(partitions, model)
+    columns = select_columns(X, min_coverage=min_coverage)
+    X, y = preprocess_drive_stats(X.loc[:, columns + ["failure"]], copy=False, columns=columns)
+    X_train, X_test, y_train, y_test = train_test_splitter(X, y, test_size=0.30, random_state=RSEED, method="hash")
+    if y_train.sum() < min_failures:
+        logger.warning(f"Skipping {model}: {int(y_train.sum())} positive train rows")
+        return None
+    logger.info(f"Training {model} on {len(X_train)} rows and {len(columns) - 2} columns")
+    X_train = hdd_preprocessor(days=days, trigger=trigger, cols=columns).fit_transform(X_train)
+    # The drive models run in parallel processes, so the stacking runs sequentially
+    budget = thread_budget(n_cores, stacking_jobs=1).apply()
+    pipeline = build_pipeline(y_train, input_dim=X_train.shape[1], budget=budget)
+    pipeline.fit(X_train, y_train)
+    artifact = artifact_name(model)
+    path = f"{output}/{artifact}"
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    save_model(sk_model=pipeline, path=path)
+    export_weights(pipeline, f"{path}/weights.npz")
+    return {"artifact": artifact,
+            "columns": columns,
+            "days": days,
+            "trigger": trigger,
+            "train_rows": len(X_train),
+            "train_failures": int(y_train.sum()),
+            "trained": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+
+def run_fleet_training(partitions="data/partitioned", output=REGISTRY_PATH, models=None, n_jobs=-1,
+                       min_coverage=0.99, min_failures=10, days=30, trigger=0.05) -> dict:
+    """Fit one pipeline per drive model in parallel processes and register the artifacts. The
+    registry is updated whenever a drive model is finished.
+
+    Args:
+        partitions (str, optional): Folder of the partitioned dataset. Defaults to "data/partitioned".
+        output (str, optional): Folder of the registry and the artifacts. Defaults to REGISTRY_PATH.
+        models (list, optional): Drive models to train. Defaults to None (all partitions).
+        n_jobs (int, optional): Number of worker processes, -1 for all cores. Defaults to -1.
+        min_coverage (float, optional): Minimal fraction of rows with a value of a selected column. Defaults to 0.99.
+        min_failures (int, optional): Minimal number of positive train rows. Defaults to 10.
+        days (int, optional): Time interval for EMA. Defaults to 30.
+        trigger (float, optional): Normalized distance between raw and EMA. Defaults to 0.05.
+
+    Returns:
+        dict: Registry entries of the trained drive models
+    """
+    available = partition_models(partitions)
+    models = list(available) if models is None else models
+    # Largest drive models first for a balanced load
+    models = sorted(models, key=lambda model: available[model]["rows"], reverse=True)
+    n_jobs = available_cores() if n_jobs == -1 else n_jobs
+    n_workers = min(n_jobs, len(models))
+    # Every drive model gets an equal share of the cores for its threads
+    n_cores = max(1, available_cores() // n_workers)
+    entries = {}
+    # Fresh interpreters, TensorFlow does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as pool:
+        futures = {pool.submit(train_drive_model, model, partitions=partitions, output=output, min_coverage=min_coverage,
+                               min_failures=min_failures, days=days, trigger=trigger, n_cores=n_cores): model for model in models}
+        for future in as_completed(futures):
+            model = futures[future]
+            try:
+                entry = future.result()
+            except Exception:
+                logger.exception(f"Training {model} failed")
+                continue
+            if entry is not None:
+                entries[model] = entry
+                update_registry({model: entry}, folder=output)
+                logger.info(f"Registered {model}")
+    return entries
+
+if __name__ == "__main__":
+    import logging
+    import argparse
+    from src.data.hdd_preprocessing import write_partitions
+
+    parser = argparse.ArgumentParser(description="Train one pipeline per drive model")
+    parser.add_argument("--source", help="Daily csv files to partition by drive model first")
+    parser.add_argument("--partitions", default="data/partitioned")
+    parser.add_argument("--output", default=REGISTRY_PATH)
+    parser.add_argument("--models", help="Comma separated drive models, defaults to all")
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logging.basicConfig(format="%(asctime)s: %(message)s")
+    logger.setLevel(logging.INFO)
+
+    if args.source:
+        write_partitions(args.source, folder=args.partitions)
+    models = args.models.split(",") if args.models else None
+    run_fleet_training(partitions=args.partitions, output=args.output, models=models, n_jobs=args.n_jobs)
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.hdd_preprocessing import cols_of_importance
+
+@pytest.fixture
+def raw_drive_stats() -> pd.DataFrame:
+    """Daily drive stats of 40 drives with the columns cols_of_importance and failure, with
+    missing values, duplicated days, a failing drive and a drive with a smart_7_raw outlier"""
+    rng = np.random.default_rng(7)
+    days = 90
+    frames = []
+    for drive in range(40):
+        df = pd.DataFrame({col: rng.integers(0, 50, size=days).cumsum().astype(np.float64)
+                           for col in cols_of_importance if col.startswith("smart_")})
+        df["smart_7_raw"] = rng.integers(10**6, 10**8, size=days).cumsum().astype(np.float64)
+        df["serial_number"] = f"Z300{drive:04d}"
+        df["date"] = pd.date_range("2021-01-01", periods=days)
+        df["failure"] = 0
+        frames.append(df)
+    frames[0].loc[days - 1, "failure"] = 1
+    frames[1].loc[10, "smart_7_raw"] = 1e11
+    df = pd.concat(frames, ignore_index=True)
+    df = pd.concat([df, df.sample(20, random_state=1)], ignore_index=True)
+    df.loc[df.sample(50, random_state=2).index, "smart_5_raw"] = np.nan
+    return df.sample(frac=1, random_state=3).reset_index(drop=True)
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+
+from src.features.feature_engineering import (unwrap_smart_7, calculate_ema, calculate_smart_999,
+                                              drop_feats, create_features, trigger_cols)
+
+def unwrap_smart_7_loop(df_in) -> pd.DataFrame:
+    # Original implementation, one boolean mask per drive and one update per jump
+    df = df_in.copy()
+    df["smart_7_mod"] = df.smart_7_raw
+    for drive in df.serial_number.unique():
+        temp_data = df[df.serial_number == drive].sort_values("date", ascending=True).reset_index()
+        jumps = temp_data.smart_7_raw.diff() < -5e8
+        jump_idx = jumps[jumps].index
+        smart_7_temp = temp_data.smart_7_raw.copy()
+        for idx in jump_idx:
+            temp_data.loc[idx:, "smart_7_raw"] += smart_7_temp[idx-1]
+        temp_data = temp_data.set_index("index")
+        df.loc[temp_data.index, "smart_7_mod"] = temp_data.smart_7_raw
+    return df
+
+def drive_history(serial_number, days, wraps, seed, nan_fraction=0.0) -> pd.DataFrame:
+    # Seek error counter that grows by up to 1e8 per day and wraps around at evenly spaced days
+    rng = np.random.default_rng(seed)
+    counter = np.cumsum(rng.integers(10**6, 10**8, size=days)).astype(np.float64)
+    for day in np.arange(1, wraps + 1) * (days // (wraps + 1)):
+        counter[day:] -= counter[day - 1] - rng.integers(0, 10**6)
+    counter[rng.random(days) < nan_fraction] = np.nan
+    return pd.DataFrame({   "serial_number": serial_number,
+                            "date": pd.date_range("2021-01-01", periods=days),
+                            "smart_7_raw": counter,
+                            })
+
+def drive_stats(seed=0, nan_fraction=0.0, shuffle=False) -> pd.DataFrame:
+    df = pd.concat([drive_history("Z300A", 120, wraps=0, seed=seed, nan_fraction=nan_fraction),
+                    drive_history("Z300B", 200, wraps=1, seed=seed + 1, nan_fraction=nan_fraction),
+                    drive_history("Z300C", 300, wraps=4, seed=seed + 2, nan_fraction=nan_fraction),
+                    drive_history("Z300D", 1, wraps=0, seed=seed + 3, nan_fraction=nan_fraction),
+                    ], ignore_index=True)
+    if shuffle:
+        df = df.sample(frac=1, random_state=seed)
+    return df
+
+@pytest.mark.parametrize("nan_fraction", [0.0, 0.1])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_unwrap_smart_7_matches_loop(nan_fraction, shuffle):
+    df = drive_stats(nan_fraction=nan_fraction, shuffle=shuffle)
+    pdt.assert_frame_equal(unwrap_smart_7(df), unwrap_smart_7_loop(df))
+
+def test_unwrap_smart_7_wraps_are_removed():
+    df = drive_stats()
+    mod = unwrap_smart_7(df).sort_values(["serial_number", "date"])
+    assert (mod.groupby("serial_number").smart_7_mod.diff().dropna() > 0).all()
+
+def test_unwrap_smart_7_integer_counter():
+    df = drive_stats(shuffle=True)
+    df["smart_7_raw"] = df.smart_7_raw.astype(np.int64)
+    pdt.assert_frame_equal(unwrap_smart_7(df), unwrap_smart_7_loop(df))
+
+@pytest.fixture
+def drive_features(raw_drive_stats) -> pd.DataFrame:
+    # Preprocessed drive stats without missing values and duplicates
+    df = raw_drive_stats.dropna().drop_duplicates(subset=["serial_number", "date"])
+    return df[df.smart_7_raw < 5e10].drop(columns=["failure"])
+
+@pytest.mark.parametrize("stage", [unwrap_smart_7, create_features])
+def test_stage_keeps_input(drive_features, stage):
+    df = drive_features.copy()
+    stage(drive_features, copy=True)
+    pdt.assert_frame_equal(drive_features, df)
+
+def test_stages_keep_input(drive_features):
+    df = drive_features.copy()
+    unwrapped = unwrap_smart_7(drive_features)
+    ema = calculate_ema(unwrapped, copy=True)
+    smart = calculate_smart_999(ema, copy=True)
+    expected_smart = smart.copy()
+    drop_feats(smart, copy=True)
+    pdt.assert_frame_equal(drive_features, df)
+    pdt.assert_frame_equal(unwrapped, unwrap_smart_7(df))
+    pdt.assert_frame_equal(ema, calculate_ema(unwrap_smart_7(df)))
+    pdt.assert_frame_equal(smart, expected_smart)
+
+def test_create_features_in_place_matches_copy(drive_features):
+    expected = create_features(drive_features, copy=True)
+    pdt.assert_frame_equal(create_features(drive_features.copy(), copy=False), expected)
+
+def test_calculate_ema_matches_pandas(drive_features):
+    df = calculate_ema(drive_features, days=30)
+    ordered = drive_features.sort_values(["serial_number", "date"])
+    expected = ordered.groupby("serial_number")[trigger_cols].transform(lambda s: s.ewm(span=30, min_periods=0).mean())
+    for col in trigger_cols:
+        pdt.assert_series_equal(df[col + "_ema"].loc[ordered.index], expected[col], check_names=False)
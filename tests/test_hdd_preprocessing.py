@@ -0,0 +1,22 @@
+import numpy as np
+import pandas.testing as pdt
+
+from src.data.hdd_preprocessing import preprocess_drive_stats, compact_dtypes
+
+def test_preprocess_drive_stats_keeps_input(raw_drive_stats):
+    df = raw_drive_stats.copy()
+    preprocess_drive_stats(raw_drive_stats, copy=True)
+    pdt.assert_frame_equal(raw_drive_stats, df)
+
+def test_preprocess_drive_stats_in_place_matches_copy(raw_drive_stats):
+    X_copy, y_copy = preprocess_drive_stats(raw_drive_stats, copy=True)
+    X_in_place, y_in_place = preprocess_drive_stats(raw_drive_stats.copy(), copy=False)
+    pdt.assert_frame_equal(X_in_place, X_copy)
+    pdt.assert_series_equal(y_in_place, y_copy)
+
+def test_preprocess_drive_stats_compact_dates_stay_int32(raw_drive_stats):
+    X, _ = preprocess_drive_stats(raw_drive_stats, compact=True)
+    assert X.date.dtype == np.int32
+    X_in_place, _ = preprocess_drive_stats(raw_drive_stats.copy(), compact=True, copy=False)
+    assert X_in_place.date.dtype == np.int32
+    assert compact_dtypes(X).date.dtype == np.int32